@@ -1,5 +1,9 @@
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Request
-from typing import Dict, Any
+from fastapi.responses import StreamingResponse
+from typing import Dict, Any, Optional
+import asyncio
+import json
+import time
 import uuid
 import logging
 import redis
@@ -12,9 +16,17 @@ from app.schemas.text_schemas import (
     TextProcessingResponse,
     TaskStatusResponse,
     TaskStatus,
-    ProcessedTextResult
+    ProcessedTextResult,
+    BatchTextProcessingRequest,
+    BatchTextProcessingResponse,
+    BatchStatusResponse
+)
+from app.workers.tasks import (
+    process_text_task,
+    record_text_analysis_start,
+    record_text_analysis_completed,
+    record_text_analysis_failed
 )
-from app.workers.tasks import process_text_task
 from app.core.celery_app import celery_app
 from app.services.openai_service import openai_service
 from app.core.config import settings
@@ -98,9 +110,9 @@ async def check_openai_quota() -> tuple[bool, dict]:
         current_rpm = int(redis_client.get(rpm_key) or 0)
         current_tpm = int(redis_client.get(tpm_key) or 0)
         
-        # Limiti conservativi (adatta ai tuoi tier OpenAI)
-        MAX_RPM = 450  # Sotto il limite di 500 per sicurezza
-        MAX_TPM = 80000  # Sotto il limite di 90k per sicurezza
+        # Stessi limiti applicati da OpenAIRateLimiter
+        MAX_RPM = settings.openai_rpm_limit
+        MAX_TPM = settings.openai_tpm_limit
         
         quota_info = {
             "current_rpm": current_rpm,
@@ -126,31 +138,6 @@ async def check_openai_quota() -> tuple[bool, dict]:
         logger.error(f"Error checking OpenAI quota: {e}")
         return True, {"status": "error", "message": str(e)}
 
-async def track_openai_usage(estimated_tokens: int = 1000):
-    """Traccia l'utilizzo OpenAI in Redis"""
-    if not redis_available:
-        return
-        
-    try:
-        current_minute = datetime.utcnow().strftime("%Y%m%d%H%M")
-        
-        # Incrementa contatori
-        rpm_key = f"openai:rpm:{current_minute}"
-        tpm_key = f"openai:tpm:{current_minute}"
-        
-        # Incrementa RPM
-        redis_client.incr(rpm_key)
-        redis_client.expire(rpm_key, 60)  # Scade dopo 1 minuto
-        
-        # Incrementa TPM (stima)
-        redis_client.incrby(tpm_key, estimated_tokens)
-        redis_client.expire(tpm_key, 60)
-        
-        logger.info(f"OpenAI usage tracked: +1 request, +{estimated_tokens} tokens")
-        
-    except Exception as e:
-        logger.error(f"Error tracking OpenAI usage: {e}")
-
 def estimate_tokens(text: str) -> int:
     """Stima approssimativa dei token per il testo"""
     # Stima: 1 token ≈ 0.75 parole in inglese, un po' più in italiano
@@ -199,6 +186,168 @@ async def apply_rate_limit_safe(request: Request, limit: str, key_func=None):
         logger.warning(f"Rate limiting failed: {e}")
         # Non bloccare la richiesta se il rate limiting fallisce
 
+async def enforce_tier_limits(
+    fastapi_request: Request,
+    text: str,
+    word_count: int,
+    subscription_tier: str,
+    credits_remaining: int
+):
+    """Rate limit, limiti di lunghezza e crediti per tier (HTTPException se non rispettati)"""
+    # ✅ RATE LIMITING DIFFERENZIATO PER TIER
+    if subscription_tier == "free":
+        # Free: 30 req/hour
+        await apply_rate_limit_safe(fastapi_request, "30/hour")
+    else:
+        # Premium: 500 req/hour
+        await apply_rate_limit_safe(fastapi_request, "500/hour")
+
+    check_text_limits(text, word_count, subscription_tier)
+
+    # ✅ VERIFICA CREDITI SUFFICIENTI PER FREE USERS (1 credito per processo)
+    if subscription_tier == "free":
+        if credits_remaining < 1:
+            raise HTTPException(
+                status_code=403,
+                detail={
+                    "code": "INSUFFICIENT_CREDITS",
+                    "message": f"Insufficient credits. You need at least 1 credit to process text.",
+                    "credits_remaining": credits_remaining,
+                    "subscription_tier": subscription_tier
+                }
+            )
+
+def check_text_limits(text: str, word_count: int, subscription_tier: str):
+    """Limiti di parole e caratteri per singolo testo in base al tier (HTTPException se superati)"""
+    if subscription_tier == "free":
+        # Free: max 200 parole per richiesta
+        max_words_per_request = 200
+        max_text_length = 10000  # Mantieni anche limite caratteri per sicurezza
+    else:
+        # Premium: max 1000 parole per richiesta
+        max_words_per_request = 1000
+        max_text_length = 50000
+
+    # ✅ VERIFICA LIMITE PAROLE PER TIER
+    if word_count > max_words_per_request:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "code": "TEXT_TOO_LONG",
+                "message": f"Text exceeds maximum word limit for {subscription_tier} tier",
+                "max_words": max_words_per_request,
+                "current_words": word_count,
+                "subscription_tier": subscription_tier
+            }
+        )
+
+    # Verifica lunghezza caratteri per tier (sicurezza aggiuntiva)
+    if len(text) > max_text_length:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "code": "TEXT_TOO_LONG",
+                "message": f"Text exceeds maximum character length for {subscription_tier} tier",
+                "max_length": max_text_length,
+                "current_length": len(text),
+                "subscription_tier": subscription_tier
+            }
+        )
+
+def consume_credit(user_id: str, user_email: str, subscription_tier: str, credits_remaining: int, word_count: int):
+    """Scala 1 credito agli utenti free"""
+    if subscription_tier == "free" and credits_remaining >= 1:
+        new_credits = credits_remaining - 1
+        supabase_client.table("users").update({
+            "credits_remaining": new_credits
+        }).eq("id", user_id).execute()
+
+        logger.info(f"Credits decremented for user {user_email}: {credits_remaining} -> {new_credits} (1 credit for process, {word_count} words)")
+
+def refund_credit(user_id: str, user_email: str, subscription_tier: str, credits_remaining: int):
+    """Restituisce il credito scalato da consume_credit (elaborazione fallita)"""
+    if subscription_tier == "free" and credits_remaining >= 1:
+        supabase_client.table("users").update({
+            "credits_remaining": credits_remaining
+        }).eq("id", user_id).execute()
+
+        logger.info("Credit refunded for user %s: back to %s", user_email, credits_remaining)
+
+def _sse_event(data: str, event: Optional[str] = None) -> str:
+    """Evento Server-Sent Events (una riga data: per ogni riga del contenuto)"""
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+async def _record_quietly(func, *args):
+    """Scrittura su Supabase in un thread: un errore di persistenza non interrompe lo stream"""
+    try:
+        await asyncio.to_thread(func, *args)
+    except Exception as e:
+        logger.warning("⚠️ %s failed: %s", func.__name__, e)
+
+async def stream_processed_text(
+    request: TextProcessingRequest,
+    task_id: str,
+    user_id: str,
+    user_email: str,
+    subscription_tier: str,
+    credits_remaining: int,
+    word_count: int
+):
+    """
+    Genera gli eventi SSE di /process/stream: start, i frammenti del testo, poi done oppure error.
+    Il credito viene scalato al primo frammento prodotto e restituito se lo stream fallisce;
+    se il client si disconnette dopo il primo frammento il credito resta scalato.
+    """
+    started_at = time.monotonic()
+    parts = []
+    charged = False
+    finished = False
+    try:
+        await _record_quietly(record_text_analysis_start, task_id, user_id, request.text)
+        yield _sse_event(json.dumps({"task_id": task_id}), "start")
+
+        async for piece in openai_service.process_text_stream(
+            request.text,
+            request.processing_type.value,
+            request.options
+        ):
+            if not charged:
+                await asyncio.to_thread(consume_credit, user_id, user_email, subscription_tier, credits_remaining, word_count)
+                charged = True
+            parts.append(piece)
+            yield _sse_event(piece)
+        finished = True
+
+    except Exception as e:
+        finished = True
+        logger.error("❌ Text streaming %s failed: %s", task_id, e)
+        if charged:
+            await _record_quietly(refund_credit, user_id, user_email, subscription_tier, credits_remaining)
+        await _record_quietly(record_text_analysis_failed, task_id, str(e))
+        yield _sse_event(json.dumps({
+            "task_id": task_id,
+            "code": "STREAM_FAILED",
+            "message": "Text processing failed",
+            # Il credito eventualmente scalato è già stato restituito
+            "credit_charged": False
+        }), "error")
+        return
+
+    finally:
+        if not finished:
+            # Client disconnesso: il generatore viene cancellato, la scrittura parte senza await
+            asyncio.get_running_loop().run_in_executor(
+                None, record_text_analysis_failed, task_id, "client disconnected"
+            )
+
+    processing_time_ms = int((time.monotonic() - started_at) * 1000)
+    await _record_quietly(
+        record_text_analysis_completed, task_id, "".join(parts), request.processing_type.value, processing_time_ms
+    )
+    yield _sse_event(json.dumps({"task_id": task_id}), "done")
+
 # ================================
 # ENDPOINTS AGGIORNATI
 # ================================
@@ -228,56 +377,7 @@ async def process_text(
         word_count = count_words(request.text)
         logger.info(f"Word count for request: {word_count} words")
 
-        # ✅ RATE LIMITING DIFFERENZIATO PER TIER
-        if subscription_tier == "free":
-            # Free: 30 req/hour, max 200 parole per richiesta
-            await apply_rate_limit_safe(fastapi_request, "30/hour")
-            max_words_per_request = 200
-            max_text_length = 10000  # Mantieni anche limite caratteri per sicurezza
-        else:
-            # Premium: 500 req/hour, max 1000 parole per richiesta
-            await apply_rate_limit_safe(fastapi_request, "500/hour")
-            max_words_per_request = 1000
-            max_text_length = 50000
-
-        # ✅ VERIFICA LIMITE PAROLE PER TIER
-        if word_count > max_words_per_request:
-            raise HTTPException(
-                status_code=400,
-                detail={
-                    "code": "TEXT_TOO_LONG",
-                    "message": f"Text exceeds maximum word limit for {subscription_tier} tier",
-                    "max_words": max_words_per_request,
-                    "current_words": word_count,
-                    "subscription_tier": subscription_tier
-                }
-            )
-
-        # Verifica lunghezza caratteri per tier (sicurezza aggiuntiva)
-        if len(request.text) > max_text_length:
-            raise HTTPException(
-                status_code=400,
-                detail={
-                    "code": "TEXT_TOO_LONG",
-                    "message": f"Text exceeds maximum character length for {subscription_tier} tier",
-                    "max_length": max_text_length,
-                    "current_length": len(request.text),
-                    "subscription_tier": subscription_tier
-                }
-            )
-
-        # ✅ VERIFICA CREDITI SUFFICIENTI PER FREE USERS (1 credito per processo)
-        if subscription_tier == "free":
-            if credits_remaining < 1:
-                raise HTTPException(
-                    status_code=403,
-                    detail={
-                        "code": "INSUFFICIENT_CREDITS",
-                        "message": f"Insufficient credits. You need at least 1 credit to process text.",
-                        "credits_remaining": credits_remaining,
-                        "subscription_tier": subscription_tier
-                    }
-                )
+        await enforce_tier_limits(fastapi_request, request.text, word_count, subscription_tier, credits_remaining)
 
         # Rate limiting globale OpenAI
         await apply_rate_limit_safe(fastapi_request, "200/minute", key_func=get_global_key)
@@ -304,12 +404,11 @@ async def process_text(
         # Generate task ID
         task_id = str(uuid.uuid4())
 
-        # Traccia l'utilizzo prima della chiamata
-        await track_openai_usage(estimated_tokens)
+        # L'utilizzo (openai:rpm/tpm) viene prenotato da OpenAIService al momento della chiamata
 
         # Get text analysis for estimated completion time
         try:
-            analysis = await openai_service.get_text_analysis(request.text)
+            analysis = openai_service.get_text_analysis(request.text)
         except Exception as openai_error:
             logger.error(f"OpenAI service error: {openai_error}")
             analysis = {
@@ -321,13 +420,7 @@ async def process_text(
                              timedelta(seconds=analysis["estimated_processing_time"])
 
         # ✅ DECREMENTA CREDITI PER FREE USERS (1 credito per processo)
-        if subscription_tier == "free" and credits_remaining >= 1:
-            new_credits = credits_remaining - 1
-            supabase_client.table("users").update({
-                "credits_remaining": new_credits
-            }).eq("id", user_id).execute()
-
-            logger.info(f"Credits decremented for user {user_email}: {credits_remaining} -> {new_credits} (1 credit for process, {word_count} words)")
+        consume_credit(user_id, user_email, subscription_tier, credits_remaining, word_count)
 
         # Start Celery task con retry policy
         task = process_text_task.apply_async(
@@ -509,6 +602,153 @@ async def cancel_task(
             detail=f"Failed to cancel task: {str(e)}"
         )
 
+@router.post("/process/stream")
+async def process_text_stream(
+    request: TextProcessingRequest,
+    fastapi_request: Request,
+    user: dict = Depends(get_authenticated_user_with_credits)
+):
+    """
+    Process text synchronously, streaming the transformed text as Server-Sent Events
+    (start, unnamed chunk events, then done or error).
+    Same tier limits as /process; the credit is charged once the first chunk is produced
+    """
+    try:
+        user_id = user.get("id")
+        user_email = user.get("email")
+        subscription_tier = user.get("subscription_tier", "free")
+        credits_remaining = user.get("credits_remaining", 0)
+
+        word_count = count_words(request.text)
+        await enforce_tier_limits(fastapi_request, request.text, word_count, subscription_tier, credits_remaining)
+        await apply_rate_limit_safe(fastapi_request, "200/minute", key_func=get_global_key)
+
+        can_proceed, quota_info = await check_openai_quota()
+        if not can_proceed:
+            raise HTTPException(
+                status_code=429,
+                detail={
+                    "error": "Rate limit",
+                    "message": "API quota temporarily exceeded. Please try again in a moment.",
+                    "retry_after": 60,
+                    "quota_info": quota_info,
+                    "type": "openai_quota_exceeded"
+                }
+            )
+
+        task_id = str(uuid.uuid4())
+        logger.info(f"✅ Text streaming started - Task: {task_id}, User: {user_email} ({subscription_tier}), Word count: {word_count}")
+
+        return StreamingResponse(
+            stream_processed_text(
+                request, task_id, user_id, user_email, subscription_tier, credits_remaining, word_count
+            ),
+            media_type="text/event-stream",
+            headers={
+                "X-Task-ID": task_id,
+                "Cache-Control": "no-cache",
+                # nginx non deve bufferizzare lo stream
+                "X-Accel-Buffering": "no"
+            }
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to start text streaming: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to start text streaming: {str(e)}"
+        )
+
+@router.post("/batch", response_model=BatchTextProcessingResponse)
+async def submit_batch(
+    request: BatchTextProcessingRequest,
+    fastapi_request: Request,
+    user: dict = Depends(get_authenticated_user_with_credits)
+):
+    """
+    Submit many texts to the OpenAI Batch API (results within 24h, half the cost)
+    Requires authentication and a paid subscription
+    """
+    try:
+        await apply_rate_limit_safe(fastapi_request, "10/hour")
+
+        subscription_tier = user.get("subscription_tier", "free")
+        if subscription_tier == "free":
+            raise HTTPException(
+                status_code=403,
+                detail={
+                    "code": "SUBSCRIPTION_REQUIRED",
+                    "message": "Batch processing requires a paid subscription",
+                    "subscription_tier": "free"
+                }
+            )
+
+        # Stessi limiti per testo di /process, applicati a ogni elemento
+        for index, item in enumerate(request.items):
+            try:
+                check_text_limits(item.text, count_words(item.text), subscription_tier)
+            except HTTPException as limit_error:
+                limit_error.detail["item_index"] = index
+                raise
+
+        batch_id = await openai_service.submit_batch(user.get("id"), [
+            {
+                "text": item.text,
+                "processing_type": item.processing_type.value,
+                "options": item.options,
+                "custom_id": item.custom_id,
+            }
+            for item in request.items
+        ])
+
+        logger.info("✅ Batch %s submitted by %s with %d items", batch_id, user.get("email"), len(request.items))
+
+        return BatchTextProcessingResponse(
+            batch_id=batch_id,
+            status="validating",
+            total=len(request.items),
+            custom_ids=[item.custom_id for item in request.items]
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to submit batch: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to submit batch: {str(e)}"
+        )
+
+@router.get("/batch/{batch_id}", response_model=BatchStatusResponse)
+async def get_batch_status(
+    batch_id: str,
+    fastapi_request: Request,
+    user: dict = Depends(verify_email_verified)
+):
+    """
+    Get status of a batch and, once finished, its results by custom_id
+    """
+    try:
+        await apply_rate_limit_safe(fastapi_request, "60/minute")
+
+        # Il batch è visibile solo all'utente che lo ha inviato
+        batch_results = await openai_service.get_batch_results(batch_id, user.get("id"))
+        if batch_results is None:
+            raise HTTPException(status_code=404, detail="Batch not found")
+
+        return BatchStatusResponse(**batch_results)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to get batch status for {batch_id}: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to get batch status: {str(e)}"
+        )
+
 @router.get("/health")
 async def health_check():
     """
@@ -541,10 +781,10 @@ async def health_check():
                 quota_info = {
                     "current_rpm": current_rpm,
                     "current_tpm": current_tpm,
-                    "rpm_limit": 450,
-                    "tpm_limit": 80000,
-                    "rpm_usage_percent": round((current_rpm / 450) * 100, 2),
-                    "tpm_usage_percent": round((current_tpm / 80000) * 100, 2)
+                    "rpm_limit": settings.openai_rpm_limit,
+                    "tpm_limit": settings.openai_tpm_limit,
+                    "rpm_usage_percent": round((current_rpm / settings.openai_rpm_limit) * 100, 2),
+                    "tpm_usage_percent": round((current_tpm / settings.openai_tpm_limit) * 100, 2)
                 }
             except Exception as e:
                 quota_info = {"error": str(e)}
@@ -98,6 +98,8 @@ celery_app.conf.update(
         "process_free_user_deletions": {"queue": "subscriptions"},
         #"cleanup-old-payment-intents-task": {"queue": "cleanup"},
         "cleanup_tables_task": {"queue": "cleanup"},
+        "refresh_email_stats_task": {"queue": "reports"},
+        "retry_failed_emails_task": {"queue": "emails"},
     },
     
     # Task execution
@@ -134,6 +136,15 @@ celery_app.conf.beat_schedule = {
         "task": "send_daily_report_task",
         "schedule": crontab(minute=0, hour=2) #crontab()
     },
+    "refresh-email-stats-task": {
+        "task": "refresh_email_stats_task",
+        "schedule": crontab(minute=5)
+    },
+    # Email Tasks
+    "retry-failed-emails-task": {
+        "task": "retry_failed_emails_task",
+        "schedule": crontab(minute='*/5')
+    },
     # Payments Tasks
     "process-expiring-subscriptions": {
         "task": "process_expiring_subscriptions",
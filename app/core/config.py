@@ -44,6 +44,14 @@ class Settings:
     STRIPE_WEBHOOK_SECRET: str = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 
     openai_api_key: Optional[str] = os.getenv("OPENAI_API_KEY")
+    prompts_cache_ttl: int = int(os.getenv("PROMPTS_CACHE_TTL", 300))
+    openai_rpm_limit: int = int(os.getenv("OPENAI_RPM_LIMIT", 450))
+    openai_tpm_limit: int = int(os.getenv("OPENAI_TPM_LIMIT", 80000))
+    openai_max_output_tokens: int = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", 16000))
+    openai_response_cache_size: int = int(os.getenv("OPENAI_RESPONSE_CACHE_SIZE", 1024))
+    openai_response_cache_ttl: int = int(os.getenv("OPENAI_RESPONSE_CACHE_TTL", 3600))
+    # Copia condivisa su Redis delle risposte: contiene i testi elaborati degli utenti (scadenza TTL)
+    openai_response_cache_shared: bool = os.getenv("OPENAI_RESPONSE_CACHE_SHARED", "false").lower() == "true"
 
     # Rate limiting
     rate_limit_requests: int = os.getenv("RATE_LIMIT_REQUESTS")
@@ -67,8 +75,14 @@ class Settings:
     
     # Email Behavior Settings
     EMAIL_TIMEOUT: int = int(os.getenv("EMAIL_TIMEOUT", 30))
+    # Attesa massima dei chiamanti sincroni per un invio sul loop email (i bulk la moltiplicano)
+    EMAIL_LOOP_WAIT_TIMEOUT: int = int(os.getenv("EMAIL_LOOP_WAIT_TIMEOUT", 120))
     EMAIL_RETRY_ATTEMPTS: int = int(os.getenv("EMAIL_RETRY_ATTEMPTS", 3))
     EMAIL_RETRY_DELAY: int = int(os.getenv("EMAIL_RETRY_DELAY", 60))
+    EMAIL_SMTP_POOL_SIZE: int = int(os.getenv("EMAIL_SMTP_POOL_SIZE", 4))
+    EMAIL_RETRY_CONCURRENCY: int = int(os.getenv("EMAIL_RETRY_CONCURRENCY", 4))
+    EMAIL_TEMPLATE_CACHE_TTL: int = int(os.getenv("EMAIL_TEMPLATE_CACHE_TTL", 300))
+    JINJA_BYTECODE_CACHE_DIR: str = os.getenv("JINJA_BYTECODE_CACHE_DIR", "/tmp/jinja_bcc")
     
     # Development/Testing Settings
     EMAIL_BACKEND: str = os.getenv("EMAIL_BACKEND", "smtp")  # smtp, console, file
@@ -1,6 +1,9 @@
+import atexit
 import logging
 import json
+import queue
 import uuid
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from fastapi import Request, Response
@@ -10,6 +13,24 @@ from app.core.supabase_client import supabase_client
 
 logger = logging.getLogger("clearify-api")
 
+
+def setup_queue_logging() -> Optional[QueueListener]:
+    """
+    Sposta la scrittura dei log su un thread dedicato: il root logger accoda i
+    record (QueueHandler) e un QueueListener li passa agli handler configurati,
+    così le scritture su stdout/file non bloccano le richieste
+    """
+    root = logging.getLogger()
+    if not root.handlers or any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return None
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 class SupabaseAPILogger:
     def __init__(self, supabase_client: Client):
         self.supabase = supabase_client
@@ -1,7 +1,7 @@
 from typing import Optional
 from app.core.config import settings
 from app.core.analytics import AnalyticsDB
-from app.services.email_service import EmailService
+from app.services.email_service import get_email_service
 from datetime import datetime, date, timedelta
 from app.schemas.analytics import DailyMetrics
 import logging
@@ -11,7 +11,7 @@ logger = logging.getLogger(__name__)
 class ReportGenerator:
     def __init__(self):
         self.db = AnalyticsDB()
-        self.email_service = EmailService()
+        self.email_service = get_email_service()
     
     async def generate_daily_report(self, target_date: Optional[date] = None, 
                                   send_email: bool = True) -> DailyMetrics:
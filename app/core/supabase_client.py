@@ -1,9 +1,27 @@
+import httpx
 from supabase import create_client, Client
 from app.core.config import settings
 
+def _use_pooled_transport(client: Client) -> Client:
+    """
+    Sostituisce la sessione HTTP di PostgREST con un httpx.Client condiviso
+    (HTTP/2 + keepalive), così le query riusano le connessioni già aperte
+    """
+    session = client.postgrest.session
+    client.postgrest.session = httpx.Client(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=session.timeout,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120),
+        follow_redirects=True
+    )
+    session.close()
+    return client
+
 def get_supabase_client() -> Client:
     """Get Supabase client instance"""
-    return create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
+    return _use_pooled_transport(create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY))
 
 # Global client instance
-supabase_client = get_supabase_client()
\ No newline at end of file
+supabase_client = get_supabase_client()
@@ -6,6 +6,9 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from fastapi.staticfiles import StaticFiles
 from app.core.config import settings
+from app.core.logging import setup_queue_logging
+from app.services.email_service import get_email_service
+from app.services.openai_service import openai_service
 import os
 import logging
 import redis
@@ -21,6 +24,8 @@ from app.api.v1.endpoints import analytics
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
+# Scrittura dei log in un thread dedicato (non blocca l'event loop)
+setup_queue_logging()
 
 # ================================
 # UTILITY FUNCTIONS PER PROXY (DEFINITE PRIMA)
@@ -484,11 +489,27 @@ async def startup_event():
     logger.info(f"🔗 Proxy headers detection: X-Forwarded-Proto, X-Real-IP, X-Forwarded-Host")
     if is_development:
         logger.info(f"🔧 Development allowed origins: {allowed_origins}")
+    
+    # Pool SMTP asincrono: connessioni aperte prima del primo invio
+    try:
+        await get_email_service().start_smtp_pool()
+    except Exception as e:
+        logger.warning(f"⚠️  SMTP pool not started: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info(f"🛑 {settings.app_name} shutting down...")
     
+    try:
+        await get_email_service().close_smtp_pool()
+    except Exception as e:
+        logger.error(f"Error closing SMTP pool: {e}")
+    
+    try:
+        await openai_service.aclose()
+    except Exception as e:
+        logger.error(f"Error closing OpenAI client: {e}")
+    
     if redis_available:
         try:
             redis_client.close()
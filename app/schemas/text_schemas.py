@@ -56,4 +56,45 @@ class TaskListResponse(BaseModel):
     tasks: List[TaskStatusResponse]
     total: int
     page: int
-    page_size: int
\ No newline at end of file
+    page_size: int
+
+class BatchTextItem(BaseModel):
+    text: str = Field(..., min_length=1, max_length=50000, description="Text to process")
+    processing_type: TextProcessingType = Field(default=TextProcessingType.PROFESSIONAL)
+    options: Optional[Dict[str, Any]] = Field(default={}, description="Additional processing options")
+    custom_id: Optional[str] = Field(default=None, max_length=64, description="Client id of the item (defaults to its index)")
+
+    @validator('processing_type')
+    def processing_type_must_use_openai(cls, v):
+        if v == TextProcessingType.HUMANIZER:
+            raise ValueError('Humanizer is not available for batch processing')
+        return v
+
+class BatchTextProcessingRequest(BaseModel):
+    items: List[BatchTextItem] = Field(..., min_items=1, max_items=500)
+
+    @validator('items')
+    def custom_ids_must_be_unique(cls, v):
+        # Senza custom_id l'elemento è identificato dalla sua posizione nella richiesta
+        for index, item in enumerate(v):
+            if item.custom_id is None:
+                item.custom_id = str(index)
+        # La Batch API rifiuta l'intero file se due richieste hanno lo stesso custom_id
+        custom_ids = [item.custom_id for item in v]
+        if len(custom_ids) != len(set(custom_ids)):
+            raise ValueError('custom_id values must be unique')
+        return v
+
+class BatchTextProcessingResponse(BaseModel):
+    batch_id: str
+    status: str
+    total: int
+    custom_ids: List[str]
+
+class BatchStatusResponse(BaseModel):
+    batch_id: str
+    status: str
+    completed: int = 0
+    failed: int = 0
+    total: int = 0
+    results: Optional[Dict[str, Optional[str]]] = None
@@ -5,17 +5,24 @@ import email.mime.text
 import email.mime.multipart
 import email.mime.base
 import email.encoders
+import email.policy
 from typing import Dict, Optional, List
+from functools import lru_cache
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 from datetime import datetime, date, timedelta
 import asyncio
+import atexit
+import queue
+import threading
+import time
 import aiosmtplib
 import os
 from pathlib import Path
 from app.core.supabase_client import supabase_client
 from app.core.analytics import AnalyticsDB
 from app.schemas.analytics import DailyMetrics
-from app.core.config import Settings
 
 # 🔥 FIX: Import specifici per evitare conflitti
 from email.mime.text import MIMEText
@@ -23,27 +30,1049 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.encoders import encode_base64
 import re
+import string
+import base64
+import hashlib
 
 # Jinja2 import con error handling
 try:
-    from jinja2 import Environment, FileSystemLoader, select_autoescape, Template
+    from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, FunctionLoader, select_autoescape, Template
     JINJA_AVAILABLE = True
 except ImportError:
     JINJA_AVAILABLE = False
-    print("⚠️ Jinja2 not available - using fallback templates")
+    logging.getLogger(__name__).warning("⚠️ Jinja2 not available - using fallback templates")
 
-from app.core.config import Settings
+from app.core.config import Settings, settings
 
 logger = logging.getLogger(__name__)
 
+# Sorgenti dei template registrati per hash del contenuto: passando dal loader
+# (invece di from_string) Jinja2 può usare la bytecode cache su disco.
+# Un sorgente resta registrato solo durante la sua compilazione (vedi _compile_template_source)
+_TEMPLATE_SOURCES: Dict[str, str] = {}
+_TEMPLATE_SOURCES_LOCK = threading.Lock()
+
+
+def _load_registered_source(name: str):
+    source = _TEMPLATE_SOURCES.get(name)
+    if source is None:
+        return None
+    # Il nome è l'hash del contenuto: un sorgente registrato non cambia mai
+    return source, None, lambda: True
+
+
+def _jinja_bytecode_cache():
+    """Bytecode cache condivisa tra worker e riavvii (None se la directory non è scrivibile)"""
+    cache_dir = getattr(settings, 'JINJA_BYTECODE_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        return FileSystemBytecodeCache(cache_dir)
+    except OSError as e:
+        logger.warning("Jinja2 bytecode cache disabled: %s", e)
+        return None
+
+
+# Environment Jinja2 condiviso: i template arrivano come stringhe (database o
+# fallback), l'autoescape resta disattivato come con i Template standalone.
+# In produzione i template non cambiano a runtime: niente auto_reload.
+_JINJA_ENV = Environment(
+    loader=FunctionLoader(_load_registered_source),
+    autoescape=False,
+    auto_reload=False,
+    cache_size=400,
+    bytecode_cache=_jinja_bytecode_cache()
+) if JINJA_AVAILABLE else None
+
+
+@lru_cache(maxsize=256)
+def _compile_template_source(source: str) -> "Template":
+    """Compila un sorgente Jinja2 una sola volta per contenuto"""
+    name = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    # Il loader serve solo a get_template: il template compilato è tenuto da lru_cache,
+    # quindi il sorgente viene rimosso subito e il dizionario non cresce
+    with _TEMPLATE_SOURCES_LOCK:
+        _TEMPLATE_SOURCES[name] = source
+        try:
+            return _JINJA_ENV.get_template(name)
+        finally:
+            del _TEMPLATE_SOURCES[name]
+
+
+# 📄 Template di fallback hardcoded, compilati una sola volta all'import
+_FALLBACK_TEMPLATE_SOURCES = {
+    "payment_confirmation": (
+        "✅ Pagamento confermato - Abbonamento {{plan_type}}",
+        """
+            <!DOCTYPE html>
+            <html>
+            <head><meta charset="UTF-8"><title>Pagamento Confermato</title></head>
+            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f3f4f6;">
+                <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 8px; padding: 30px;">
+                    <h1 style="color: #059669; margin: 0 0 20px 0;">Pagamento Confermato!</h1>
+                    <p>Ciao <strong>{{customer_name}}</strong>,</p>
+                    <p>Il tuo pagamento per l'abbonamento <strong>{{plan_type}}</strong> è stato elaborato con successo.</p>
+                    
+                    <div style="background: #f0fdf4; padding: 20px; border-radius: 6px; margin: 20px 0;">
+                        <p><strong>Piano:</strong> {{plan_type}}</p>
+                        <p><strong>Importo:</strong> €{{amount}}</p>
+                        <p><strong>Data:</strong> {{payment_date}}</p>
+                        <p><strong>ID Transazione:</strong> {{payment_intent_id}}</p>
+                    </div>
+                    
+                    <p style="font-size: 14px; color: #6b7280;">
+                        Grazie per aver scelto Clearify!<br>
+                        Supporto: <a href="mailto:support@clearify.com">support@clearify.com</a>
+                    </p>
+                </div>
+            </body>
+            </html>
+            """,
+        """
+            Pagamento Confermato!
+
+            Ciao {{customer_name}},
+
+            Il tuo pagamento per l'abbonamento {{plan_type}} è stato elaborato con successo.
+
+            Dettagli:
+            - Piano: {{plan_type}}
+            - Importo: €{{amount}}
+            - Data: {{payment_date}}
+            - ID Transazione: {{payment_intent_id}}
+
+            Grazie per aver scelto Clearify!
+            Supporto: support@clearify.com
+            """
+    ),
+    "subscription_expiring": (
+        "⚠️ Il tuo abbonamento Clearify scade presto",
+        """
+            <!DOCTYPE html>
+            <html>
+            <head><meta charset="UTF-8"><title>Abbonamento in Scadenza</title></head>
+            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f3f4f6;">
+                <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 8px; padding: 30px;">
+                    <h1 style="color: #d97706; margin: 0 0 20px 0;">Il tuo abbonamento sta scadendo</h1>
+                    <p>Il tuo abbonamento <strong>{{plan_type}}</strong> scadrà il <strong>{{end_date}}</strong>.</p>
+                    <p>Rinnova ora per continuare a usare tutte le funzionalità premium.</p>
+                    
+                    <div style="text-align: center; margin: 30px 0;">
+                        <a href="https://clearify.com/checkout" 
+                           style="display: inline-block; background: #059669; color: white; padding: 12px 24px; text-decoration: none; border-radius: 6px; font-weight: 500;">
+                            Rinnova Abbonamento
+                        </a>
+                    </div>
+                </div>
+            </body>
+            </html>
+            """,
+        """
+            Il tuo abbonamento sta scadendo
+
+            Il tuo abbonamento {{plan_type}} scadrà il {{end_date}}.
+            Rinnova ora per continuare a usare tutte le funzionalità premium.
+
+            Rinnova su: https://clearify.com/checkout
+            """
+    ),
+}
+
+_PLACEHOLDER_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class _EmptyDefaultDict(dict):
+    """Variabili mancanti renderizzate come stringa vuota, come Jinja2"""
+    def __missing__(self, key):
+        return ''
+
+
+def _to_format_string(source: str) -> Optional[str]:
+    """
+    Converte un template con sole sostituzioni {{variabile}} in una format string.
+    Ritorna None se il template usa costrutti Jinja (blocchi, filtri, espressioni).
+    """
+    parts = _PLACEHOLDER_RE.split(source)
+    literals = parts[0::2]
+    if any('{{' in literal or '{%' in literal or '{#' in literal for literal in literals):
+        return None
+    return ''.join(
+        part.replace('{', '{{').replace('}', '}}') if i % 2 == 0 else '{' + part + '}'
+        for i, part in enumerate(parts)
+    )
+
+
+# I fallback usano solo sostituzioni {{variabile}}: vengono resi con str.format_map,
+# senza Jinja2 (devono funzionare anche quando Jinja2 o il database non sono disponibili)
+_FALLBACK_FORMAT_STRINGS = {}
+for _name, _sources in _FALLBACK_TEMPLATE_SOURCES.items():
+    _format_strings = tuple(_to_format_string(source) for source in _sources)
+    if not all(_format_strings):
+        raise ValueError(f"Fallback template '{_name}' must only use {{{{variable}}}} placeholders")
+    _FALLBACK_FORMAT_STRINGS[_name] = _format_strings
+
+# Template generico per i nomi senza fallback dedicato
+_GENERIC_SUBJECT = "Notifica da Clearify"
+_GENERIC_HTML = string.Template("<p>Template non trovato per: $template_name</p>")
+_GENERIC_TEXT = string.Template("Template non trovato per: $template_name")
+
+
+@lru_cache(maxsize=64)
+def _generic_fallback(template_name: str) -> tuple:
+    """Template generico già renderizzato, riusato per ogni miss sullo stesso nome"""
+    return (
+        _GENERIC_SUBJECT,
+        _GENERIC_HTML.substitute(template_name=template_name),
+        _GENERIC_TEXT.substitute(template_name=template_name)
+    )
+
+
+# Generazione della cache dei template: viene incrementata ad ogni modifica
+# dei template nel database per invalidare le versioni compilate
+_template_cache_version = 0
+_template_name_versions: Dict[str, int] = {}
+
+
+def _template_cache_key(template_name: str) -> str:
+    """
+    Chiave di cache del template: generazione globale, generazione del nome e
+    finestra TTL. Le modifiche fatte da altri processi (API / worker Celery)
+    diventano visibili al più dopo EMAIL_TEMPLATE_CACHE_TTL secondi.
+    """
+    ttl = getattr(settings, 'EMAIL_TEMPLATE_CACHE_TTL', 300) or 1
+    return f"{_template_cache_version}.{_template_name_versions.get(template_name, 0)}.{int(time.monotonic() // ttl)}"
+
+
+def _fetch_email_template(template_name: str) -> Optional[Dict]:
+    """Recupera l'ultima versione attiva di un template dal database Supabase"""
+    try:
+        result = supabase_client.table('email_templates')\
+            .select('*')\
+            .eq('name', template_name)\
+            .eq('is_active', True)\
+            .order('version', desc=True)\
+            .limit(1)\
+            .execute()
+        
+        if result.data and len(result.data) > 0:
+            template_data = result.data[0]
+            logger.info("✅ Found database template: %s v%s", template_name, template_data.get('version', '1.0'))
+            return template_data
+        
+        logger.warning("⚠️ Template '%s' not found in database", template_name)
+        return None
+        
+    except Exception as e:
+        logger.error("❌ Failed to fetch template '%s' from database: %s", template_name, e)
+        return None
+
+
+@lru_cache(maxsize=64)
+def _get_compiled_template(name: str, version: str) -> tuple:
+    """
+    Recupera e compila i template (subject, html, text) una sola volta per generazione.
+    Returns: (template_version, subject_template, html_template, text_template)
+    Le eccezioni non vengono messe in cache: il prossimo invio ritenta il database.
+    """
+    template_data = _fetch_email_template(name)
+    
+    if not template_data:
+        raise LookupError(f"Template '{name}' not found in database")
+    
+    if not template_data.get('subject_template'):
+        raise ValueError(f"Missing subject_template for template: {name}")
+    
+    if not template_data.get('html_template'):
+        raise ValueError(f"Missing html_template for template: {name}")
+    
+    subject_template = _get_compiled_field(template_data, 'subject_template')
+    html_template = _get_compiled_field(template_data, 'html_template')
+    text_template = _get_compiled_field(template_data, 'text_template') if template_data.get('text_template') else None
+    
+    return template_data.get('version', '1.0'), subject_template, html_template, text_template
+
+
+# Template compilati per riga del database: (id, version, updated_at, campo).
+# Una riga invariata non viene né ricompilata né ri-hashata dopo un refresh.
+_COMPILED_FIELDS: Dict[tuple, "Template"] = {}
+_MAX_COMPILED_FIELDS = 512
+
+
+def _get_compiled_field(template_data: Dict, field: str) -> "Template":
+    key = (template_data.get('id'), template_data.get('version'), template_data.get('updated_at'), field)
+    compiled = _COMPILED_FIELDS.get(key)
+    if compiled is None:
+        compiled = _compile_template_source(template_data[field])
+        if len(_COMPILED_FIELDS) >= _MAX_COMPILED_FIELDS:
+            _COMPILED_FIELDS.clear()
+        _COMPILED_FIELDS[key] = compiled
+    return compiled
+
+
+def invalidate_template_cache(template_name: Optional[str] = None) -> None:
+    """Invalida i template compilati dopo una modifica nel database (uno o tutti)"""
+    global _template_cache_version
+    if template_name:
+        _template_name_versions[template_name] = _template_name_versions.get(template_name, 0) + 1
+        return
+    _template_cache_version += 1
+    _get_compiled_template.cache_clear()
+
+
+class PipelinedSMTP(smtplib.SMTP):
+    """
+    smtplib.SMTP con PIPELINING (RFC 2920): MAIL FROM, RCPT TO e DATA partono
+    in un'unica scrittura e le risposte vengono lette in blocco, un solo RTT
+    invece di uno per comando. Senza l'estensione usa il sendmail standard.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('pipelining') or mail_options or rcpt_options:
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = re.sub(r'(?:\r\n|\n|\r(?!\n))', smtplib.CRLF, msg).encode('ascii')
+        
+        mail_command = "mail FROM:%s" % smtplib.quoteaddr(from_addr)
+        if self.has_extn('size'):
+            mail_command += " size=%d" % len(msg)
+        commands = [mail_command] + ["rcpt TO:%s" % smtplib.quoteaddr(addr) for addr in to_addrs] + ["data"]
+        self.send("".join(command + smtplib.CRLF for command in commands))
+        
+        # Le risposte arrivano nello stesso ordine dei comandi
+        mail_code, mail_resp = self.getreply()
+        senderrs = {}
+        disconnected = mail_code == 421
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+            disconnected = disconnected or code == 421
+        data_code, data_resp = self.getreply()
+        disconnected = disconnected or data_code == 421
+        
+        def _abort(error: Exception):
+            if disconnected:
+                self.close()
+            else:
+                if data_code == 354:
+                    # DATA accettato senza mittente/destinatari validi: chiude il messaggio vuoto
+                    self.send(b"." + smtplib.bCRLF)
+                    self.getreply()
+                self._rset()
+            raise error
+        
+        if mail_code != 250:
+            _abort(smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr))
+        if len(senderrs) == len(to_addrs):
+            _abort(smtplib.SMTPRecipientsRefused(senderrs))
+        if data_code != 354:
+            _abort(smtplib.SMTPDataError(data_code, data_resp))
+        
+        payload = re.sub(br'(?m)^\.', b'..', msg)
+        if payload[-2:] != smtplib.bCRLF:
+            payload += smtplib.bCRLF
+        self.send(payload + b"." + smtplib.bCRLF)
+        
+        code, resp = self.getreply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+
+class AsyncSMTPPool:
+    """
+    Pool di connessioni aiosmtplib persistenti, condiviso tra gli invii asincroni.
+    Le connessioni vengono aperte al primo utilizzo e mantenute vive con un NOOP
+    quando restano inattive troppo a lungo.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: str,
+        password: str,
+        start_tls: bool = True,
+        size: int = 4,
+        timeout: int = 30,
+        heartbeat_interval: int = 30
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.start_tls = start_tls
+        self.size = size
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self._available: Optional[asyncio.Queue] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            timeout=self.timeout,
+            start_tls=self.start_tls,
+            tls_context=_TLS_CONTEXT
+        )
+        await smtp.connect()
+        await smtp.login(self.username, self.password)
+        return smtp
+
+    async def _ensure_started(self):
+        async with self._lock:
+            if self._available is None:
+                self._available = asyncio.Queue()
+                # Slot vuoti: la connessione viene aperta solo quando serve
+                for _ in range(self.size):
+                    self._available.put_nowait((None, 0.0))
+
+    async def acquire(self) -> aiosmtplib.SMTP:
+        await self._ensure_started()
+        smtp, last_used = await self._available.get()
+        try:
+            if smtp is not None and smtp.is_connected:
+                if time.monotonic() - last_used < self.heartbeat_interval:
+                    return smtp
+                try:
+                    # Heartbeat: verifica che il server non abbia chiuso la connessione
+                    await smtp.noop()
+                    return smtp
+                except aiosmtplib.SMTPException:
+                    smtp.close()
+            return await self._connect()
+        except Exception:
+            self._available.put_nowait((None, 0.0))
+            raise
+
+    def release(self, smtp: Optional[aiosmtplib.SMTP], discard: bool = False):
+        if self._available is None:
+            # Pool chiuso mentre la connessione era in uso
+            if smtp is not None:
+                smtp.close()
+            return
+        if discard and smtp is not None:
+            smtp.close()
+            smtp = None
+        self._available.put_nowait((smtp, time.monotonic()))
+
+    async def warm_up(self):
+        """Apre in anticipo le connessioni libere del pool (avvio dell'applicazione)"""
+        await self._ensure_started()
+        slots = [self._available.get_nowait() for _ in range(self._available.qsize())]
+
+        async def _open(slot: tuple) -> tuple:
+            if slot[0] is not None:
+                return slot
+            try:
+                return await self._connect(), time.monotonic()
+            except Exception as e:
+                logger.warning("⚠️ SMTP pool warm-up failed: %s", e)
+                return slot
+
+        for slot in await asyncio.gather(*[_open(slot) for slot in slots]):
+            self._available.put_nowait(slot)
+
+    async def close(self):
+        """Chiude le connessioni libere; quelle in uso vengono chiuse al rilascio"""
+        available, self._available = self._available, None
+        if available is None:
+            return
+        while not available.empty():
+            smtp, _ = available.get_nowait()
+            if smtp is None:
+                continue
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+
+    async def sendmail(self, sender: str, recipients: List[str], raw_message: bytes) -> None:
+        """Trasmette un messaggio già serializzato: sulla connessione resta solo l'I/O"""
+        smtp = await self.acquire()
+        try:
+            await smtp.sendmail(sender, recipients, raw_message)
+        except Exception:
+            self.release(smtp, discard=True)
+            raise
+        self.release(smtp)
+
+
+class EmailQueueWriter:
+    """
+    Writer in background per la tabella email_queue (group commit).
+    Gli eventi di insert/update vengono accumulati per al massimo max_wait secondi
+    o max_batch eventi e scritti con un insert multi-riga e un update multi-riga
+    (RPC email_queue_bulk_update, solo le colonne modificate).
+    Gli insert restituiscono l'id tramite Future; gli update sono fire-and-forget.
+    """
+
+    def __init__(self, max_batch: int = 64, max_wait: float = 0.01):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._events: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="email-queue-writer", daemon=True)
+                    self._thread.start()
+
+    def insert(self, row: Dict) -> Future:
+        """Accoda l'insert senza attendere: il Future si risolve con l'id del record"""
+        self._ensure_started()
+        future = Future()
+        self._events.put(('insert', row, future))
+        return future
+
+    def insert_many(self, rows: List[Dict]) -> List[Future]:
+        return [self.insert(row) for row in rows]
+
+    def update(self, email_queue_ref, fields: Dict):
+        """
+        Accoda un update. email_queue_ref può essere l'id del record o il Future
+        restituito da insert: l'insert viene sempre scritto prima dell'update.
+        """
+        self._ensure_started()
+        self._events.put(('update', email_queue_ref, fields))
+
+    def close(self, timeout: float = 10.0):
+        """
+        Scrive gli eventi ancora in coda e attende la fine della scrittura
+        (shutdown del processo: il thread è daemon e verrebbe interrotto)
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        drained = threading.Event()
+        self._events.put(('drain', None, drained))
+        if not drained.wait(timeout):
+            logger.warning("Email queue writer not drained within %ss", timeout)
+
+    def _run(self):
+        while True:
+            events = [self._events.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(events) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    events.append(self._events.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._flush(events)
+            except Exception as e:
+                logger.warning("Email queue writer flush failed: %s", e)
+            # Gli eventi accodati prima della richiesta di drain sono stati scritti
+            for op, _, drained in events:
+                if op == 'drain':
+                    drained.set()
+
+    def _flush(self, events: List[tuple]):
+        inserts = [(row, future) for op, row, future in events if op == 'insert']
+        
+        if inserts:
+            self._flush_inserts(inserts)
+        
+        # Più update sullo stesso record vengono fusi in uno solo
+        updates: Dict[str, Dict] = {}
+        for op, email_queue_ref, fields in events:
+            if op != 'update':
+                continue
+            # Gli insert precedono sempre gli update: il Future è già risolto
+            if isinstance(email_queue_ref, Future):
+                email_queue_id = email_queue_ref.result() if email_queue_ref.done() else None
+            else:
+                email_queue_id = email_queue_ref
+            if email_queue_id:
+                updates.setdefault(email_queue_id, {}).update(fields)
+        
+        if updates:
+            self._flush_updates(updates)
+
+    def _flush_inserts(self, inserts: List[tuple]):
+        try:
+            result = supabase_client.table('email_queue').insert([row for row, _ in inserts]).execute()
+            records = result.data or []
+            
+            if len(records) != len(inserts):
+                raise RuntimeError(f"expected {len(inserts)} rows back, got {len(records)}")
+            
+            for (_, future), record in zip(inserts, records):
+                future.set_result(record['id'])
+            
+            logger.info("📝 %s emails queued in database", len(records))
+            
+        except Exception as db_error:
+            logger.warning("Failed to save email to database: %s", db_error)
+            for _, future in inserts:
+                if not future.done():
+                    future.set_result(None)
+
+    def _flush_updates(self, updates: Dict[str, Dict]):
+        """
+        Update in un solo round-trip tramite RPC, con le sole colonne modificate
+        (i corpi delle email non vengono riscritti); update puntuali come fallback
+        """
+        partial_updates = [{'id': email_queue_id, **fields} for email_queue_id, fields in updates.items()]
+        try:
+            supabase_client.rpc('email_queue_bulk_update', {'updates': partial_updates}).execute()
+            logger.info("📧 Email status updated for %s emails", len(partial_updates))
+            return
+        except Exception as rpc_error:
+            logger.warning("email_queue_bulk_update not available, updating one by one: %s", rpc_error)
+        
+        for update in partial_updates:
+            fields = {k: v for k, v in update.items() if k != 'id'}
+            try:
+                supabase_client.table('email_queue').update(fields).eq('id', update['id']).execute()
+            except Exception as db_error:
+                logger.warning("Failed to update email status: %s", db_error)
+
+
+_email_queue_writer = EmailQueueWriter()
+atexit.register(_email_queue_writer.close)
+
+
+def close_email_queue_writer():
+    """Scrive i record di email_queue ancora in coda (shutdown dei processi worker)"""
+    _email_queue_writer.close()
+
+
+# Contesto TLS condiviso: il bundle delle CA di sistema viene caricato una sola volta
+_TLS_CONTEXT = ssl.create_default_context()
+
+# Metadata vuoti condivisi tra tutti i record senza metadata (mai modificati:
+# i record della coda vengono solo serializzati)
+_EMPTY_METADATA: Dict = {}
+
+# Colonne lette dal retry: niente metadata, timestamp o altri campi non usati
+_RETRY_COLUMNS = 'id, recipient_email, subject, html_body, text_body, retry_count'
+
+# Backoff massimo tra due tentativi e margine oltre il quale un retry in sospeso
+# nel database è considerato orfano (processo che lo gestiva non più attivo)
+_MAX_RETRY_DELAY = 3600
+_RETRY_SWEEP_GRACE = 300
+
+# Durata della presa in carico dei record letti dallo sweep: nel frattempo né
+# uno sweep sovrapposto né un altro worker li rileggono. L'esito del retry
+# sovrascrive next_retry_at; se il processo muore la presa scade da sola.
+_RETRY_CLAIM_LEASE = 900
+
+# Circuit breaker dei retry: pausa quando almeno un terzo degli ultimi
+# tentativi fallisce (valutato dopo _RETRY_ABORT_MIN_ATTEMPTS esiti)
+_RETRY_ABORT_MIN_ATTEMPTS = 6
+_RETRY_WINDOW_SIZE = 30
+
+# Timestamp ISO UTC per i record della coda: il prefisso fino ai secondi viene
+# formattato una volta al secondo, per ogni invio si aggiungono i microsecondi
+_iso_second_cache = (None, "")
+
+
+def _utc_iso(timestamp: Optional[float] = None) -> str:
+    """Equivalente di datetime.now(timezone.utc).isoformat(timespec='microseconds')"""
+    global _iso_second_cache
+    if timestamp is None:
+        timestamp = time.time()
+    second = int(timestamp)
+    cached_second, prefix = _iso_second_cache
+    if cached_second != second:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        _iso_second_cache = (second, prefix)
+    return f"{prefix}.{int((timestamp - second) * 1_000_000):06d}+00:00"
+
+
+# Policy SMTP per tutte le parti del messaggio: header non ASCII codificati
+# (RFC 2047) e righe terminate da CRLF come richiesto dal protocollo
+_SMTP_POLICY = email.policy.SMTP
+
+# Multiplo di 57 byte: ogni blocco codificato termina a fine riga MIME (76 caratteri)
+_ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# Costruzione MIME fuori dal loop email: il build del messaggio N+1 si
+# sovrappone alla trasmissione SMTP del messaggio N
+_MIME_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="email-mime")
+
+
+# Event loop dedicato agli invii asincroni, usato anche dai chiamanti sincroni
+_email_loop: Optional[asyncio.AbstractEventLoop] = None
+_email_loop_lock = threading.Lock()
+
+
+def _get_email_loop() -> asyncio.AbstractEventLoop:
+    """Avvia (una sola volta) il loop in background che gestisce il pool SMTP"""
+    global _email_loop
+    with _email_loop_lock:
+        if _email_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="email-sender", daemon=True).start()
+            _email_loop = loop
+    return _email_loop
+
+
+def run_in_email_loop(coro, timeout: Optional[float] = None):
+    """
+    Esegue una coroutine sul loop email e ne attende il risultato (per chiamanti sincroni).
+    Dal loop email stesso andrebbe in deadlock: lì si usano le varianti async.
+    Scaduto il timeout solleva TimeoutError; la coroutine prosegue sul loop e registra l'esito.
+    """
+    loop = _get_email_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_in_email_loop called from the email loop: await the async variant instead")
+    
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    timeout = timeout or settings.EMAIL_LOOP_WAIT_TIMEOUT
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        logger.error("❌ Email loop did not complete within %ss", timeout)
+        raise
+
+
+def _bulk_wait_timeout(count: int) -> float:
+    """Timeout di run_in_email_loop per count email inviate in parallelo sul pool SMTP"""
+    pool_size = max(1, settings.EMAIL_SMTP_POOL_SIZE)
+    return settings.EMAIL_LOOP_WAIT_TIMEOUT * max(1, -(-count // pool_size))
+
+
+async def _await_in_email_loop(coro):
+    """Esegue una coroutine sul loop email da un qualunque altro event loop"""
+    loop = _get_email_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
 class EmailService:
     def __init__(self):
-        self.settings = Settings()
+        # Settings ed Environment Jinja sono condivisi a livello di modulo
+        self.settings = settings
+        self.jinja_env = _JINJA_ENV
         self.smtp_server = getattr(self.settings, 'EMAIL_HOST', 'smtp.gmail.com')
         self.smtp_port = getattr(self.settings, 'EMAIL_PORT', 587)
         self.sender_email = getattr(self.settings, 'EMAIL_HOST_USER', 'noreply@clearify.com')
         self.sender_password = getattr(self.settings, 'EMAIL_HOST_PASSWORD', '')
         self.use_tls = getattr(self.settings, 'EMAIL_USE_TLS', True)
+        self.smtp_pool_size = getattr(self.settings, 'EMAIL_SMTP_POOL_SIZE', 4)
+        self._smtp_pool: Optional[AsyncSMTPPool] = None
+        self.smtp_idle_timeout = 60
+        self.smtp_heartbeat_interval = 30
+        # Connessione SMTP sincrona persistente, una per thread
+        self._smtp_local = threading.local()
+        self._smtp_servers: set = set()
+        self._smtp_servers_lock = threading.Lock()
+        atexit.register(self.close_smtp_connections)
+        # Coda di retry in-process (vive sul loop email)
+        self._retry_queue: Optional[asyncio.PriorityQueue] = None
+        self._retry_wakeup: Optional[asyncio.Event] = None
+        self._retry_tasks: set = set()
+        self._retry_sequence = 0
+        # Riferimenti (id o Future dell'insert) dei record in coda o in invio
+        self._retry_pending: set = set()
+
+    def _connect_smtp(self) -> smtplib.SMTP:
+        server = PipelinedSMTP(self.smtp_server, self.smtp_port, timeout=getattr(self.settings, 'EMAIL_TIMEOUT', 30))
+        server.set_debuglevel(0)
+        
+        if self.use_tls:
+            server.starttls(context=_TLS_CONTEXT)
+            
+        server.login(self.sender_email, self.sender_password)
+        return server
+
+    def _close_smtp(self):
+        server = getattr(self._smtp_local, 'server', None)
+        self._smtp_local.server = None
+        if server is None:
+            return
+        with self._smtp_servers_lock:
+            self._smtp_servers.discard(server)
+        self._quit_smtp(server)
+
+    @staticmethod
+    def _quit_smtp(server: smtplib.SMTP):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def close_smtp_connections(self):
+        """Chiude tutte le connessioni SMTP persistenti (allo shutdown del processo)"""
+        with self._smtp_servers_lock:
+            servers = list(self._smtp_servers)
+            self._smtp_servers.clear()
+        for server in servers:
+            self._quit_smtp(server)
+
+    def _get_smtp(self) -> smtplib.SMTP:
+        """
+        Ritorna la connessione SMTP del thread corrente, riaprendola solo se
+        inattiva da più di smtp_idle_timeout secondi o chiusa dal server
+        """
+        server = getattr(self._smtp_local, 'server', None)
+        
+        if server is not None:
+            idle = time.monotonic() - self._smtp_local.last_used
+            if idle < self.smtp_heartbeat_interval:
+                # Usata di recente: nessun round-trip, una disconnessione
+                # viene comunque gestita da _sendmail con un solo retry
+                return server
+            if idle > self.smtp_idle_timeout:
+                self._close_smtp()
+            else:
+                try:
+                    # NOOP: verifica che il server non abbia chiuso la connessione
+                    if server.noop()[0] == 250:
+                        return server
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self._close_smtp()
+        
+        server = self._connect_smtp()
+        self._smtp_local.server = server
+        self._smtp_local.last_used = time.monotonic()
+        with self._smtp_servers_lock:
+            self._smtp_servers.add(server)
+        return server
+
+    def _sendmail(self, to_email: str, raw_message: bytes):
+        """Invia il messaggio già serializzato sulla connessione persistente, riconnettendo una volta se caduta"""
+        try:
+            self._get_smtp().sendmail(self.sender_email, [to_email], raw_message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self._close_smtp()
+            self._get_smtp().sendmail(self.sender_email, [to_email], raw_message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # Rifiuto del server: smtplib ha già inviato RSET, la connessione resta valida
+            raise
+        except Exception:
+            self._close_smtp()
+            raise
+        self._smtp_local.last_used = time.monotonic()
+
+    def _get_smtp_pool(self) -> AsyncSMTPPool:
+        if self._smtp_pool is None:
+            self._smtp_pool = AsyncSMTPPool(
+                hostname=self.smtp_server,
+                port=self.smtp_port,
+                username=self.sender_email,
+                password=self.sender_password,
+                start_tls=self.use_tls,
+                size=self.smtp_pool_size,
+                timeout=getattr(self.settings, 'EMAIL_TIMEOUT', 30)
+            )
+        return self._smtp_pool
+
+    async def start_smtp_pool(self):
+        """Apre le connessioni del pool SMTP asincrono all'avvio dell'applicazione"""
+        if not self.sender_email or not self.sender_password:
+            logger.warning("⚠️ Email credentials not configured - SMTP pool not started")
+            return
+        await _await_in_email_loop(self._get_smtp_pool().warm_up())
+        logger.info("✅ SMTP pool started (%s connections)", self.smtp_pool_size)
+
+    async def close_smtp_pool(self):
+        """Chiude il pool SMTP asincrono allo shutdown dell'applicazione"""
+        if self._smtp_pool is not None:
+            await _await_in_email_loop(self._smtp_pool.close())
+            logger.info("✅ SMTP pool closed")
+
+    def _build_message(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        attachments: Optional[List[Dict]] = None
+    ) -> MIMEMultipart:
+        """Costruisce il messaggio MIME (testo, HTML e allegati)"""
+        message = MIMEMultipart("alternative", policy=_SMTP_POLICY)
+        message["Subject"] = subject
+        message["From"] = self.sender_email
+        message["To"] = to_email
+        message["Date"] = email.utils.formatdate(localtime=True)
+        
+        # Aggiungi corpo del messaggio
+        if text_body:
+            text_part = MIMEText(text_body, "plain", "utf-8", policy=_SMTP_POLICY)
+            message.attach(text_part)
+        
+        html_part = MIMEText(html_body, "html", "utf-8", policy=_SMTP_POLICY)
+        message.attach(html_part)
+
+        # Aggiungi allegati se presenti
+        if attachments:
+            for attachment in attachments:
+                self._add_attachment(message, attachment)
+
+        return message
+
+    def _build_raw_message(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        attachments: Optional[List[Dict]] = None
+    ) -> bytes:
+        """Costruisce e serializza il messaggio (solo CPU, nessuna connessione coinvolta)"""
+        # Il messaggio è costruito con la policy SMTP: as_bytes la eredita
+        return self._build_message(to_email, subject, html_body, text_body, attachments).as_bytes()
+
+    async def _build_raw_message_async(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        attachments: Optional[List[Dict]] = None
+    ) -> bytes:
+        """Serializza il messaggio nel thread pool MIME senza bloccare il loop email"""
+        return await asyncio.get_running_loop().run_in_executor(
+            _MIME_EXECUTOR, self._build_raw_message,
+            to_email, subject, html_body, text_body, attachments
+        )
+
+    def _email_queue_row(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        email_type: str = "system_notification",
+        payment_intent_id: str = None,
+        subscription_id: str = None,
+        metadata: Dict = None,
+        created_at: Optional[str] = None
+    ) -> Dict:
+        """Costruisce il record della coda email per il database"""
+        return {
+            'recipient_email': to_email,
+            'subject': subject,
+            'html_body': html_body,
+            'text_body': text_body,
+            'email_type': email_type,
+            'payment_intent_id': payment_intent_id,
+            'subscription_id': subscription_id,
+            'metadata': metadata or _EMPTY_METADATA,
+            'created_at': created_at or _utc_iso()
+        }
+
+    def _record_email(self, email_queue_data: Dict) -> Optional[Future]:
+        """
+        Accoda il salvataggio dell'email nel database senza bloccare l'invio.
+        Ritorna un Future che si risolve con l'id del record.
+        """
+        try:
+            return _email_queue_writer.insert(email_queue_data)
+        except Exception as db_error:
+            logger.warning("Failed to save email to database: %s", db_error)
+        
+        return None
+
+    def _record_emails(self, rows: List[Dict]) -> List[Optional[Future]]:
+        """Accoda il salvataggio di un batch di email (insert multi-riga tramite il writer)"""
+        try:
+            return _email_queue_writer.insert_many(rows)
+        except Exception as db_error:
+            logger.warning("Failed to save email batch to database: %s", db_error)
+        
+        return [None] * len(rows)
+
+    def _sent_row(self, email_queue_data: Dict, processing_time_ms: int) -> Dict:
+        """Record finale di un invio riuscito (un solo insert, nessun update)"""
+        # Stesse colonne di _failed_row: PostgREST richiede chiavi uniformi negli insert multi-riga
+        return {
+            **email_queue_data,
+            'status': 'sent',
+            'sent_at': _utc_iso(),
+            'processing_time_ms': processing_time_ms,
+            'failed_at': None,
+            'error_message': None,
+            'retry_count': 0,
+            'next_retry_at': None
+        }
+
+    def _failed_row(self, email_queue_data: Dict, error_message: str) -> Dict:
+        """Record finale di un invio fallito, già pronto per la coda di retry"""
+        now = time.time()
+        return {
+            **email_queue_data,
+            'status': 'failed',
+            'sent_at': None,
+            'processing_time_ms': None,
+            'failed_at': _utc_iso(now),
+            'error_message': error_message,
+            'retry_count': 0,
+            'next_retry_at': _utc_iso(now + self._retry_delay(0))
+        }
+
+    def _mark_email_sent(self, email_queue_ref, processing_time_ms: int):
+        if not email_queue_ref:
+            return
+        _email_queue_writer.update(email_queue_ref, {
+            'status': 'sent',
+            'sent_at': _utc_iso(),
+            'processing_time_ms': processing_time_ms
+        })
+
+    def _retry_delay(self, retry_count: int) -> int:
+        """Backoff esponenziale: EMAIL_RETRY_DELAY * 2^retry_count, al massimo un'ora"""
+        return min(self.settings.EMAIL_RETRY_DELAY * (2 ** retry_count), _MAX_RETRY_DELAY)
+
+    def _schedule_first_retry(
+        self,
+        email_queue_ref: Optional[Future],
+        email_queue_data: Dict,
+        raw_message: Optional[bytes] = None
+    ):
+        """
+        Primo tentativo di recupero nella coda di retry del processo.
+        Il messaggio già serializzato (allegati inclusi) viene riusato dai retry.
+        """
+        if not email_queue_ref:
+            return
+        self._schedule_retry({
+            'id': email_queue_ref,
+            'recipient_email': email_queue_data['recipient_email'],
+            'subject': email_queue_data['subject'],
+            'html_body': email_queue_data['html_body'],
+            'text_body': email_queue_data['text_body'],
+            'retry_count': 0,
+            'raw_message': raw_message
+        }, self._retry_delay(0))
+
+    def _mark_email_retry_failed(self, email_record: Dict, error_message: str) -> int:
+        """Registra il tentativo fallito e ritorna il nuovo retry_count"""
+        retry_count = (email_record.get('retry_count') or 0) + 1
+        now = time.time()
+        _email_queue_writer.update(email_record['id'], {
+            'status': 'failed',
+            'failed_at': _utc_iso(now),
+            'error_message': error_message,
+            'retry_count': retry_count,
+            'next_retry_at': _utc_iso(now + self._retry_delay(retry_count))
+        })
+        return retry_count
 
     def send_email_sync(
         self,
@@ -58,174 +1087,377 @@ class EmailService:
         metadata: Dict = None
     ) -> bool:
         """
-        Invia email sincrona e salva nel database
+        Invia email sincrona e salva nel database
+        """
+        email_queue_data = None
+        raw_message = None
+        
+        try:
+            logger.info("📧 Sending email to %s: %s", to_email, subject)
+            
+            # Validazione input
+            if not all([to_email, subject, html_body]):
+                raise ValueError("Missing required email parameters")
+            
+            if not self.sender_email or not self.sender_password:
+                raise ValueError("Email credentials not configured")
+
+            # Il record viene scritto una sola volta, con l'esito dell'invio
+            email_queue_data = self._email_queue_row(
+                to_email, subject, html_body, text_body,
+                email_type, payment_intent_id, subscription_id, metadata
+            )
+
+            # PREPARA EMAIL (prima di occupare la connessione SMTP)
+            raw_message = self._build_raw_message(to_email, subject, html_body, text_body, attachments)
+
+            # 🔥 INVIA EMAIL
+            start_ns = time.perf_counter_ns()
+            self._sendmail(to_email, raw_message)
+
+            processing_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+            
+            # 🔥 SALVA EMAIL COME INVIATA (in background, non blocca il chiamante)
+            self._record_email(self._sent_row(email_queue_data, processing_time_ms))
+
+            logger.info("✅ Email sent successfully to %s in %sms", to_email, processing_time_ms)
+            return True
+
+        except Exception as e:
+            logger.error("❌ Failed to send email to %s: %s", to_email, e)
+            if email_queue_data:
+                email_queue_ref = self._record_email(self._failed_row(email_queue_data, str(e)))
+                self._schedule_first_retry(email_queue_ref, email_queue_data, raw_message)
+            return False
+    
+    async def send_email_async(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        attachments: Optional[List[Dict]] = None,
+        email_type: str = "system_notification",
+        payment_intent_id: str = None,
+        subscription_id: str = None,
+        metadata: Dict = None
+    ) -> bool:
+        """
+        Invia email asincrona tramite il pool SMTP persistente e salva nel database
+        """
+        return await _await_in_email_loop(self._send_email_pooled(
+            to_email, subject, html_body, text_body, attachments,
+            email_type, payment_intent_id, subscription_id, metadata
+        ))
+
+    async def send_emails_async(self, emails: List[Dict]) -> List[bool]:
+        """
+        Invia un batch di email in parallelo sul pool SMTP.
+        Ogni elemento contiene gli stessi argomenti di send_email_async.
+        """
+        return await _await_in_email_loop(self._send_batch_pooled(emails))
+
+    async def _send_batch_pooled(self, emails: List[Dict]) -> List[bool]:
+        if not emails:
+            return []
+
+        if not self.sender_email or not self.sender_password:
+            logger.error("❌ Failed to send email batch: Email credentials not configured")
+            return [False] * len(emails)
+
+        created_at = _utc_iso()
+
+        async def _send_one(email_kwargs: Dict) -> tuple:
+            to_email = email_kwargs['to_email']
+            email_queue_data = self._email_queue_row(
+                created_at=created_at,
+                **{k: v for k, v in email_kwargs.items() if k != 'attachments'}
+            )
+            raw_message = None
+            try:
+                if not all([to_email, email_kwargs.get('subject'), email_kwargs.get('html_body')]):
+                    raise ValueError("Missing required email parameters")
+
+                raw_message = await self._build_raw_message_async(
+                    to_email,
+                    email_kwargs['subject'],
+                    email_kwargs['html_body'],
+                    email_kwargs.get('text_body'),
+                    email_kwargs.get('attachments')
+                )
+
+                start_ns = time.perf_counter_ns()
+                await self._get_smtp_pool().sendmail(self.sender_email, [to_email], raw_message)
+                processing_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+
+                return True, self._sent_row(email_queue_data, processing_time_ms), None
+
+            except Exception as e:
+                logger.error("❌ Failed to send async email to %s: %s", to_email, e)
+                return False, self._failed_row(email_queue_data, str(e)), raw_message
+
+        outcomes = await asyncio.gather(*[_send_one(email_kwargs) for email_kwargs in emails])
+        results = [sent for sent, _, _ in outcomes]
+
+        # Un solo insert multi-riga con l'esito finale di tutto il batch
+        email_queue_refs = self._record_emails([row for _, row, _ in outcomes])
+        for (sent, row, raw_message), email_queue_ref in zip(outcomes, email_queue_refs):
+            if not sent and row['recipient_email'] and row['subject'] and row['html_body']:
+                self._schedule_first_retry(email_queue_ref, row, raw_message)
+
+        logger.info("✅ Email batch completed: %s/%s sent", sum(results), len(results))
+        return results
+
+    async def _send_email_pooled(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        text_body: Optional[str] = None,
+        attachments: Optional[List[Dict]] = None,
+        email_type: str = "system_notification",
+        payment_intent_id: str = None,
+        subscription_id: str = None,
+        metadata: Dict = None
+    ) -> bool:
+        email_queue_data = None
+        raw_message = None
+        
+        try:
+            logger.info("📧 Sending async email to %s: %s", to_email, subject)
+            
+            if not all([to_email, subject, html_body]):
+                raise ValueError("Missing required email parameters")
+            
+            if not self.sender_email or not self.sender_password:
+                raise ValueError("Email credentials not configured")
+
+            # Il record viene scritto dal writer in background, solo a invio concluso
+            email_queue_data = self._email_queue_row(
+                to_email, subject, html_body, text_body,
+                email_type, payment_intent_id, subscription_id, metadata
+            )
+
+            raw_message = await self._build_raw_message_async(to_email, subject, html_body, text_body, attachments)
+
+            start_ns = time.perf_counter_ns()
+            await self._get_smtp_pool().sendmail(self.sender_email, [to_email], raw_message)
+            processing_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
+
+            self._record_email(self._sent_row(email_queue_data, processing_time_ms))
+
+            logger.info("✅ Async email sent successfully to %s in %sms", to_email, processing_time_ms)
+            return True
+
+        except Exception as e:
+            logger.error("❌ Failed to send async email to %s: %s", to_email, e)
+            if email_queue_data:
+                email_queue_ref = self._record_email(self._failed_row(email_queue_data, str(e)))
+                self._schedule_first_retry(email_queue_ref, email_queue_data, raw_message)
+            return False
+
+    # Retry Section
+    def get_failed_emails_for_retry(self, limit: int = 50, offset: int = 0, overdue_seconds: int = 0) -> List[Dict]:
+        """
+        Recupera una pagina di email fallite pronte per un nuovo tentativo,
+        con le sole colonne necessarie al reinvio (indice email_queue_retry_idx).
+        """
+        try:
+            result = supabase_client.table('email_queue')\
+                .select(_RETRY_COLUMNS)\
+                .eq('status', 'failed')\
+                .lt('retry_count', self.settings.EMAIL_RETRY_ATTEMPTS)\
+                .lte('next_retry_at', (datetime.utcnow() - timedelta(seconds=overdue_seconds)).isoformat())\
+                .order('next_retry_at')\
+                .range(offset, offset + limit - 1)\
+                .execute()
+            return result.data or []
+            
+        except Exception as e:
+            logger.error("❌ Failed to fetch emails to retry: %s", e)
+            return []
+
+    def claim_failed_emails_for_retry(self, limit: int = 50, overdue_seconds: int = 0) -> List[Dict]:
+        """
+        Prende in carico le email fallite in sospeso spostando next_retry_at in avanti
+        di _RETRY_CLAIM_LEASE. L'update è condizionato allo stato letto: con sweep
+        concorrenti Postgres rivaluta il filtro dopo il lock di riga e ogni record
+        viene restituito a un solo chiamante.
+        """
+        candidates = self.get_failed_emails_for_retry(limit, 0, overdue_seconds)
+        if not candidates:
+            return []
+        
+        cutoff = (datetime.utcnow() - timedelta(seconds=overdue_seconds)).isoformat()
+        try:
+            result = supabase_client.table('email_queue')\
+                .update({'next_retry_at': _utc_iso(time.time() + _RETRY_CLAIM_LEASE)})\
+                .in_('id', [record['id'] for record in candidates])\
+                .eq('status', 'failed')\
+                .lte('next_retry_at', cutoff)\
+                .execute()
+        except Exception as e:
+            logger.error("❌ Failed to claim emails to retry: %s", e)
+            return []
+        
+        claimed_ids = {record['id'] for record in result.data or []}
+        return [record for record in candidates if record['id'] in claimed_ids]
+
+    async def retry_failed_emails(self, limit: int = 50) -> Dict:
+        """
+        Inserisce nella coda di retry del processo le email fallite rimaste in sospeso
+        nel database (es. dopo un riavvio): il worker di retry le invia in parallelo
         """
-        email_queue_id = None
+        failed_emails = await asyncio.to_thread(
+            self.claim_failed_emails_for_retry, limit, _RETRY_SWEEP_GRACE
+        )
         
-        try:
-            logger.info(f"📧 Sending email to {to_email}: {subject}")
-            
-            # Validazione input
-            if not all([to_email, subject, html_body]):
-                raise ValueError("Missing required email parameters")
-            
-            if not self.sender_email or not self.sender_password:
-                raise ValueError("Email credentials not configured")
+        if failed_emails:
+            _get_email_loop().call_soon_threadsafe(self._enqueue_swept_retries, failed_emails)
+        
+        logger.info("🔁 Scheduled %s failed emails for retry", len(failed_emails))
+        return {'scheduled': len(failed_emails)}
 
-            # 🔥 SALVA EMAIL IN CODA DATABASE PRIMA DI INVIARE
-            try:
-                email_queue_data = {
-                    'recipient_email': to_email,
-                    'subject': subject,
-                    'html_body': html_body,
-                    'text_body': text_body,
-                    'email_type': email_type,
-                    'status': 'processing',
-                    'payment_intent_id': payment_intent_id,
-                    'subscription_id': subscription_id,
-                    'metadata': metadata or {},
-                    'created_at': datetime.utcnow().isoformat()
-                }
-                
-                result = supabase_client.table('email_queue').insert(email_queue_data).execute()
-                
-                if result.data:
-                    email_queue_id = result.data[0]['id']
-                    logger.info(f"📝 Email queued in database: {email_queue_id}")
-                
-            except Exception as db_error:
-                logger.warning(f"Failed to save email to database: {str(db_error)}")
+    def _enqueue_swept_retries(self, email_records: List[Dict]):
+        # Eseguito sul loop email: salta i record già in coda o in invio in questo processo
+        pending_ids = {
+            ref.result() if isinstance(ref, Future) else ref
+            for ref in self._retry_pending
+            if not isinstance(ref, Future) or ref.done()
+        }
+        now = time.time()
+        for email_record in email_records:
+            if email_record['id'] in pending_ids:
+                continue
+            pending_ids.add(email_record['id'])
+            self._enqueue_retry(now, email_record)
 
-            # PREPARA E INVIA EMAIL
-            message = MIMEMultipart("alternative")
-            message["Subject"] = subject
-            message["From"] = self.sender_email
-            message["To"] = to_email
-            message["Date"] = email.utils.formatdate(localtime=True)
-            
-            # Aggiungi corpo del messaggio
-            if text_body:
-                text_part = MIMEText(text_body, "plain", "utf-8")
-                message.attach(text_part)
-            
-            html_part = MIMEText(html_body, "html", "utf-8")
-            message.attach(html_part)
+    def _schedule_retry(self, email_record: Dict, delay: float):
+        """Programma un tentativo nella coda di retry (thread-safe)"""
+        _get_email_loop().call_soon_threadsafe(self._enqueue_retry, time.time() + delay, email_record)
 
-            # Aggiungi allegati se presenti
-            if attachments:
-                for attachment in attachments:
-                    self._add_attachment(message, attachment)
+    def _enqueue_retry(self, due_at: float, email_record: Dict):
+        # Eseguito sul loop email: coda e worker vengono creati al primo utilizzo
+        if self._retry_queue is None:
+            self._retry_queue = asyncio.PriorityQueue()
+            self._retry_wakeup = asyncio.Event()
+            self._retry_tasks = set()
+            self._retry_tasks.add(asyncio.get_running_loop().create_task(self._retry_worker()))
+        
+        self._retry_sequence += 1
+        self._retry_pending.add(email_record['id'])
+        self._retry_queue.put_nowait((due_at, self._retry_sequence, email_record))
+        self._retry_wakeup.set()
 
-            # 🔥 INVIA EMAIL
-            start_time = datetime.utcnow()
-            context = ssl.create_default_context()
-            
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.set_debuglevel(0)
-                
-                if self.use_tls:
-                    server.starttls(context=context)
-                    
-                server.login(self.sender_email, self.sender_password)
-                text = message.as_string()
-                server.sendmail(self.sender_email, [to_email], text)
+    async def _retry_worker(self):
+        """Estrae i retry in ordine di scadenza e li invia in parallelo"""
+        # Concorrenza bassa per i retry: evita di superare i rate limit del provider
+        semaphore = asyncio.Semaphore(getattr(self.settings, 'EMAIL_RETRY_CONCURRENCY', 4))
+        # Esiti della finestra corrente: [tentativi, fallimenti]
+        window = [0, 0]
 
-            processing_time_ms = int((datetime.utcnow() - start_time).total_seconds() * 1000)
-            
-            # 🔥 AGGIORNA STATUS COME INVIATA
-            if email_queue_id:
-                try:
-                    supabase_client.table('email_queue').update({
-                        'status': 'sent',
-                        'sent_at': datetime.utcnow().isoformat(),
-                        'processing_time_ms': processing_time_ms
-                    }).eq('id', email_queue_id).execute()
-                    
-                    logger.info(f"📧 Email status updated: sent")
-                    
-                except Exception as db_error:
-                    logger.warning(f"Failed to update email status: {str(db_error)}")
+        async def _retry_with_limit(email_record: Dict):
+            try:
+                async with semaphore:
+                    sent = await self._retry_email(email_record)
+            finally:
+                # Un eventuale nuovo tentativo viene accodato dopo: call_soon_threadsafe
+                self._retry_pending.discard(email_record['id'])
+            if sent is not None:
+                window[0] += 1
+                window[1] += 0 if sent else 1
 
-            logger.info(f"✅ Email sent successfully to {to_email} in {processing_time_ms}ms")
-            return True
+        while True:
+            attempts, failures = window
+            if attempts >= _RETRY_ABORT_MIN_ATTEMPTS and failures * 3 >= attempts:
+                # Un terzo dei retry fallisce: il server SMTP è probabilmente giù,
+                # meglio sospendere che bruciare i tentativi rimasti
+                logger.warning(
+                    "⏸️ Pausing email retries for %ss: %s/%s recent retries failed",
+                    self.settings.EMAIL_RETRY_DELAY, failures, attempts
+                )
+                window[0] = window[1] = 0
+                await asyncio.sleep(self.settings.EMAIL_RETRY_DELAY)
+            elif attempts >= _RETRY_WINDOW_SIZE:
+                window[0] = window[1] = 0
 
-        except Exception as e:
-            logger.error(f"❌ Failed to send email to {to_email}: {str(e)}")
+            due_at, sequence, email_record = await self._retry_queue.get()
+            delay = due_at - time.time()
             
-            if email_queue_id:
+            if delay > 0:
+                # Non ancora scaduto: attende la scadenza o l'arrivo di un retry più urgente
+                self._retry_queue.put_nowait((due_at, sequence, email_record))
+                self._retry_wakeup.clear()
                 try:
-                    supabase_client.table('email_queue').update({
-                        'status': 'failed',
-                        'failed_at': datetime.utcnow().isoformat(),
-                        'error_message': str(e),
-                        'retry_count': 0,
-                        'next_retry_at': datetime.utcnow().isoformat()
-                    }).eq('id', email_queue_id).execute()
-                    
-                except Exception as db_error:
-                    logger.warning(f"Failed to update error status: {str(db_error)}")
-            
-            return False
-    
-    async def send_email_async(
-        self,
-        to_email: str,
-        subject: str,
-        html_body: str,
-        text_body: Optional[str] = None
-    ) -> bool:
-        """
-        Invia email asincrona
-        """
-        try:
-            logger.info(f"📧 Sending async email to {to_email}: {subject}")
+                    await asyncio.wait_for(self._retry_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
             
-            message = MIMEMultipart("alternative")
-            message["Subject"] = subject
-            message["From"] = self.sender_email
-            message["To"] = to_email
-            message["Date"] = email.utils.formatdate(localtime=True)
+            task = asyncio.get_running_loop().create_task(_retry_with_limit(email_record))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
 
-            if text_body:
-                text_part = MIMEText(text_body, "plain", "utf-8")
-                message.attach(text_part)
-            
-            html_part = MIMEText(html_body, "html", "utf-8")
-            message.attach(html_part)
+    async def _retry_email(self, email_record: Dict) -> Optional[bool]:
+        """Ritenta un invio; None se il record non è (ancora) salvato nel database"""
+        email_queue_ref = email_record['id']
+        if isinstance(email_queue_ref, Future):
+            # Record accodato da questo processo: l'insert è già stato scritto
+            email_queue_id = email_queue_ref.result() if email_queue_ref.done() else None
+            if not email_queue_id:
+                return None
+            email_record = {**email_record, 'id': email_queue_id}
 
-            await aiosmtplib.send(
-                message,
-                hostname=self.smtp_server,
-                port=self.smtp_port,
-                username=self.sender_email,
-                password=self.sender_password,
-                use_tls=self.use_tls,
-                timeout=30,
-                start_tls=self.use_tls
-            )
+        try:
+            raw_message = email_record.get('raw_message')
+            if raw_message is None:
+                # Record letto dal database: si ricostruisce una volta sola
+                raw_message = await self._build_raw_message_async(
+                    email_record['recipient_email'],
+                    email_record['subject'],
+                    email_record['html_body'],
+                    email_record.get('text_body')
+                )
+                email_record = {**email_record, 'raw_message': raw_message}
+
+            start_ns = time.perf_counter_ns()
+            await self._get_smtp_pool().sendmail(self.sender_email, [email_record['recipient_email']], raw_message)
+            processing_time_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
 
-            logger.info(f"✅ Async email sent successfully to {to_email}")
+            self._mark_email_sent(email_record['id'], processing_time_ms)
+            logger.info("🔁 Retry succeeded for email %s", email_record['id'])
             return True
 
         except Exception as e:
-            logger.error(f"❌ Failed to send async email to {to_email}: {str(e)}")
+            logger.error("❌ Retry failed for email %s: %s", email_record.get('id'), e)
+            retry_count = self._mark_email_retry_failed(email_record, str(e))
+            
+            if retry_count < self.settings.EMAIL_RETRY_ATTEMPTS:
+                self._schedule_retry({**email_record, 'retry_count': retry_count}, self._retry_delay(retry_count))
             return False
 
     def _add_attachment(self, message, attachment: Dict):
         """Aggiunge allegato al messaggio"""
         try:
+            # Lettura e codifica base64 a blocchi (righe MIME da 76 caratteri): il file
+            # grezzo non viene mai caricato per intero. Al picco restano in memoria i
+            # blocchi codificati e il payload unito, circa 2x la dimensione codificata
+            # (con encode_base64 sul file intero: file grezzo + bytes codificati + str)
+            encoded_chunks = []
             with open(attachment['path'], "rb") as attachment_file:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment_file.read())
+                while chunk := attachment_file.read(_ATTACHMENT_CHUNK_SIZE):
+                    encoded_chunks.append(base64.encodebytes(chunk).decode('ascii'))
             
-            encode_base64(part)
+            part = MIMEBase('application', 'octet-stream', policy=_SMTP_POLICY)
+            part.set_payload(''.join(encoded_chunks))
+            part['Content-Transfer-Encoding'] = 'base64'
             part.add_header(
                 'Content-Disposition',
                 f"attachment; filename= {attachment['filename']}"
             )
             message.attach(part)
         except Exception as e:
-            logger.warning(f"⚠️ Failed to add attachment {attachment['filename']}: {str(e)}")
+            logger.warning("⚠️ Failed to add attachment %s: %s", attachment['filename'], e)
 
     def render_template_and_subject(self, template_name: str, context: Dict) -> tuple[str, str, str]:
         """
@@ -233,187 +1465,52 @@ class EmailService:
         Returns: (rendered_subject, rendered_html, rendered_text)
         """
         try:
-            # 1️⃣ RECUPERA TEMPLATE DAL DATABASE
-            db_template = self._get_template_from_database(template_name)
-            
-            if not db_template:
-                logger.error(f"❌ Template '{template_name}' not found in database")
+            if not JINJA_AVAILABLE:
+                logger.warning("⚠️ Jinja2 not available - using fallback")
                 return self._get_fallback_template(template_name, context)
             
-            logger.info(f"📄 Using database template: {template_name} v{db_template.get('version', '1.0')}")
+            # 1️⃣ RECUPERA TEMPLATE COMPILATO (database solo al primo utilizzo)
+            version, subject_template, html_template, text_template = _get_compiled_template(
+                template_name, _template_cache_key(template_name)
+            )
+            
+            logger.info("📄 Using database template: %s v%s", template_name, version)
             
             # 2️⃣ RENDERIZZA TUTTI I COMPONENTI
-            return self._render_database_template_complete(db_template, context)
+            rendered_subject = subject_template.render(**context)
+            rendered_html = html_template.render(**context)
+            rendered_text = text_template.render(**context) if text_template else None
+            
+            logger.info("✅ Template rendered successfully: %s", template_name)
+            return rendered_subject, rendered_html, rendered_text
                 
         except Exception as e:
-            logger.error(f"❌ Template rendering error for '{template_name}': {str(e)}")
+            logger.error("❌ Template rendering error for '%s': %s", template_name, e)
             return self._get_fallback_template(template_name, context)
     
+    async def render_template_and_subject_async(self, template_name: str, context: Dict) -> tuple[str, str, str]:
+        """
+        Renderizza il template in un thread: la lettura da Supabase e il render
+        Jinja non devono bloccare il loop email, che resta dedicato all'I/O SMTP
+        """
+        return await asyncio.to_thread(self.render_template_and_subject, template_name, context)
+    
     def _get_template_from_database(self, template_name: str) -> Optional[Dict]:
         """Recupera template dal database Supabase"""
-        try:
-            result = supabase_client.table('email_templates')\
-                .select('*')\
-                .eq('name', template_name)\
-                .eq('is_active', True)\
-                .order('version', desc=True)\
-                .limit(1)\
-                .execute()
-            
-            if result.data and len(result.data) > 0:
-                template_data = result.data[0]
-                logger.info(f"✅ Found database template: {template_name} v{template_data.get('version', '1.0')}")
-                return template_data
-            
-            logger.warning(f"⚠️ Template '{template_name}' not found in database")
-            return None
-            
-        except Exception as e:
-            logger.error(f"❌ Failed to fetch template '{template_name}' from database: {str(e)}")
-            return None
-    
-    def _render_database_template_complete(self, template_data: Dict, context: Dict) -> tuple[str, str, str]:
-        """Renderizza subject, HTML e text template dal database usando Jinja2"""
-        try:
-            if not JINJA_AVAILABLE:
-                logger.warning("⚠️ Jinja2 not available - using fallback")
-                return self._get_fallback_template(template_data['name'], context)
-            
-            # 🔥 RENDERIZZA SOGGETTO (sempre obbligatorio)
-            if not template_data.get('subject_template'):
-                raise ValueError(f"Missing subject_template for template: {template_data['name']}")
-
-            subject_template = Template(template_data['subject_template'])
-            rendered_subject = subject_template.render(**context)
-            
-            # 🔥 RENDERIZZA HTML (sempre obbligatorio)
-            if not template_data.get('html_template'):
-                raise ValueError(f"Missing html_template for template: {template_data['name']}")
-                
-            html_template = Template(template_data['html_template'])
-            rendered_html = html_template.render(**context)
-            
-            # 🔥 RENDERIZZA TEXT (opzionale)
-            rendered_text = None
-            if template_data.get('text_template'):
-                text_template = Template(template_data['text_template'])
-                rendered_text = text_template.render(**context)
-            
-            logger.info(f"✅ Template rendered successfully: {template_data['name']}")
-            return rendered_subject, rendered_html, rendered_text
-            
-        except Exception as e:
-            logger.error(f"❌ Failed to render database template: {str(e)}")
-            return self._get_fallback_template(template_data['name'], context)
+        return _fetch_email_template(template_name)
 
     def _get_fallback_template(self, template_name: str, context: Dict) -> tuple[str, str, str]:
         """Template di fallback hardcoded quando il database non è disponibile"""
         
-        if template_name == "payment_confirmation":
-            subject = "✅ Pagamento confermato - Abbonamento {{plan_type}}"
-            html_body = """
-            <!DOCTYPE html>
-            <html>
-            <head><meta charset="UTF-8"><title>Pagamento Confermato</title></head>
-            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f3f4f6;">
-                <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 8px; padding: 30px;">
-                    <h1 style="color: #059669; margin: 0 0 20px 0;">Pagamento Confermato!</h1>
-                    <p>Ciao <strong>{{customer_name}}</strong>,</p>
-                    <p>Il tuo pagamento per l'abbonamento <strong>{{plan_type}}</strong> è stato elaborato con successo.</p>
-                    
-                    <div style="background: #f0fdf4; padding: 20px; border-radius: 6px; margin: 20px 0;">
-                        <p><strong>Piano:</strong> {{plan_type}}</p>
-                        <p><strong>Importo:</strong> €{{amount}}</p>
-                        <p><strong>Data:</strong> {{payment_date}}</p>
-                        <p><strong>ID Transazione:</strong> {{payment_intent_id}}</p>
-                    </div>
-                    
-                    <p style="font-size: 14px; color: #6b7280;">
-                        Grazie per aver scelto Clearify!<br>
-                        Supporto: <a href="mailto:support@clearify.com">support@clearify.com</a>
-                    </p>
-                </div>
-            </body>
-            </html>
-            """
-            text_body = """
-            Pagamento Confermato!
-
-            Ciao {{customer_name}},
-
-            Il tuo pagamento per l'abbonamento {{plan_type}} è stato elaborato con successo.
-
-            Dettagli:
-            - Piano: {{plan_type}}
-            - Importo: €{{amount}}
-            - Data: {{payment_date}}
-            - ID Transazione: {{payment_intent_id}}
-
-            Grazie per aver scelto Clearify!
-            Supporto: support@clearify.com
-            """
-            
-        elif template_name == "subscription_expiring":
-            subject = "⚠️ Il tuo abbonamento Clearify scade presto"
-            html_body = """
-            <!DOCTYPE html>
-            <html>
-            <head><meta charset="UTF-8"><title>Abbonamento in Scadenza</title></head>
-            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f3f4f6;">
-                <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 8px; padding: 30px;">
-                    <h1 style="color: #d97706; margin: 0 0 20px 0;">Il tuo abbonamento sta scadendo</h1>
-                    <p>Il tuo abbonamento <strong>{{plan_type}}</strong> scadrà il <strong>{{end_date}}</strong>.</p>
-                    <p>Rinnova ora per continuare a usare tutte le funzionalità premium.</p>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="https://clearify.com/checkout" 
-                           style="display: inline-block; background: #059669; color: white; padding: 12px 24px; text-decoration: none; border-radius: 6px; font-weight: 500;">
-                            Rinnova Abbonamento
-                        </a>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            text_body = """
-            Il tuo abbonamento sta scadendo
-
-            Il tuo abbonamento {{plan_type}} scadrà il {{end_date}}.
-            Rinnova ora per continuare a usare tutte le funzionalità premium.
-
-            Rinnova su: https://clearify.com/checkout
-            """
+        format_strings = _FALLBACK_FORMAT_STRINGS.get(template_name)
         
-        else:
+        if format_strings is None:
             # Template generico
-            subject = "Notifica da Clearify"
-            html_body = "<p>Template non trovato per: " + template_name + "</p>"
-            text_body = "Template non trovato per: " + template_name
-        
-        # Renderizza con Jinja2 se disponibile, altrimenti simple replace
-        if JINJA_AVAILABLE:
-            try:
-                subject_template = Template(subject)
-                html_template = Template(html_body)
-                text_template = Template(text_body) if text_body else None
-                
-                rendered_subject = subject_template.render(**context)
-                rendered_html = html_template.render(**context)
-                rendered_text = text_template.render(**context) if text_template else None
-                
-                return rendered_subject, rendered_html, rendered_text
-            except:
-                pass
+            return _generic_fallback(template_name)
         
-        # Fallback senza Jinja2 - simple string replace
-        for key, value in context.items():
-            placeholder = "{{" + key + "}}"
-            subject = subject.replace(placeholder, str(value))
-            html_body = html_body.replace(placeholder, str(value))
-            if text_body:
-                text_body = text_body.replace(placeholder, str(value))
-        
-        return subject, html_body, text_body
+        # Una format_map per componente (variabili mancanti come stringa vuota)
+        values = _EmptyDefaultDict(context)
+        return tuple(format_string.format_map(values) for format_string in format_strings)
 
     def send_verification_email(
         self,
@@ -450,7 +1547,7 @@ class EmailService:
             )
 
         except Exception as e:
-            logger.error(f"Error in send_verification_email: {str(e)}")
+            logger.error("Error in send_verification_email: %s", e)
             return False
 
     def send_password_reset_email(
@@ -488,7 +1585,7 @@ class EmailService:
             )
 
         except Exception as e:
-            logger.error(f"Error in send_password_reset_email: {str(e)}")
+            logger.error("Error in send_password_reset_email: %s", e)
             return False
 
     def send_subscription_expiring_email(
@@ -525,7 +1622,7 @@ class EmailService:
             )
             
         except Exception as e:
-            logger.error(f"Error in send_subscription_expiring_email: {str(e)}")
+            logger.error("Error in send_subscription_expiring_email: %s", e)
             return False
 
     def send_payment_failed_email_service(
@@ -562,7 +1659,7 @@ class EmailService:
             )
             
         except Exception as e:
-            logger.error(f"Error in send_payment_failed_email_service: {str(e)}")
+            logger.error("Error in send_payment_failed_email_service: %s", e)
             return False
     
     # Analytics Section
@@ -570,8 +1667,6 @@ class EmailService:
         """Invia report giornaliero via email"""
         
         try:
-            email_service = EmailService() 
-
             # Carica template HTML
             html_template = self._get_template_from_database("analytics")
             
@@ -579,7 +1674,7 @@ class EmailService:
             html_content = self._replace_template_variables(html_template['html_template'], metrics)
             
             # Invia email            
-            success = email_service.send_email_sync(
+            success = self.send_email_sync(
                 to_email=recipient_email,
                 subject=f"{html_template['subject_template']} - {metrics.report_date}",
                 html_body=html_content,
@@ -598,7 +1693,7 @@ class EmailService:
                 report_data=asdict(metrics)
             )
             
-            print(f"Errore invio email: {e}")
+            logger.error("Errore invio email: %s", e)
             return False
     
     # Cleanup Section
@@ -626,12 +1721,12 @@ class EmailService:
                 .execute()
             
             deleted_count = len(response.data)
-            logger.info(f"Cleaned up {deleted_count} old email queues")
+            logger.info("Cleaned up %s old email queues", deleted_count)
             
             return deleted_count
             
         except Exception as e:
-            logger.error(f"Error cleaning up email queue: {e}")
+            logger.error("Error cleaning up email queue: %s", e)
             return 0
 
     def _replace_template_variables(self, template: str, metrics: DailyMetrics) -> str:
@@ -776,7 +1871,7 @@ class EmailService:
         remaining_placeholders = re.findall(r'\{\{([^}]+)\}\}', template)
         
         if remaining_placeholders:
-            print(f"⚠️  Placeholder non sostituiti trovati: {remaining_placeholders}")
+            logger.warning("⚠️  Placeholder non sostituiti trovati: %s", remaining_placeholders)
             
             # Sostituisce placeholder rimanenti con "N/A"
             for placeholder in remaining_placeholders:
@@ -784,7 +1879,11 @@ class EmailService:
         
         return template
 
-def send_payment_confirmation_email(
+def _name_from_email(to_email: str) -> str:
+    """Nome di fallback ricavato dalla parte locale dell'indirizzo email"""
+    return to_email.partition('@')[0].title()
+
+async def send_payment_confirmation_email_async(
     to_email: str,
     plan_type: str,
     amount: float,
@@ -792,23 +1891,21 @@ def send_payment_confirmation_email(
     customer_name: str = ""
 ) -> bool:
     """
-    Funzione per inviare email di conferma pagamento con template da database
+    Funzione asincrona per inviare email di conferma pagamento con template da database
     """
     try:
-        email_service = EmailService()
-        
         # Context per template
         context = {
-            'customer_name': customer_name or to_email.split('@')[0].title(),
+            'customer_name': customer_name or _name_from_email(to_email),
             'plan_type': plan_type,
             'amount': amount,
             'payment_date': datetime.utcnow().strftime("%d/%m/%Y alle %H:%M UTC"),
             'payment_intent_id': payment_intent_id,
         }
         
-        subject, html_body, text_body = email_service.render_template_and_subject("payment_confirmation", context)
+        subject, html_body, text_body = await email_service.render_template_and_subject_async("payment_confirmation", context)
         
-        success = email_service.send_email_sync(
+        success = await email_service.send_email_async(
             to_email=to_email,
             subject=subject,
             html_body=html_body,
@@ -825,30 +1922,46 @@ def send_payment_confirmation_email(
         return success
         
     except Exception as e:
-        logger.error(f"❌ Error in send_payment_confirmation_email: {str(e)}")
+        logger.error("❌ Error in send_payment_confirmation_email: %s", e)
         return False
 
-def send_registration_confirmation_email(
+def send_payment_confirmation_email(
+    to_email: str,
+    plan_type: str,
+    amount: float,
+    payment_intent_id: str,
+    customer_name: str = ""
+) -> bool:
+    """
+    Funzione per inviare email di conferma pagamento con template da database
+    """
+    return run_in_email_loop(send_payment_confirmation_email_async(
+        to_email=to_email,
+        plan_type=plan_type,
+        amount=amount,
+        payment_intent_id=payment_intent_id,
+        customer_name=customer_name
+    ))
+
+async def send_registration_confirmation_email_async(
     to_email: str,
     customer_name: str
 ) -> bool:
     """
-    Funzione di utilità per inviare email di conferma registrazione con template da database
+    Funzione asincrona per inviare email di conferma registrazione con template da database
     """
     try:
-        email_service = EmailService()
-        
         # Il context, passando le variabili necessarie al template
         context = {
-            'customer_name': customer_name or to_email.split('@')[0].title(),
+            'customer_name': customer_name or _name_from_email(to_email),
             'user_email': to_email
         }
         
         #Prendo il template dal database
-        subject, html_body, text_body = email_service.render_template_and_subject("registration_confirmation", context)
+        subject, html_body, text_body = await email_service.render_template_and_subject_async("registration_confirmation", context)
         
         #Invio l'email
-        success = email_service.send_email_sync(
+        success = await email_service.send_email_async(
             to_email=to_email,
             subject=subject,
             html_body=html_body,
@@ -863,9 +1976,122 @@ def send_registration_confirmation_email(
         return success
         
     except Exception as e:
-        logger.error(f"❌ Error in send_payment_confirmation_email: {str(e)}")
+        logger.error("❌ Error in send_registration_confirmation_email: %s", e)
         return False
 
+def send_registration_confirmation_email(
+    to_email: str,
+    customer_name: str
+) -> bool:
+    """
+    Funzione di utilità per inviare email di conferma registrazione con template da database
+    """
+    return run_in_email_loop(send_registration_confirmation_email_async(
+        to_email=to_email,
+        customer_name=customer_name
+    ))
+
+async def send_registration_confirmation_emails_async(recipients: List[Dict]) -> List[bool]:
+    """
+    Invia in blocco le email di conferma registrazione.
+    Ogni destinatario è un dict con 'to_email' e 'customer_name' (opzionale).
+    """
+    try:
+        emails = []
+        for recipient in recipients:
+            to_email = recipient['to_email']
+            customer_name = recipient.get('customer_name', '')
+            
+            context = {
+                'customer_name': customer_name or _name_from_email(to_email),
+                'user_email': to_email
+            }
+            
+            # Il template compilato è in cache: qui si paga solo il render, fuori dal loop
+            subject, html_body, text_body = await email_service.render_template_and_subject_async("registration_confirmation", context)
+            
+            emails.append({
+                'to_email': to_email,
+                'subject': subject,
+                'html_body': html_body,
+                'text_body': text_body,
+                'email_type': "registration_confirmation",
+                'metadata': {
+                    'customer_name': customer_name,
+                    'user_email': to_email
+                }
+            })
+        
+        return await email_service.send_emails_async(emails)
+        
+    except Exception as e:
+        logger.error("❌ Error in send_registration_confirmation_emails: %s", e)
+        return [False] * len(recipients)
+
+def send_registration_confirmation_emails(recipients: List[Dict]) -> List[bool]:
+    """
+    Funzione di utilità per inviare in blocco le email di conferma registrazione
+    """
+    return run_in_email_loop(
+        send_registration_confirmation_emails_async(recipients), timeout=_bulk_wait_timeout(len(recipients))
+    )
+
+async def send_payment_confirmation_emails_async(payments: List[Dict]) -> List[bool]:
+    """
+    Invia in blocco le email di conferma pagamento.
+    Ogni elemento contiene gli argomenti di send_payment_confirmation_email.
+    """
+    try:
+        payment_date = datetime.utcnow().strftime("%d/%m/%Y alle %H:%M UTC")
+        emails = []
+        for payment in payments:
+            to_email = payment['to_email']
+            customer_name = payment.get('customer_name', '')
+            
+            context = {
+                'customer_name': customer_name or _name_from_email(to_email),
+                'plan_type': payment['plan_type'],
+                'amount': payment['amount'],
+                'payment_date': payment_date,
+                'payment_intent_id': payment['payment_intent_id'],
+            }
+            
+            subject, html_body, text_body = await email_service.render_template_and_subject_async("payment_confirmation", context)
+            
+            emails.append({
+                'to_email': to_email,
+                'subject': subject,
+                'html_body': html_body,
+                'text_body': text_body,
+                'email_type': "payment_confirmation",
+                'payment_intent_id': payment['payment_intent_id'],
+                'metadata': {
+                    'plan_type': payment['plan_type'],
+                    'amount_euros': payment['amount'] / 100,
+                    'customer_name': customer_name
+                }
+            })
+        
+        return await email_service.send_emails_async(emails)
+        
+    except Exception as e:
+        logger.error("❌ Error in send_payment_confirmation_emails: %s", e)
+        return [False] * len(payments)
+
+def send_payment_confirmation_emails(payments: List[Dict]) -> List[bool]:
+    """
+    Funzione di utilità per inviare in blocco le email di conferma pagamento
+    """
+    return run_in_email_loop(
+        send_payment_confirmation_emails_async(payments), timeout=_bulk_wait_timeout(len(payments))
+    )
+
+def retry_failed_emails_from_database(limit: int = 50) -> Dict:
+    """
+    Funzione di utilità per ritentare le email fallite salvate nel database
+    """
+    return run_in_email_loop(email_service.retry_failed_emails(limit), timeout=_bulk_wait_timeout(limit))
+
 def create_or_update_email_template(
     name: str,
     subject_template: str,
@@ -878,6 +2104,9 @@ def create_or_update_email_template(
     Crea o aggiorna un template email nel database
     """
     try:
+        # Un solo timestamp per updated_at / created_at
+        now_iso = datetime.utcnow().isoformat()
+        
         # Controlla se esiste già
         existing = supabase_client.table('email_templates')\
             .select('id')\
@@ -892,7 +2121,7 @@ def create_or_update_email_template(
             'text_template': text_template,
             'version': version,
             'is_active': is_active,
-            'updated_at': datetime.utcnow().isoformat()
+            'updated_at': now_iso
         }
         
         if existing.data:
@@ -902,48 +2131,94 @@ def create_or_update_email_template(
                 .eq('name', name)\
                 .eq('version', version)\
                 .execute()
-            logger.info(f"✅ Updated email template: {name} v{version}")
+            logger.info("✅ Updated email template: %s v%s", name, version)
         else:
             # Crea nuovo
-            template_data['created_at'] = datetime.utcnow().isoformat()
+            template_data['created_at'] = now_iso
             result = supabase_client.table('email_templates')\
                 .insert(template_data)\
                 .execute()
-            logger.info(f"✅ Created new email template: {name} v{version}")
+            logger.info("✅ Created new email template: %s v%s", name, version)
         
+        invalidate_template_cache(name)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Error creating/updating template '{name}': {str(e)}")
+        logger.error("❌ Error creating/updating template '%s': %s", name, e)
         return False
 
+def _empty_type_stats() -> Dict:
+    return {'sent': 0, 'failed': 0, 'pending': 0}
+
+def _email_statistics_from_queue(cutoff_date: datetime) -> Dict:
+    """Calcola le statistiche scansionando direttamente email_queue (fallback)"""
+    result = supabase_client.table('email_queue')\
+        .select('status, email_type')\
+        .gte('created_at', cutoff_date.isoformat())\
+        .execute()
+    
+    # Un solo passaggio (Counter in C) per coppia (email_type, status),
+    # poi la stessa somma usata per le righe già aggregate
+    pair_counts = Counter((email['email_type'], email['status']) for email in result.data or [])
+    
+    return _sum_grouped_email_counts(
+        [{'email_type': email_type, 'status': status, 'n': count} for (email_type, status), count in pair_counts.items()],
+        'n'
+    )
+
+def _sum_grouped_email_counts(rows: List[Dict], count_key: str) -> Dict:
+    """Costruisce le statistiche da righe già raggruppate per (email_type, status)"""
+    stats = {'total': 0, 'sent': 0, 'failed': 0, 'pending': 0}
+    by_type = defaultdict(_empty_type_stats)
+    
+    for row in rows:
+        status = row['status']
+        count = row[count_key]
+        
+        stats['total'] += count
+        if status in ('sent', 'failed', 'pending'):
+            stats[status] += count
+        
+        type_stats = by_type[row['email_type']]
+        type_stats[status] = type_stats.get(status, 0) + count
+    
+    stats['by_type'] = dict(by_type)
+    return stats
+
+def _email_statistics_from_daily_view(cutoff_date: datetime) -> Dict:
+    """Somma le righe pre-aggregate della vista materializzata email_stats_daily"""
+    result = supabase_client.table('email_stats_daily')\
+        .select('email_type, status, c')\
+        .gte('d', cutoff_date.date().isoformat())\
+        .execute()
+    
+    return _sum_grouped_email_counts(result.data or [], 'c')
+
+def _email_statistics_from_rpc(cutoff_date: datetime) -> Dict:
+    """Aggregazione GROUP BY lato Postgres tramite la RPC email_queue_stats"""
+    result = supabase_client.rpc('email_queue_stats', {'since': cutoff_date.isoformat()}).execute()
+    
+    return _sum_grouped_email_counts(result.data or [], 'n')
+
 def get_email_statistics(days: int = 7) -> Dict:
-    """Ottieni statistiche email degli ultimi N giorni"""
+    """
+    Ottieni statistiche email degli ultimi N giorni.
+    Usa la vista materializzata email_stats_daily (aggiornata ogni ora, granularità
+    giornaliera); se non disponibile aggrega email_queue lato server con la RPC
+    email_queue_stats e, in ultima istanza, interroga direttamente email_queue.
+    """
     try:
-        from datetime import timedelta
         cutoff_date = datetime.utcnow() - timedelta(days=days)
         
-        result = supabase_client.table('email_queue')\
-            .select('status, email_type')\
-            .gte('created_at', cutoff_date.isoformat())\
-            .execute()
-        
-        data = result.data or []
-        
-        stats = {
-            'total': len(data),
-            'sent': len([e for e in data if e['status'] == 'sent']),
-            'failed': len([e for e in data if e['status'] == 'failed']),
-            'pending': len([e for e in data if e['status'] == 'pending']),
-            'by_type': {}
-        }
-        
-        # Statistiche per tipo
-        for email in data:
-            email_type = email['email_type']
-            if email_type not in stats['by_type']:
-                stats['by_type'][email_type] = {'sent': 0, 'failed': 0, 'pending': 0}
-            stats['by_type'][email_type][email['status']] += 1
+        try:
+            stats = _email_statistics_from_daily_view(cutoff_date)
+        except Exception as view_error:
+            logger.warning("email_stats_daily not available, aggregating email_queue: %s", view_error)
+            try:
+                stats = _email_statistics_from_rpc(cutoff_date)
+            except Exception as rpc_error:
+                logger.warning("email_queue_stats RPC not available, querying email_queue: %s", rpc_error)
+                stats = _email_statistics_from_queue(cutoff_date)
         
         # Calcola success rate
         if stats['total'] > 0:
@@ -954,9 +2229,25 @@ def get_email_statistics(days: int = 7) -> Dict:
         return stats
         
     except Exception as e:
-        logger.error(f"Error getting email statistics: {str(e)}")
+        logger.error("Error getting email statistics: %s", e)
         return {'total': 0, 'sent': 0, 'failed': 0, 'pending': 0, 'success_rate': 0}
 
+def refresh_email_statistics() -> bool:
+    """Aggiorna la vista materializzata email_stats_daily"""
+    try:
+        supabase_client.rpc('refresh_email_stats_daily').execute()
+        logger.info("✅ email_stats_daily refreshed")
+        return True
+    except Exception as e:
+        logger.error("Error refreshing email statistics: %s", e)
+        return False
+
+
+@lru_cache(maxsize=1)
+def get_email_service() -> EmailService:
+    """Ritorna l'istanza condivisa del servizio email"""
+    return EmailService()
+
 
 # Istanza globale del servizio
-email_service = EmailService()
\ No newline at end of file
+email_service = get_email_service()
\ No newline at end of file
@@ -1,39 +1,404 @@
 import asyncio
+import hashlib
+import json
 import logging
-from typing import Dict, Any, Optional
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional, Tuple
 
-from openai import AsyncOpenAI, APIError, RateLimitError
+from openai import AsyncOpenAI, APIConnectionError, APIError, APIStatusError, APITimeoutError, NotFoundError, RateLimitError
 from app.core.config import settings
 from app.core.supabase_client import supabase_client
 from fastapi import HTTPException
 import httpx
+import redis
 
 logger = logging.getLogger(__name__)
-# Mappa processing_type -> nome prompt DB
-PROCESSING_TYPE_TO_PROMPT_NAME = {
-    "HUMANIZER": "humanizer",
-    "GRAMMAR": "grammar",
-    "STYLE": "style",
-    "PROFESSIONAL": "professional",
-}
+# Mappa processing_type -> nome prompt DB (immutabile, condivisa tra i loop).
+# Chiavi casefold: i valori di TextProcessingType ("humanizer", ...) trovano la chiave senza conversioni
+PROCESSING_TYPE_TO_PROMPT_NAME = MappingProxyType({
+    "humanizer": "humanizer",
+    "grammar": "grammar",
+    "style": "style",
+    "professional": "professional",
+})
+
+
+def _processing_key(processing_type: str) -> str:
+    """processing_type normalizzato (casefold solo se non è già una chiave della mappa)"""
+    if processing_type in PROCESSING_TYPE_TO_PROMPT_NAME:
+        return processing_type
+    return processing_type.casefold()
+
+# Testo trasformato racchiuso nei tag dell'agent prompt (una sola scansione)
+TRANSFORMED_TEXT_RE = re.compile(r"<TRANSFORMED_TEXT>(.*?)</TRANSFORMED_TEXT>", re.DOTALL)
+
+def _response_key(
+    text: str,
+    processing_type: str,
+    options: Optional[Dict[str, Any]],
+    prompt_hash: str
+) -> bytes:
+    """
+    Chiave della cache risposte: hash di (processing_type, testo, opzioni canoniche, prompt).
+    prompt_hash cambia quando i prompt nel DB vengono modificati, invalidando le risposte vecchie
+    """
+    payload = json.dumps([processing_type, text, options or {}, prompt_hash], sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+
+# Istruzioni di sistema se agent_prompt non è presente nel DB
+DEFAULT_AGENT_PROMPT = (
+    "You are a professional text improvement assistant. Transform the provided text "
+    "according to the given tone or template. Output only the transformed text."
+)
+
+# Frasi per get_text_analysis: tratti non vuoti tra due punti, in una sola scansione
+SENTENCE_RE = re.compile(r"[^.]*[^.\s][^.]*")
+
+# Placeholder del testo nei prompt: "[text]" viene normalizzato in "{text}"
+TEXT_PLACEHOLDER = "{text}"
+
+
+@lru_cache(maxsize=256)
+def _compile_prompt(prompt: str) -> Tuple[str, ...]:
+    """Prompt normalizzato diviso sul placeholder (calcolato una volta per prompt): il testo va tra i segmenti"""
+    return tuple(prompt.replace("[text]", TEXT_PLACEHOLDER).split(TEXT_PLACEHOLDER))
+
+
+# Opzioni aggiunte in coda al prompt, con l'etichetta già pronta
+OPTION_LINES = (("style", "Style: "), ("target_audience", "Target Audience: "))
+
+
+class _TransformedTextFilter:
+    """
+    Versione in streaming di _extract_transformed_text: emette solo il testo tra i
+    tag <TRANSFORMED_TEXT>, oppure l'intera risposta a fine stream se i tag mancano.
+    """
+    OPEN = "<TRANSFORMED_TEXT>"
+    CLOSE = "</TRANSFORMED_TEXT>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+        self._done = False
+        self._emitted = False
+
+    def feed(self, piece: str) -> str:
+        if self._done:
+            return ""
+        searched = max(0, len(self._buffer) - len(self.OPEN))
+        self._buffer += piece
+        if not self._inside:
+            start = self._buffer.find(self.OPEN, searched)
+            if start < 0:
+                return ""
+            self._buffer = self._buffer[start + len(self.OPEN):]
+            self._inside = True
+        if not self._emitted:
+            self._buffer = self._buffer.lstrip()
+
+        end = self._buffer.find(self.CLOSE)
+        if end >= 0:
+            self._done = True
+            text, self._buffer = self._buffer[:end].rstrip(), ""
+            return text
+        # Trattiene la coda (e gli spazi finali): il tag di chiusura può arrivare spezzato
+        keep = len(self.CLOSE) - 1
+        text = self._buffer[:-keep].rstrip()
+        self._buffer = self._buffer[len(text):]
+        self._emitted = self._emitted or bool(text)
+        return text
+
+    def flush(self) -> str:
+        if self._done:
+            return ""
+        self._done = True
+        return self._buffer.rstrip() if self._inside else self._buffer.strip()
+
+
+# Più testi dello stesso chiamante nella stessa richiesta chat: il prompt di sistema viene pagato una volta sola
+PACKED_TEXTS_PLACEHOLDER = "<<<NUMBERED_TEXTS>>>"
+
+# Stati finali di un batch OpenAI (/v1/batches)
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _extract_transformed_text(content: str) -> str:
+    """Testo tra i tag <TRANSFORMED_TEXT>, oppure l'intera risposta"""
+    processed_text = content.strip()
+    transformed = TRANSFORMED_TEXT_RE.search(processed_text)
+    return transformed.group(1).strip() if transformed else processed_text
+
+
+HUMANIZE_WEBHOOK_URL = "https://agentonesrl.app.n8n.cloud/webhook/humanize"
+
+# Event loop dedicato alle chiamate HTTP verso OpenAI/n8n: i task Celery creano
+# un loop nuovo per ogni esecuzione, mentre i client HTTP condivisi (e le loro
+# connessioni keep-alive) devono restare legati sempre allo stesso loop
+_http_loop: Optional[asyncio.AbstractEventLoop] = None
+_http_loop_lock = threading.Lock()
+
+
+def _get_http_loop() -> asyncio.AbstractEventLoop:
+    """Avvia (una sola volta) il loop in background che possiede i client HTTP"""
+    global _http_loop
+    with _http_loop_lock:
+        if _http_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="openai-http", daemon=True).start()
+            _http_loop = loop
+    return _http_loop
+
+
+async def _await_in_http_loop(coro):
+    """Esegue una coroutine sul loop HTTP da un qualunque altro event loop"""
+    loop = _get_http_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+async def _anext(agen):
+    return await agen.__anext__()
+
+
+async def _iterate_in_http_loop(agen):
+    """Itera un async generator del loop HTTP da un qualunque altro event loop"""
+    loop = _get_http_loop()
+    if asyncio.get_running_loop() is loop:
+        async for item in agen:
+            yield item
+        return
+    try:
+        while True:
+            try:
+                item = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_anext(agen), loop))
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        # Consumer interrotto (es. client disconnesso): chiude lo stream OpenAI sul suo loop
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop)
+
+
+# Cache dei prompt e limiti OpenAI condivisi tra processi (API e worker Celery) su Redis
+PROMPTS_REDIS_KEY = "prompts:all"
+RESPONSE_REDIS_PREFIX = "openai:response:"
+_redis_client = None
+
+
+def _get_redis() -> Optional[redis.Redis]:
+    """Client Redis condiviso del servizio (None se Redis non è configurato)"""
+    global _redis_client
+    if _redis_client is None:
+        try:
+            _redis_client = redis.Redis.from_url(
+                settings.redis_url, db=1, decode_responses=True, socket_timeout=1
+            ) if settings.redis_url else False
+        except Exception as e:
+            logger.warning("Redis not available for OpenAI service: %s", e)
+            _redis_client = False
+    return _redis_client or None
+
+
+class OpenAIRateLimiter:
+    """
+    Limite RPM/TPM lato client, condiviso tra tutti i processi tramite contatori
+    Redis per minuto (openai:rpm:<minuto> / openai:tpm:<minuto>, gli stessi
+    letti da /health). Senza Redis i contatori restano locali al processo.
+    """
+
+    def __init__(self, rpm_limit: int, tpm_limit: int):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._local_minute = None
+        self._local_counts = [0, 0]
+
+    async def acquire(self, tokens: int):
+        """Attende finché la richiesta (con i token stimati) rientra nei limiti del minuto"""
+        tokens = min(tokens, self.tpm_limit)
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, tokens)
+            if wait <= 0:
+                return
+            logger.info("OpenAI rate limit reached, waiting %.1fs", wait)
+            await asyncio.sleep(wait)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Prenota richiesta e token nel minuto corrente; ritorna i secondi da attendere (0 = ok)"""
+        now = time.time()
+        minute = time.strftime("%Y%m%d%H%M", time.gmtime(now))
+        wait = 60 - now % 60
+        client = _get_redis()
+
+        if client is None:
+            if self._local_minute != minute:
+                self._local_minute, self._local_counts = minute, [0, 0]
+            rpm, tpm = self._local_counts
+            if rpm + 1 > self.rpm_limit or tpm + tokens > self.tpm_limit:
+                return wait
+            self._local_counts = [rpm + 1, tpm + tokens]
+            return 0
+
+        rpm_key, tpm_key = f"openai:rpm:{minute}", f"openai:tpm:{minute}"
+        try:
+            pipe = client.pipeline()
+            pipe.incr(rpm_key)
+            pipe.incrby(tpm_key, tokens)
+            pipe.expire(rpm_key, 120)
+            pipe.expire(tpm_key, 120)
+            rpm, tpm, _, _ = pipe.execute()
+            if rpm <= self.rpm_limit and tpm <= self.tpm_limit:
+                return 0
+            # Oltre il limite: annulla la prenotazione e attende il minuto successivo
+            pipe = client.pipeline()
+            pipe.decr(rpm_key)
+            pipe.decrby(tpm_key, tokens)
+            pipe.execute()
+            return wait
+        except Exception as e:
+            logger.warning("OpenAI rate limiter unavailable, not throttling: %s", e)
+            return 0
+
+
+# Durate degli header x-ratelimit-reset-* (es. "1s", "6m0s", "20ms")
+_RESET_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_reset_duration(value: str) -> Optional[float]:
+    matches = _RESET_DURATION_RE.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Attesa indicata da OpenAI (retry-after-ms, retry-after o x-ratelimit-reset-*), se presente"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    resets = [
+        _parse_reset_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+# Backoff dei retry OpenAI: base * 2**attempt (max RETRY_MAX_DELAY) più jitter
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_JITTER = 0.5
+
+
+def _compute_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Secondi di attesa prima del retry; il jitter evita che le coroutine riprovino tutte insieme"""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, RETRY_JITTER)
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * (1 + random.uniform(0, RETRY_JITTER))
+
+
+def _is_retryable(error: Exception) -> bool:
+    """429, 5xx, timeout e errori di connessione si riprovano; gli altri 4xx (400, 401, 404...) no"""
+    if isinstance(error, RateLimitError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500
+    return True
+
+
+# Client httpx condiviso per il webhook n8n (usato solo sul loop HTTP).
+# HTTP/2: le umanizzazioni concorrenti condividono una sola connessione TLS
+_HUMANIZE_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+)
 
 class OpenAIService:
     def __init__(self, max_retries: int = 3, request_timeout: int = 200):
         if not settings.openai_api_key:
             raise ValueError("OpenAI API key is required")
         self.prompts_cache: Dict[str, str] = {}  # {name: prompt}
+        # Messaggio di sistema (agent_prompt) costruito una volta per caricamento della cache
+        self._system_msg: Dict[str, str] = {"role": "system", "content": DEFAULT_AGENT_PROMPT}
+        # TTL della cache: scaduta, viene servita la copia corrente e ricaricata in background
+        self._cache_loaded_at: float = 0.0
+        self._cache_ttl = settings.prompts_cache_ttl
+        # Query prompt (e elaborazioni non in cache) in corso: richieste concorrenti uguali attendono la stessa
+        self._prompt_queries: Dict[str, asyncio.Task] = {}
         self.max_retries = max_retries
         self.request_timeout = request_timeout
+        # Ultime risposte per (testo, processing_type, opzioni, prompt): i reinvii identici non richiamano OpenAI.
+        # Valori (scadenza monotonic, testo). La copia su Redis è opzionale (openai_response_cache_shared):
+        # contiene i testi elaborati degli utenti, quindi è disattivata salvo configurazione esplicita
+        self._response_cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+        self._response_cache_size = settings.openai_response_cache_size
+        self._response_cache_ttl = settings.openai_response_cache_ttl
+        self._response_cache_shared = settings.openai_response_cache_shared
+        self.rate_limiter = OpenAIRateLimiter(settings.openai_rpm_limit, settings.openai_tpm_limit)
+        # Client unico: connessioni TLS riusate tra le richieste (retry gestiti qui sotto)
+        self.client = AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            timeout=request_timeout,
+            max_retries=0
+        )
         logger.debug(
             "OpenAIService initialized (max_retries=%s, timeout=%s)",
             max_retries, request_timeout
         )
 
-    async def _fetch_prompts_from_db(self) -> Dict[str, str]:
-        """Fetch all prompts from DB and cache them."""
+    def _read_shared_prompts(self) -> Optional[Dict[str, str]]:
+        client = _get_redis()
+        if client is None:
+            return None
         try:
+            cached = client.get(PROMPTS_REDIS_KEY)
+            return json.loads(cached) if cached else None
+        except Exception as e:
+            logger.warning("Failed to read prompts from Redis: %s", e)
+            return None
+
+    def _write_shared_prompts(self, prompts_dict: Dict[str, str]) -> None:
+        client = _get_redis()
+        if client is None:
+            return
+        try:
+            client.set(PROMPTS_REDIS_KEY, json.dumps(prompts_dict), ex=self._cache_ttl)
+        except Exception as e:
+            logger.warning("Failed to write prompts to Redis: %s", e)
+
+    async def _fetch_prompts_from_db(self, use_shared_cache: bool = True) -> Dict[str, str]:
+        """Fetch all prompts from DB (or the shared Redis copy) and cache them."""
+        try:
+            if use_shared_cache:
+                prompts_dict = await asyncio.to_thread(self._read_shared_prompts)
+                if prompts_dict:
+                    self.prompts_cache = prompts_dict
+                    self._cache_loaded_at = time.monotonic()
+                    self._set_system_message()
+                    logger.info("Cached %d prompts from Redis", len(prompts_dict))
+                    return prompts_dict
+
             logger.info("Fetching prompts from database...")
-            response = supabase_client.table("prompts").select("name, prompt").execute()
+            # Il client Supabase è sincrono: la query gira in un thread per non bloccare il loop
+            response = await asyncio.to_thread(
+                supabase_client.table("prompts").select("name, prompt").execute
+            )
             data = getattr(response, "data", None)
             if not data:
                 logger.warning("No prompts found in database (empty response.data).")
@@ -41,6 +406,9 @@ class OpenAIService:
 
             prompts_dict = {row["name"]: row["prompt"] for row in data}
             self.prompts_cache = prompts_dict
+            self._cache_loaded_at = time.monotonic()
+            self._set_system_message()
+            await asyncio.to_thread(self._write_shared_prompts, prompts_dict)
             logger.info(
                 "Cached %d prompts: %s",
                 len(prompts_dict), list(prompts_dict.keys())
@@ -51,38 +419,80 @@ class OpenAIService:
             logger.exception("Failed to fetch prompts from database: %s", e)
             return {}
 
-    async def _get_prompt(self, prompt_name: str) -> str:
-        """Get a specific prompt by name from cache or DB."""
-        logger.debug("Retrieving prompt name='%s'", prompt_name)
+    def _set_system_message(self) -> None:
+        """Ricostruisce il messaggio di sistema condiviso (sola lettura) dall'agent_prompt in cache"""
+        agent_instructions = self.prompts_cache.get("agent_prompt")
+        if not agent_instructions:
+            logger.warning("agent_prompt not found. Using default fallback instructions.")
+            agent_instructions = DEFAULT_AGENT_PROMPT
+        # Prompt completi solo in debug: stringhe da diversi KB
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("AGENT prompt:\n%s", agent_instructions)
+        self._system_msg = {"role": "system", "content": agent_instructions}
+
+    def _start_query(self, key: str, factory) -> asyncio.Task:
+        """Avvia factory() solo se non c'è già una query in corso per key."""
+        task = self._prompt_queries.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(factory())
+            self._prompt_queries[key] = task
+            task.add_done_callback(lambda _: self._prompt_queries.pop(key, None))
+        return task
 
+    async def _coalesced(self, key: str, factory):
+        """Esegue factory() una sola volta per key tra le richieste concorrenti."""
+        return await asyncio.shield(self._start_query(key, factory))
+
+    async def _fetch_prompts_by_name(self, prompt_names: List[str]) -> None:
+        """Fetch the given prompts with a single query and add them to the cache."""
+        try:
+            logger.debug("Prompts %s not in cache. Querying DB...", prompt_names)
+            response = await asyncio.to_thread(
+                supabase_client.table("prompts").select("name, prompt").in_("name", prompt_names).execute
+            )
+            for row in getattr(response, "data", None) or []:
+                self.prompts_cache[row["name"]] = row["prompt"]
+            if "agent_prompt" in prompt_names:
+                self._set_system_message()
+        except Exception as e:
+            logger.exception("Failed to fetch prompts %s: %s", prompt_names, e)
+
+    async def _get_prompts_bulk(self, prompt_names: List[str]) -> None:
+        """Carica in cache tutti i prompt richiesti con al più una query."""
         if not self.prompts_cache:
             logger.debug("Prompts cache empty. Loading from DB...")
-            await self._fetch_prompts_from_db()
+            await self._coalesced("*", self._fetch_prompts_from_db)
+        elif time.monotonic() - self._cache_loaded_at > self._cache_ttl:
+            # Cache scaduta: la richiesta usa i prompt correnti, il refresh non la blocca
+            self._start_query("*", self._fetch_prompts_from_db)
+
+        missing = sorted({name for name in prompt_names if name and name not in self.prompts_cache})
+        if missing:
+            await self._coalesced("in:" + ",".join(missing), lambda: self._fetch_prompts_by_name(missing))
 
+    def _cached_prompt(self, prompt_name: str) -> str:
+        """Prompt dalla cache, oppure il prompt generico di fallback."""
         if prompt_name in self.prompts_cache:
             logger.debug("Prompt '%s' served from cache", prompt_name)
             return self.prompts_cache[prompt_name]
 
-        try:
-            logger.debug("Prompt '%s' not in cache. Querying DB...", prompt_name)
-            response = supabase_client.table("prompts").select("name, prompt").eq("name", prompt_name).execute()
-            data = getattr(response, "data", None)
-            if data:
-                prompt = data[0]["prompt"]
-                self.prompts_cache[prompt_name] = prompt
-                logger.debug("Prompt '%s' loaded from DB and cached", prompt_name)
-                return prompt
-        except Exception as e:
-            logger.exception("Failed to fetch prompt '%s': %s", prompt_name, e)
-
         fallback = f"Process the following text according to the '{prompt_name}' requirements: {{text}}"
         logger.warning("Prompt '%s' not found. Using fallback.", prompt_name)
         return fallback
 
+    async def _get_prompt(self, prompt_name: str) -> str:
+        """Get a specific prompt by name from cache or DB."""
+        logger.debug("Retrieving prompt name='%s'", prompt_name)
+        await self._get_prompts_bulk([prompt_name])
+        return self._cached_prompt(prompt_name)
+
+    def _mapped_prompt_name(self, processing_type: str) -> str:
+        """Nome del prompt DB per il processing_type (mapping processing_type -> DB name)."""
+        return PROCESSING_TYPE_TO_PROMPT_NAME.get(_processing_key(processing_type), processing_type)
+
     async def _get_mapped_prompt(self, processing_type: str) -> str:
         """Restituisce il prompt corretto usando il mapping processing_type -> DB name."""
-        prompt_name = PROCESSING_TYPE_TO_PROMPT_NAME.get(processing_type.upper(), processing_type)
-        return await self._get_prompt(prompt_name)
+        return await self._get_prompt(self._mapped_prompt_name(processing_type))
 
     async def process_text(
         self,
@@ -91,130 +501,471 @@ class OpenAIService:
         options: Optional[Dict[str, Any]] = None
     ) -> str:
         """Process text using OpenAI with DB-backed prompts, merging tone if provided."""
+        return await _await_in_http_loop(self._process_text(text, processing_type, options))
+
+    async def _process_text(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
         logger.info("=== TEXT PROCESSING START ===")
         logger.info("Processing type: %s | Text length: %d chars", processing_type, len(text))
 
+        if not self._response_cache_size:
+            return await self._process_uncached(text, processing_type, options)
+
+        key = _response_key(
+            text, _processing_key(processing_type), options,
+            await self._prompt_hash(processing_type, options)
+        )
+        cached = self._response_cache.get(key)
+        if cached is not None:
+            expires_at, result = cached
+            if expires_at > time.monotonic():
+                self._response_cache.move_to_end(key)
+                logger.info("=== TEXT PROCESSING SUCCESS (cached response) ===")
+                return result
+            del self._response_cache[key]
+
+        # Richieste identiche concorrenti attendono la stessa chiamata (single-flight)
+        return await self._coalesced(
+            "resp:" + key.hex(), lambda: self._process_and_cache(key, text, processing_type, options)
+        )
+
+    async def _prompt_hash(self, processing_type: str, options: Optional[Dict[str, Any]]) -> str:
+        """Hash dei prompt usati per processing_type e opzioni (vuoto per humanizer, che non usa prompt)"""
+        if _processing_key(processing_type) == "humanizer":
+            return ""
+        prompt_names = [
+            "agent_prompt",
+            self._mapped_prompt_name(processing_type),
+            options.get("tone") if options else None,
+            options.get("template") if options else None,
+        ]
+        # Prompt già in cache nel caso comune: nessuna query
+        await self._get_prompts_bulk(prompt_names)
+        prompts = [self._system_msg["content"]] + [self.prompts_cache.get(name) for name in prompt_names[1:]]
+        payload = json.dumps(prompts).encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+    async def _process_and_cache(
+        self,
+        key: bytes,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]]
+    ) -> str:
+        result = await asyncio.to_thread(self._read_shared_response, key)
+        if result is None:
+            result = await self._process_uncached(text, processing_type, options)
+            await asyncio.to_thread(self._write_shared_response, key, result)
+        else:
+            logger.info("=== TEXT PROCESSING SUCCESS (shared cached response) ===")
+
+        self._response_cache[key] = (time.monotonic() + self._response_cache_ttl, result)
+        if len(self._response_cache) > self._response_cache_size:
+            self._response_cache.popitem(last=False)
+        return result
+
+    def _read_shared_response(self, key: bytes) -> Optional[str]:
+        if not self._response_cache_shared:
+            return None
+        client = _get_redis()
+        if client is None:
+            return None
+        try:
+            return client.get(RESPONSE_REDIS_PREFIX + key.hex())
+        except Exception as e:
+            logger.warning("Failed to read cached response from Redis: %s", e)
+            return None
+
+    def _write_shared_response(self, key: bytes, result: str) -> None:
+        # Su Redis finiscono solo chiave (hash, nessun testo in chiaro) e risultato elaborato
+        if not self._response_cache_shared:
+            return
+        client = _get_redis()
+        if client is None:
+            return
+        try:
+            client.set(RESPONSE_REDIS_PREFIX + key.hex(), result, ex=self._response_cache_ttl)
+        except Exception as e:
+            logger.warning("Failed to write cached response to Redis: %s", e)
+
+    async def _process_uncached(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
         # Se processing_type è humanizer, salta OpenAI e vai direttamente all'umanizzazione
-        if processing_type.upper() == "HUMANIZER":
+        if _processing_key(processing_type) == "humanizer":
             logger.info("=== HUMANIZER MODE: Skipping OpenAI, going directly to humanization ===")
             result = await humanize_text(text, 'medium')
             logger.info("=== TEXT PROCESSING SUCCESS (HUMANIZER) ===")
             return result
 
-        # 1) System instructions (agent_prompt)
-        logger.debug("Loading agent_prompt...")
-        agent_instructions = await self._get_prompt("agent_prompt")
-        if not agent_instructions:
-            logger.warning("agent_prompt not found. Using default fallback instructions.")
-            agent_instructions = (
-                "You are a professional text improvement assistant. Transform the provided text "
-                "according to the given tone or template. Output only the transformed text."
-            )
-        logger.info("AGENT prompt:\n%s", agent_instructions)
+        return await self._complete_text(text, processing_type, options)
+
+    async def _complete_text(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Una richiesta chat per un singolo testo"""
+        messages, max_tokens = await self._build_messages(text, processing_type, options)
+        content = await self._complete(messages, max_tokens)
+        processed_text = _extract_transformed_text(content)
+        logger.info("=== TEXT PROCESSING SUCCESS ===")
+        return processed_text
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]], max_tokens: int) -> int:
+        # Stima token: ~4 caratteri per token in input più il massimo in output
+        return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+    async def _create_completion(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        stream: bool = False,
+        response_format: Optional[Dict[str, str]] = None
+    ):
+        """Chat completion (in streaming solo per _stream_text), dopo aver prenotato il rate limit"""
+        extra = {"response_format": response_format} if response_format else {}
+        await self.rate_limiter.acquire(self._estimate_tokens(messages, max_tokens))
+        # Timeout gestito da httpx: alla scadenza la connessione viene chiusa, non restituita al pool
+        return await self.client.with_options(timeout=self.request_timeout).chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            top_p=1.0,
+            stream=stream,
+            **extra
+        )
+
+    async def _wait_before_retry(self, error: Exception, attempt: int):
+        """Attesa prima del tentativo successivo; all'ultimo tentativo rilancia l'errore"""
+        logger.warning("OpenAI request failed on attempt %d: %s", attempt, error)
+        if not _is_retryable(error):
+            logger.error("OpenAI request rejected, not retrying: %s", error)
+            raise Exception(f"Text processing failed: {error}")
+        if attempt == self.max_retries:
+            logger.error("Max retries reached. Failing...")
+            raise Exception(f"Text processing failed after {self.max_retries} attempts: {error}")
+        # 429: attende quanto indicato da OpenAI; altri errori: backoff esponenziale
+        retry_after = _retry_after_seconds(error) if isinstance(error, RateLimitError) else None
+        sleep_time = _compute_backoff(attempt, retry_after)
+        logger.debug("Retrying in %.2f seconds...", sleep_time)
+        await asyncio.sleep(sleep_time)
+
+    async def _complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        response_format: Optional[Dict[str, str]] = None
+    ) -> str:
+        """Chiamata chat completion con rate limit e retry; ritorna il contenuto della risposta"""
+        # 5) Chiamata OpenAI con retry
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                logger.info("OpenAI API call attempt %d/%d", attempt, self.max_retries)
+
+                response = await self._create_completion(messages, max_tokens, response_format=response_format)
+                content = response.choices[0].message.content or ""
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Raw OpenAI response: %s", content)
+                return content
+
+            except (RateLimitError, APITimeoutError, APIConnectionError, APIError) as e:
+                await self._wait_before_retry(e, attempt)
+
+            except Exception as e:
+                logger.exception("Unexpected error during text processing: %s", e)
+                raise Exception("An unexpected error occurred during text processing.")
+
+    async def process_text_stream(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        """Come process_text, ma restituisce il testo elaborato a frammenti man mano che il modello lo genera"""
+        async for piece in _iterate_in_http_loop(self._stream_text(text, processing_type, options)):
+            yield piece
+
+    async def _stream_text(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        logger.info("=== TEXT STREAMING START ===")
+        logger.info("Processing type: %s | Text length: %d chars", processing_type, len(text))
+
+        if _processing_key(processing_type) == "humanizer":
+            # Il webhook n8n non supporta lo streaming: un unico frammento
+            yield await _humanize_text(text, 'medium')
+            return
+
+        messages, max_tokens = await self._build_messages(text, processing_type, options)
+
+        for attempt in range(1, self.max_retries + 1):
+            # Il retry è possibile solo finché nulla è stato inviato al client
+            started = False
+            text_filter = _TransformedTextFilter()
+            try:
+                logger.info("OpenAI streaming call attempt %d/%d", attempt, self.max_retries)
+
+                stream = await self._create_completion(messages, max_tokens, stream=True)
+                async for chunk in stream:
+                    piece = chunk.choices[0].delta.content if chunk.choices else None
+                    if piece:
+                        piece = text_filter.feed(piece)
+                        if piece:
+                            started = True
+                            yield piece
+                tail = text_filter.flush()
+                if tail:
+                    yield tail
+                logger.info("=== TEXT STREAMING SUCCESS ===")
+                return
+
+            # Gli errori di trasporto durante l'iterazione arrivano da httpx, non dall'SDK
+            except (RateLimitError, APITimeoutError, APIConnectionError, APIError, httpx.TransportError) as e:
+                if started:
+                    logger.error("OpenAI stream interrupted: %s", e)
+                    raise Exception(f"Text processing stream interrupted: {e}")
+                await self._wait_before_retry(e, attempt)
+
+    async def process_text_batch(
+        self,
+        texts: List[str],
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        """
+        Elabora più testi dello stesso chiamante con una sola richiesta chat (stesso prompt);
+        risultati nello stesso ordine. Mai testi di utenti diversi nello stesso prompt.
+        """
+        return await _await_in_http_loop(self._process_text_batch(texts, processing_type, options))
+
+    async def _process_text_batch(
+        self,
+        texts: List[str],
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        logger.info("Processing %d texts in one request (%s)", len(texts), processing_type)
+        messages, _ = await self._build_messages(PACKED_TEXTS_PLACEHOLDER, processing_type, options)
+        user_prompt = messages[1]["content"].replace(PACKED_TEXTS_PLACEHOLDER, "each numbered text below")
+        numbered = "\n".join(f"{i}) <<<{text}>>>" for i, text in enumerate(texts, 1))
+        messages[1] = {
+            "role": "user",
+            "content": (
+                f"{user_prompt}\n\nProcess each text independently and return a JSON object "
+                f'{{"results": [...]}} with exactly {len(texts)} strings: the transformed texts, '
+                f"in the same order.\n{numbered}"
+            ),
+        }
+        max_tokens = min(settings.openai_max_output_tokens, sum(max(500, len(text.split()) * 10) for text in texts))
+
+        content = await self._complete(messages, max_tokens, response_format={"type": "json_object"})
+        try:
+            results = json.loads(content)["results"]
+            if isinstance(results, list) and len(results) == len(texts):
+                logger.info("=== TEXT PROCESSING SUCCESS (%d texts) ===", len(texts))
+                return [_extract_transformed_text(str(result)) for result in results]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        # Risposta non allineata ai testi: si torna a una richiesta per testo
+        logger.warning("Packed response not parseable for %d texts, processing them one by one", len(texts))
+        return list(await asyncio.gather(
+            *(self._complete_text(text, processing_type, options) for text in texts)
+        ))
+
+    async def _build_messages(
+        self,
+        text: str,
+        processing_type: str,
+        options: Optional[Dict[str, Any]] = None
+    ) -> Tuple[List[Dict[str, str]], int]:
+        """Messaggi (system + user) e max_tokens della richiesta chat per il testo"""
+        # 0) Tutti i prompt necessari in una sola query (solo per quelli non in cache)
+        base_prompt_name = self._mapped_prompt_name(processing_type)
+        tone_name = options.get("tone") if options and "tone" in options else None
+        template_name = options.get("template") if options and "template" in options else None
+        await self._get_prompts_bulk(["agent_prompt", base_prompt_name, tone_name, template_name])
 
         # 2) Prompt specifico per l’operazione (processing_type) con mapping
         logger.debug("Loading base prompt for processing_type='%s'...", processing_type)
-        base_prompt = await self._get_mapped_prompt(processing_type)
+        base_prompt = self._cached_prompt(base_prompt_name)
         logger.debug("Base prompt: %s", base_prompt)
 
         # 3) Merge con prompt del tone se presente
         tone_prompt = ""
         if options and "tone" in options:
-            tone_prompt = await self._get_prompt(options["tone"])
+            tone_prompt = self._cached_prompt(tone_name)
             logger.debug("Tone prompt: %s", tone_prompt)
         
         # 3) Merge con prompt del template
         template_prompt = ""
         if options and "template" in options:
-            template_prompt = await self._get_prompt(options["template"])
+            template_prompt = self._cached_prompt(template_name)
             logger.debug("Template prompt: %s", template_prompt)
 
-        # 4) Costruzione prompt finale
-        final_prompt_parts = [part for part in [base_prompt, tone_prompt, template_prompt] if part]
-        prompt = "\n\n".join(final_prompt_parts)
-
-        if "{text}" in prompt or "[text]" in prompt:
-            prompt = prompt.replace("{text}", text).replace("[text]", text)
+        # 4) Costruzione prompt finale (placeholder già individuati per ogni prompt)
+        compiled = [_compile_prompt(part) for part in (base_prompt, tone_prompt, template_prompt) if part]
+        if any(len(segments) > 1 for segments in compiled):
+            parts = [text.join(segments) for segments in compiled]
         else:
             logger.debug("No {text} placeholder found. Appending text at the end.")
-            prompt = f"{prompt}\n\n{text}"
+            parts = [segments[0] for segments in compiled]
+            parts.append(text)
 
-        # Opzioni aggiuntive
+        # Opzioni aggiuntive (una riga ciascuna), unite al prompt con un solo join
+        lines = ["\n\n".join(parts)]
         if options:
-            for key in ["style", "target_audience"]:
-                if key in options:
-                    prompt += f"\n{key.replace('_',' ').title()}: {options[key]}"
+            lines.extend(f"{label}{options[key]}" for key, label in OPTION_LINES if key in options)
+        prompt = "\n".join(lines)
 
-        # 5) Chiamata OpenAI con retry
-        client = AsyncOpenAI(api_key=settings.openai_api_key)
+        messages = [
+            self._system_msg,
+            {"role": "user", "content": prompt}
+        ]
+        return messages, min(settings.openai_max_output_tokens, max(500, len(text.split()) * 10))
 
-        for attempt in range(1, self.max_retries + 1):
-            try:
-                logger.info("OpenAI API call attempt %d/%d", attempt, self.max_retries)
+    async def submit_batch(self, user_id: str, requests: List[Dict[str, Any]]) -> str:
+        """
+        Invia più testi alla Batch API di OpenAI (costo dimezzato, limiti separati
+        dalle chiamate sincrone, completamento entro 24h). Ogni richiesta contiene
+        text, processing_type, options e custom_id (univoco nel batch). Ritorna il batch_id.
+        L'utente proprietario viene salvato nei metadata del batch.
+        """
+        return await _await_in_http_loop(self._submit_batch(user_id, requests))
 
-                response = await asyncio.wait_for(
-                    client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[
-                            {"role": "system", "content": agent_instructions},
-                            {"role": "user", "content": prompt}
-                        ],
-                        max_tokens=max(500, len(text.split()) * 10),
-                        temperature=0.7,
-                        top_p=1.0
-                    ),
-                    timeout=self.request_timeout
-                )
-
-                processed_text = response.choices[0].message.content.strip()
-                logger.debug("Raw OpenAI response: %s", processed_text)
-
-                if "<TRANSFORMED_TEXT>" in processed_text and "</TRANSFORMED_TEXT>" in processed_text:
-                    start_tag = "<TRANSFORMED_TEXT>"
-                    end_tag = "</TRANSFORMED_TEXT>"
-                    start_idx = processed_text.find(start_tag) + len(start_tag)
-                    end_idx = processed_text.find(end_tag)
-                    processed_text = processed_text[start_idx:end_idx].strip()
-
-                logger.info("=== TEXT PROCESSING SUCCESS ===")
-
-                # Ritorno il testo processato
-                return processed_text
-
-            except (RateLimitError, APIError, asyncio.TimeoutError) as e:
-                logger.warning("OpenAI request failed on attempt %d: %s", attempt, e)
-                if attempt == self.max_retries:
-                    logger.error("Max retries reached. Failing...")
-                    raise Exception(f"Text processing failed after {self.max_retries} attempts: {e}")
-                sleep_time = 2 ** attempt
-                logger.debug("Retrying in %d seconds...", sleep_time)
-                await asyncio.sleep(sleep_time)
+    async def _submit_batch(self, user_id: str, requests: List[Dict[str, Any]]) -> str:
+        lines = []
+        for item in requests:
+            processing_type = item["processing_type"]
+            if _processing_key(processing_type) == "humanizer":
+                # L'umanizzazione passa dal webhook n8n, non da OpenAI
+                raise ValueError("HUMANIZER requests cannot be processed with the Batch API")
 
-            except Exception as e:
-                logger.exception("Unexpected error during text processing: %s", e)
-                raise Exception("An unexpected error occurred during text processing.")
+            messages, max_tokens = await self._build_messages(item["text"], processing_type, item.get("options"))
+            lines.append(json.dumps({
+                "custom_id": item["custom_id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4o-mini",
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7,
+                    "top_p": 1.0,
+                },
+            }))
+
+        batch_file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"user_id": str(user_id)}
+        )
+        logger.info("OpenAI batch %s submitted with %d requests", batch.id, len(lines))
+        return batch.id
+
+    async def get_batch_results(self, batch_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Stato del batch e, se completato, i testi elaborati per custom_id (None se falliti).
+        Ritorna None se il batch non esiste o non appartiene a user_id.
+        """
+        return await _await_in_http_loop(self._get_batch_results(batch_id, user_id))
+
+    async def _get_batch_results(self, batch_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            batch = await self.client.batches.retrieve(batch_id)
+        except NotFoundError:
+            return None
+        if (batch.metadata or {}).get("user_id") != str(user_id):
+            logger.warning("Batch %s requested by user %s who does not own it", batch_id, user_id)
+            return None
+
+        counts = batch.request_counts
+        result = {
+            "batch_id": batch.id,
+            "status": batch.status,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "total": counts.total if counts else 0,
+            "results": None,
+        }
+        if batch.status not in BATCH_FINAL_STATUSES:
+            return result
+
+        results: Dict[str, Optional[str]] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                response = row.get("response") or {}
+                if response.get("status_code") == 200:
+                    message = response["body"]["choices"][0]["message"]["content"]
+                    results[row["custom_id"]] = _extract_transformed_text(message)
+                else:
+                    logger.warning("Batch %s request %s failed: %s", batch_id, row.get("custom_id"), row.get("error"))
+                    results[row["custom_id"]] = None
+
+        result["results"] = results
+        return result
+
+    async def aclose(self):
+        """Chiude i client HTTP condivisi (shutdown dell'applicazione)"""
+        if _http_loop is None:
+            return
+        await _await_in_http_loop(self._aclose())
+
+    async def _aclose(self):
+        await self.client.close()
+        await _HUMANIZE_HTTP.aclose()
 
     async def get_available_prompts(self) -> Dict[str, str]:
+        # La cache e le query in corso appartengono al loop HTTP
+        return await _await_in_http_loop(self._get_available_prompts())
+
+    async def _get_available_prompts(self) -> Dict[str, str]:
         logger.debug("Retrieving available prompts for frontend")
         if not self.prompts_cache:
-            await self._fetch_prompts_from_db()
-        return self.prompts_cache
+            await self._coalesced("*", self._fetch_prompts_from_db)
+        # Copia: il refresh in background può sostituire la cache durante l'iterazione
+        return dict(self.prompts_cache)
 
     async def refresh_prompts_cache(self) -> bool:
         logger.info("Refreshing prompts cache manually...")
         try:
-            await self._fetch_prompts_from_db()
+            await _await_in_http_loop(self._fetch_prompts_from_db(use_shared_cache=False))
             logger.info("Prompts cache refreshed successfully.")
             return True
         except Exception as e:
             logger.exception("Failed to refresh prompts cache: %s", e)
             return False
 
-    async def get_text_analysis(self, text: str) -> Dict[str, Any]:
+    def get_text_analysis(self, text: str) -> Dict[str, Any]:
         logger.debug("Performing text analysis...")
         word_count = len(text.split())
         char_count = len(text)
-        sentence_count = len([s for s in text.split('.') if s.strip()])
+        # finditer: nessuna lista di frasi allocata, solo il conteggio
+        sentence_count = sum(1 for _ in SENTENCE_RE.finditer(text))
         return {
             "word_count": word_count,
             "character_count": char_count,
@@ -223,9 +974,13 @@ class OpenAIService:
         }
 
 async def humanize_text(text: str, intensity: str):
+    return await _await_in_http_loop(_humanize_text(text, intensity))
+
+
+async def _humanize_text(text: str, intensity: str):
     try:
-        logger.info(f"=== STARTING HUMANIZE_TEXT ===")
-        logger.info(f"Text length: {len(text)} chars, Intensity: {intensity}")
+        logger.info("=== STARTING HUMANIZE_TEXT ===")
+        logger.info("Text length: %s chars, Intensity: %s", len(text), intensity)
 
         # Preparo il JSON per n8n
         humanize_data = {
@@ -234,24 +989,23 @@ async def humanize_text(text: str, intensity: str):
         }
 
         logger.info("Sending POST request to n8n webhook...")
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://agentonesrl.app.n8n.cloud/webhook/humanize",
-                json=humanize_data
-            )
+        response = await _HUMANIZE_HTTP.post(HUMANIZE_WEBHOOK_URL, json=humanize_data)
 
-        logger.info(f"=== n8n response received - Status: {response.status_code} ===")
-        logger.info(f"=== TESTO DA N8N: {response.json()} ===")
+        logger.info("=== n8n response received - Status: %s ===", response.status_code)
 
         if response.status_code >= 400:
-            logger.warning(f"n8n responded with {response.status_code}")
+            logger.warning("n8n responded with %s", response.status_code)
             raise HTTPException(
                 status_code=response.status_code,
                 detail=f"n8n webhook failed with status {response.status_code}"
             )
 
+        response_data = response.json()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("=== TESTO DA N8N: %s ===", response_data)
+
         logger.info("Successfully received humanized text from n8n webhook")
-        humanized_result = response.json().get("humanizedText")
+        humanized_result = response_data.get("humanizedText")
 
         if not humanized_result:
             logger.error("n8n response missing 'humanizedText' field")
@@ -260,13 +1014,13 @@ async def humanize_text(text: str, intensity: str):
                 detail="Invalid response from humanization service"
             )
 
-        logger.info(f"Humanized text length: {len(humanized_result)} chars")
+        logger.info("Humanized text length: %s chars", len(humanized_result))
         return humanized_result
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error creating humanized text: {str(e)}")
+        logger.error("Error creating humanized text: %s", e)
         
         raise HTTPException(
             status_code=500, 
@@ -274,5 +1028,11 @@ async def humanize_text(text: str, intensity: str):
         )
 
 
+@lru_cache(maxsize=None)
+def get_openai_service() -> OpenAIService:
+    """Ritorna l'istanza condivisa del servizio OpenAI (creata alla prima richiesta)"""
+    return OpenAIService()
+
+
 # Global service instance
-openai_service = OpenAIService()
+openai_service = get_openai_service()
@@ -1,6 +1,10 @@
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 import logging
+import threading
+import time
+from functools import lru_cache
 from uuid import UUID
 
 from app.core.supabase_client import supabase_client
@@ -8,11 +12,29 @@ from postgrest import APIError
 
 logger = logging.getLogger(__name__)
 
+# Cache analytics (stale-while-revalidate): oltre il soft TTL si serve la copia e la si
+# ricarica in background, oltre l'hard TTL si ricarica in modo sincrono
+ANALYTICS_SOFT_TTL = 60
+ANALYTICS_HARD_TTL = 600
+
+# Colonne di user_subscriptions restituite ai chiamanti (senza metadata, che può pesare KB)
+SUBSCRIPTION_COLUMNS = (
+    "id, user_id, email, plan_type, status, start_date, end_date, last_payment_date, "
+    "amount_paid, currency, stripe_customer_id, stripe_payment_intent_id, created_at"
+)
+
 class SupabasePaymentService:
     """Service per gestire pagamenti con Supabase"""
     
     def __init__(self):
         self.client = supabase_client  # Usa admin client per operazioni privilegiate
+        self._analytics_cache: Dict[int, Tuple[float, Dict]] = {}  # {days: (caricato_il, analytics)}
+        self._analytics_refreshing = set()
+        self._analytics_lock = threading.Lock()
+    
+    async def _execute(self, query):
+        """Esegue la query PostgREST (client sincrono) in un thread, senza bloccare l'event loop"""
+        return await asyncio.to_thread(query.execute)
     
     async def create_payment_intent_record(
         self, 
@@ -42,19 +64,19 @@ class SupabasePaymentService:
                 'processing_status': 'pending'
             }
             
-            response = self.client.table('payment_intents').insert(data).execute()
+            response = await self._execute(self.client.table('payment_intents').insert(data))
             
             if response.data:
-                logger.info(f"Payment intent record created: {stripe_payment_intent_id}")
+                logger.info("Payment intent record created: %s", stripe_payment_intent_id)
                 return response.data[0]
             else:
                 raise Exception("No data returned from insert")
                 
         except APIError as e:
-            logger.error(f"Error creating payment intent record: {e}")
+            logger.error("Error creating payment intent record: %s", e)
             raise e
         except Exception as e:
-            logger.error(f"Unexpected error creating payment intent record: {e}")
+            logger.error("Unexpected error creating payment intent record: %s", e)
             raise e
     
     async def update_payment_intent_status(
@@ -74,21 +96,20 @@ class SupabasePaymentService:
             if completed_at:
                 update_data['completed_at'] = completed_at.isoformat()
             elif status == 'succeeded':
-                update_data['completed_at'] = datetime.utcnow().isoformat()
+                update_data['completed_at'] = datetime.now(timezone.utc).isoformat()
             
-            response = self.client.table('payment_intents')\
-                .update(update_data)\
-                .eq('stripe_payment_intent_id', stripe_payment_intent_id)\
-                .execute()
+            response = await self._execute(self.client.table('payment_intents')
+                .update(update_data)
+                .eq('stripe_payment_intent_id', stripe_payment_intent_id))
             
-            logger.info(f"Payment intent status updated: {stripe_payment_intent_id} -> {status}")
+            logger.info("Payment intent status updated: %s -> %s", stripe_payment_intent_id, status)
             return True
             
         except APIError as e:
-            logger.error(f"Error updating payment intent status: {e}")
+            logger.error("Error updating payment intent status: %s", e)
             return False
         except Exception as e:
-            logger.error(f"Unexpected error updating payment intent: {e}")
+            logger.error("Unexpected error updating payment intent: %s", e)
             return False
     
     async def create_or_update_subscription(
@@ -110,9 +131,12 @@ class SupabasePaymentService:
             if not email:
                 raise ValueError("Email is required")
             
+            # Un solo istante per tutti i timestamp del record
+            now = datetime.now(timezone.utc)
+            
             # Calcola le date se non fornite
             if not start_date:
-                start_date = datetime.utcnow()
+                start_date = now
             
             if not end_date:
                 if plan_type == "yearly":
@@ -120,12 +144,6 @@ class SupabasePaymentService:
                 else:  # monthly
                     end_date = start_date + timedelta(days=30)
             
-            # Controlla se esiste già una subscription attiva
-            existing_response = self.client.table("user_subscriptions")\
-                .select("*")\
-                .eq("email", email)\
-                .execute()
-            
             subscription_data = {
                 "email": email,
                 "stripe_customer_id": stripe_customer_id,
@@ -134,7 +152,7 @@ class SupabasePaymentService:
                 "status": status,
                 "start_date": start_date.isoformat(),
                 "end_date": end_date.isoformat(),
-                "last_payment_date": datetime.utcnow().isoformat(),
+                "last_payment_date": now.isoformat(),
                 "amount_paid": amount_paid,
                 "currency": currency,
                 "metadata": metadata or {},
@@ -145,87 +163,107 @@ class SupabasePaymentService:
             if user_id:
                 subscription_data["user_id"] = str(user_id)
             
-            # Se esiste una subscription attiva
-            if existing_response.data:
-                existing_sub = existing_response.data[0]
-                logger.info(f"User Exists")
-                if existing_sub["plan_type"] != plan_type:
-                    logger.info(f"Insert new record")
-                    # Upgrade/downgrade → cancella la vecchia e crea nuova
-                    await self._cancel_subscription(existing_sub["id"])
-                    response = self.client.table("user_subscriptions")\
-                        .insert(subscription_data)\
-                        .execute()
-                else:
-                    logger.info(f"Update")
-                    # Aggiorna la subscription esistente
-                    response = self.client.table("user_subscriptions")\
-                        .update(subscription_data)\
-                        .eq("id", existing_sub["id"])\
-                        .execute()
-            else:
-                logger.info(f"Inserisco il record perche non esiste")
-                # Nessuna subscription attiva → crea nuova
-                response = self.client.table("user_subscriptions")\
-                    .insert(subscription_data)\
-                    .execute()
-            
-            if not response.data:
-                raise Exception("No data returned from subscription operation")
-            
-            subscription = response.data[0]
-
-            # Aggiorna sempre l'utente a "premium" se ha una subscription attiva
-            self.client.table("users")\
-                .update({"subscription_tier": "premium"})\
-                .eq("email", email)\
-                .execute()
-            
-            logger.info(f"Subscription created/updated for {email} - Plan: {plan_type}")
+            try:
+                # Check, cancellazione al cambio piano, insert/update e tier utente in una transazione
+                response = await self._execute(self.client.rpc('upsert_subscription', {
+                    'p_email': email,
+                    'p_data': subscription_data
+                }))
+                subscription = response.data[0] if isinstance(response.data, list) else response.data
+                if not subscription:
+                    raise Exception("No data returned from subscription operation")
+            except APIError as rpc_error:
+                logger.warning("upsert_subscription not available, updating step by step: %s", rpc_error)
+                subscription = await self._upsert_subscription_rows(email, plan_type, subscription_data)
+            
+            logger.info("Subscription created/updated for %s - Plan: %s", email, plan_type)
             return subscription
 
         except APIError as e:
-            logger.error(f"Error creating/updating subscription: {e}")
+            logger.error("Error creating/updating subscription: %s", e)
             raise e
         except Exception as e:
-            logger.error(f"Unexpected error with subscription: {e}")
+            logger.error("Unexpected error with subscription: %s", e)
             raise e
 
     
+    async def _upsert_subscription_rows(self, email: str, plan_type: str, subscription_data: Dict) -> Dict:
+        """Fallback di upsert_subscription: stesse operazioni con query separate"""
+        # Controlla se esiste già una subscription attiva
+        existing_response = await self._execute(self.client.table("user_subscriptions")
+            .select("id, plan_type")
+            .eq("email", email)
+            .eq("status", "active")
+            .limit(1))
+        
+        # Se esiste una subscription attiva
+        if existing_response.data:
+            existing_sub = existing_response.data[0]
+            logger.info("User Exists")
+            if existing_sub["plan_type"] != plan_type:
+                logger.info("Insert new record")
+                # Upgrade/downgrade → cancella la vecchia e crea nuova (righe diverse: in parallelo)
+                _, response = await asyncio.gather(
+                    self._cancel_subscription(existing_sub["id"]),
+                    self._execute(self.client.table("user_subscriptions")
+                        .insert(subscription_data))
+                )
+            else:
+                logger.info("Update")
+                # Aggiorna la subscription esistente
+                response = await self._execute(self.client.table("user_subscriptions")
+                    .update(subscription_data)
+                    .eq("id", existing_sub["id"]))
+        else:
+            logger.info("Inserisco il record perche non esiste")
+            # Nessuna subscription attiva → crea nuova
+            response = await self._execute(self.client.table("user_subscriptions")
+                .insert(subscription_data))
+        
+        if not response.data:
+            raise Exception("No data returned from subscription operation")
+        
+        subscription = response.data[0]
+
+        # Aggiorna sempre l'utente a "premium" se ha una subscription attiva
+        await self._execute(self.client.table("users")
+            .update({"subscription_tier": "premium"})
+            .eq("email", email))
+        
+        return subscription
+
     async def _cancel_subscription(self, subscription_id: str) -> bool:
         """Cancella una subscription"""
         try:
-            response = self.client.table('user_subscriptions')\
+            response = await self._execute(self.client.table('user_subscriptions')
                 .update({
                     'status': 'canceled',
-                    'canceled_at': datetime.utcnow().isoformat()
-                })\
-                .eq('id', subscription_id)\
-                .execute()
+                    'canceled_at': datetime.now(timezone.utc).isoformat()
+                })
+                .eq('id', subscription_id))
             
             return True
         except Exception as e:
-            logger.error(f"Error canceling subscription {subscription_id}: {e}")
+            logger.error("Error canceling subscription %s: %s", subscription_id, e)
             return False
     
     async def get_user_subscription(self, email: str) -> Optional[Dict]:
         """Ottiene la subscription attiva di un utente"""
         try:
-            response = self.client.table('user_subscriptions')\
-                .select('*')\
-                .eq('email', email)\
-                .eq('status', 'active')\
-                .gte('end_date', datetime.utcnow().isoformat())\
-                .order('created_at', desc=True)\
-                .limit(1)\
-                .execute()
+            response = await self._execute(self.client.table('user_subscriptions')
+                .select(SUBSCRIPTION_COLUMNS)
+                .eq('email', email)
+                .eq('status', 'active')
+                .gte('end_date', datetime.now(timezone.utc).isoformat())
+                .order('created_at', desc=True)
+                .limit(1))
             
             if response.data:
                 return response.data[0]
             return None
             
         except APIError as e:
-            logger.error(f"Error getting user subscription: {e}")
+            logger.error("Error getting user subscription: %s", e)
             return None
     
     async def log_webhook_event(
@@ -246,16 +284,27 @@ class SupabasePaymentService:
                 'processing_status': 'pending'
             }
             
-            response = self.client.table('stripe_webhook_events')\
-                .insert(data)\
-                .execute()
+            # Stripe ripete lo stesso evento se non riceve subito un 2xx: i duplicati vengono ignorati
+            response = await self._execute(self.client.table('stripe_webhook_events')
+                .upsert(data, on_conflict='stripe_event_id', ignore_duplicates=True))
             
             if response.data:
-                logger.info(f"Webhook event logged: {stripe_event_id}")
+                logger.info("Webhook event logged: %s", stripe_event_id)
+                # Il payload completo può essere grande: lo serializzo solo in debug
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Webhook event %s payload: %s", event_type, event_data)
                 return response.data[0]
             
+            # Evento già registrato: restituisce il record esistente
+            logger.info("Webhook event already logged: %s", stripe_event_id)
+            existing = await self._execute(self.client.table('stripe_webhook_events')
+                .select('*')
+                .eq('stripe_event_id', stripe_event_id)
+                .limit(1))
+            return existing.data[0] if existing.data else None
+            
         except APIError as e:
-            logger.error(f"Error logging webhook event: {e}")
+            logger.error("Error logging webhook event: %s", e)
             raise e
     
     async def mark_webhook_processed(
@@ -269,30 +318,58 @@ class SupabasePaymentService:
             update_data = {
                 'processed': success,
                 'processing_status': 'completed' if success else 'failed',
-                'processed_at': datetime.utcnow().isoformat()
+                'processed_at': datetime.now(timezone.utc).isoformat()
             }
             
             if error_message:
                 update_data['error_message'] = error_message
             
-            response = self.client.table('stripe_webhook_events')\
-                .update(update_data)\
-                .eq('stripe_event_id', stripe_event_id)\
-                .execute()
+            # Gli eventi già completati non vengono riscritti (l'UPDATE non trova righe)
+            response = await self._execute(self.client.table('stripe_webhook_events')
+                .update(update_data, returning='minimal')
+                .eq('stripe_event_id', stripe_event_id)
+                .neq('processing_status', 'completed'))
             
             return True
             
         except Exception as e:
-            logger.error(f"Error marking webhook as processed: {e}")
+            logger.error("Error marking webhook as processed: %s", e)
             return False
     
     async def get_payment_analytics(self, days: int = 30) -> Dict:
-        """Ottiene analytics sui pagamenti"""
+        """Ottiene analytics sui pagamenti (dalla cache per days, se recente)"""
+        cached = self._analytics_cache.get(days)
+        if cached:
+            age = time.monotonic() - cached[0]
+            if age < ANALYTICS_HARD_TTL:
+                if age > ANALYTICS_SOFT_TTL:
+                    self._refresh_analytics_in_background(days)
+                return dict(cached[1])
+        return await asyncio.to_thread(self._load_payment_analytics, days)
+
+    def _refresh_analytics_in_background(self, days: int):
+        """Ricarica le analytics in un thread (una sola ricarica alla volta per days)"""
+        with self._analytics_lock:
+            if days in self._analytics_refreshing:
+                return
+            self._analytics_refreshing.add(days)
+
+        def refresh():
+            try:
+                self._load_payment_analytics(days)
+            finally:
+                with self._analytics_lock:
+                    self._analytics_refreshing.discard(days)
+
+        threading.Thread(target=refresh, name="payment-analytics-refresh", daemon=True).start()
+
+    def _load_payment_analytics(self, days: int) -> Dict:
+        """Legge la vista payment_dashboard, calcola i totali e aggiorna la cache"""
         try:
             # Usa la vista che abbiamo creato
             response = self.client.table('payment_dashboard')\
                 .select('*')\
-                .gte('payment_date', (datetime.utcnow() - timedelta(days=days)).date())\
+                .gte('payment_date', (datetime.now(timezone.utc) - timedelta(days=days)).date())\
                 .execute()
             
             if response.data:
@@ -301,74 +378,72 @@ class SupabasePaymentService:
                 total_payments = sum(row['total_payments'] for row in response.data)
                 total_successful = sum(row['successful_payments'] for row in response.data)
                 
-                return {
+                analytics = {
                     'total_revenue': total_revenue,
                     'total_payments': total_payments,
                     'successful_payments': total_successful,
                     'success_rate': (total_successful / total_payments * 100) if total_payments > 0 else 0,
                     'daily_data': response.data
                 }
+            else:
+                analytics = {
+                    'total_revenue': 0,
+                    'total_payments': 0,
+                    'successful_payments': 0,
+                    'success_rate': 0,
+                    'daily_data': []
+                }
             
-            return {
-                'total_revenue': 0,
-                'total_payments': 0,
-                'successful_payments': 0,
-                'success_rate': 0,
-                'daily_data': []
-            }
+            self._analytics_cache[days] = (time.monotonic(), analytics)
+            return dict(analytics)
             
         except Exception as e:
-            logger.error(f"Error getting payment analytics: {e}")
+            logger.error("Error getting payment analytics: %s", e)
             return {}
     
     async def get_expiring_subscriptions(self, days_ahead: int = 7) -> List[Dict]:
         """Ottiene subscription che scadono presto"""
         try:
-            cutoff_date = (datetime.utcnow() + timedelta(days=days_ahead)).isoformat()
+            cutoff_date = (datetime.now(timezone.utc) + timedelta(days=days_ahead)).isoformat()
             
-            response = self.client.table('user_subscriptions')\
-                .select('*')\
-                .eq('status', 'active')\
-                .lte('end_date', cutoff_date)\
-                .execute()
+            response = await self._execute(self.client.table('user_subscriptions')
+                .select('id, email, plan_type, end_date')
+                .eq('status', 'active')
+                .lte('end_date', cutoff_date))
             
             return response.data or []
             
         except Exception as e:
-            logger.error(f"Error getting expiring subscriptions: {e}")
+            logger.error("Error getting expiring subscriptions: %s", e)
             return []
     
     async def cleanup_old_failed_payment_intents(self, days: int = 60) -> int:
         """Pulisce vecchi payment intent non completati"""
         try:
-            cutoff_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
+            cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
             
-            # Prima ottieni i record da eliminare
-            response = self.client.table('payment_intents')\
-                .select('id')\
-                .neq('status', 'succeeded')\
-                .lt('created_at', cutoff_date)\
-                .execute()
+            # Un solo DELETE filtrato: nessuna SELECT preventiva né lista di id da inviare.
+            # return=minimal + count=exact: PostgREST restituisce solo il numero di righe eliminate
+            response = await self._execute(self.client.table('payment_intents')
+                .delete(count='exact', returning='minimal')
+                .neq('status', 'succeeded')
+                .lt('created_at', cutoff_date))
             
-            if not response.data:
-                return 0
-            
-            # Elimina i record
-            ids_to_delete = [record['id'] for record in response.data]
-            
-            delete_response = self.client.table('payment_intents')\
-                .delete()\
-                .in_('id', ids_to_delete)\
-                .execute()
-            
-            deleted_count = len(response.data)
-            logger.info(f"Cleaned up {deleted_count} old payment intents")
+            deleted_count = response.count or 0
+            if deleted_count:
+                logger.info("Cleaned up %s old payment intents", deleted_count)
             
             return deleted_count
             
         except Exception as e:
-            logger.error(f"Error cleaning up payment intents: {e}")
+            logger.error("Error cleaning up payment intents: %s", e)
             return 0
 
+@lru_cache(maxsize=None)
+def get_payment_service() -> SupabasePaymentService:
+    """Ritorna l'istanza condivisa del service pagamenti"""
+    return SupabasePaymentService()
+
+
 # Istanza globale del service
-payment_service = SupabasePaymentService()
\ No newline at end of file
+payment_service = get_payment_service()
\ No newline at end of file
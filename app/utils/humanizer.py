@@ -1,11 +1,85 @@
 import random
 import re
 from collections import Counter, deque
+from itertools import islice
 from dataclasses import dataclass
 from typing import Dict, List, Tuple, Optional
 from abc import ABC, abstractmethod
 import math
 
+# Punteggiatura rimossa dalle parole prima dei confronti con i dizionari
+WORD_STRIP_CHARS = '.,!?;:()[]{}'
+TRAILING_PUNCTUATION = frozenset('.,!?;:')
+
+# Pattern precompilati: evitano il parsing delle regex a ogni chiamata
+SENTENCE_SPLIT_RE = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s')
+SENTENCE_SPLIT_ADVANCED_RE = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s+')
+PERSONAL_PRONOUN_RE = re.compile(r'\b(I|my|our)\b')
+
+NOMINAL_PHRASE_PATTERNS = tuple(
+    (re.compile(pattern), replacement) for pattern, replacement in (
+        (r'The implementation of ([a-z\s]+)', r'\1 application'),
+        (r'The optimization of ([a-z\s]+)', r'Optimizing \1'),
+        (r'The development of ([a-z\s]+)', r'Developing \1'),
+        (r'The establishment of ([a-z\s]+)', r'Establishing \1'),
+        (r'The integration of ([a-z\s]+)', r'Integrating \1'),
+        (r'The utilization of ([a-z\s]+)', r'Using \1'),
+    )
+)
+
+HUMAN_IMPERFECTION_PATTERNS = tuple(
+    (re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in (
+        (r'to achieve (\w+) performance', r'in their efforts to maximize \1'),
+        (r'to achieve optimal', r'working towards best'),
+        (r'while maintaining (\w+) standards', r'amidst keeping \1 standards intact'),
+        (r'(\w+) numerous industries', r'\1 world of various industries'),
+        (r'for automated decisions', r'for decisions made independently'),
+        (r'throughout the (\w+) process', r'during \1'),
+    )
+)
+
+WHITESPACE_RE = re.compile(r'\s+')
+SPACE_BEFORE_PUNCT_RE = re.compile(r'\s+([.,!?;:])')
+DASH_RE = re.compile(r'[\s\xa0\u00A0]*[\u2014\u2013\u2012\u2015—–-]{1,3}[\s\xa0\u00A0]*')
+# Parole composte spezzate dalla rimozione dei trattini: una sola alternanza, chiave senza separatori
+COMPOUND_WORDS = {
+    compound.replace('-', ''): compound for compound in (
+        'decision-making', 'well-being', 'long-term', 'real-time',
+        'short-term', 'high-quality', 'low-cost', 'full-time',
+        'part-time', 'state-of-the-art', 'up-to-date'
+    )
+}
+COMPOUND_WORD_RE = re.compile(
+    r'\b(?:' + '|'.join(compound.replace('-', r',\s*') for compound in COMPOUND_WORDS.values()) + r')\b',
+    re.IGNORECASE
+)
+COMPOUND_SEPARATOR_RE = re.compile(r',\s*')
+DOUBLE_CONNECTOR_RE = re.compile(
+    r'\b(So|But|Well|Now|Also|Plus),\s+(So|But|Well|Now|Also|Plus)\b', re.IGNORECASE
+)
+RESIDUAL_AI_RE = re.compile(r'\b(?:Subsequently|Furthermore|Moreover),?\s+', re.IGNORECASE)
+PUNCTUATION_FIXES = tuple(
+    (re.compile(pattern), replacement) for pattern, replacement in (
+        (r'\.\s*,\s*', '. '),
+        (r',\s+\.', '.'),
+        (r',\s*,+', ','),
+        (r'\.\.+', '.'),
+    )
+)
+SENTENCE_BOUNDARY_RE = re.compile(r'([.!?]\s+)')
+
+AI_DETECTION_PATTERNS = tuple(
+    (re.compile(pattern, re.IGNORECASE), penalty, description) for pattern, penalty, description in (
+        (r'\b(furthermore|moreover|additionally|consequently|subsequently)\b', -4, "Formal transitions"),
+        (r'\bIt is important to note that\b', -5, "AI opening phrase"),
+        (r'\b(comprehensive|robust|leverage|utilize|facilitate)\b', -2, "AI vocabulary"),
+        (r'\.\s+The\s+', -1, "Monotonous sentence starts"),
+        (r',\s+(making|being|term)\b', -3, "Broken compound words"),
+        (r'\b(So|But|Also),\s+(So|But|Also)\b', -4, "Double connectors"),
+        (r'The \w+ of', -0.5, "Nominal phrase pattern"),
+    )
+)
+
 @dataclass
 class TextAnalysis:
     """Analisi completa dello stile del testo"""
@@ -146,15 +220,30 @@ class TextAnalyzer:
         ]
         
         self.human_indicators_patterns = [
-            r'[!]{1,3}', r'[?]', r'[\U0001F600-\U0001F64F]',
-            r'\b(I\'m|I\'ve|I\'ll|can\'t|won\'t|don\'t)\b',
-            r'\b(my|our|we|us)\b',
+            re.compile(pattern) for pattern in (
+                r'[!]{1,3}', r'[?]', r'[\U0001F600-\U0001F64F]',
+                r'\b(I\'m|I\'ve|I\'ll|can\'t|won\'t|don\'t)\b',
+                r'\b(my|our|we|us)\b',
+            )
+        ]
+        self._casual_indicator_res = [
+            re.compile(r'\b' + re.escape(indicator) + r'\b') for indicator in self.casual_indicators
         ]
+        self._formal_set = frozenset(self.formal_indicators)
+        self._technical_set = frozenset(self.technical_indicators)
+        self._casual_set = frozenset(self.casual_indicators)
     
     def analyze(self, text: str) -> TextAnalysis:
+        return self.analyze_with_sentences(text)[0]
+    
+    def analyze_with_sentences(self, text: str) -> Tuple[TextAnalysis, List[str]]:
+        """Analizza il testo e restituisce anche le frasi già divise, così chi le usa non ripete lo split"""
         sentences = self._split_sentences(text)
-        words = text.split()
-        words_clean = [w.lower().strip('.,!?;:()[]{}') for w in words if w.strip()]
+        # lower() solo se serve: la maggior parte delle parole è già minuscola
+        words_clean = [
+            w.strip(WORD_STRIP_CHARS) if w.islower() else w.lower().strip(WORD_STRIP_CHARS)
+            for w in text.split()
+        ]
         
         word_count = len(words_clean)
         sentence_count = len(sentences)
@@ -165,19 +254,20 @@ class TextAnalyzer:
         complex_words = [w for w in words_clean if len(w) > 12]
         vocabulary_complexity = len(complex_words) / word_count if word_count > 0 else 0
         
-        formal_count = sum(1 for word in words_clean if word in self.formal_indicators)
-        casual_count = sum(1 for word in words_clean if word in self.casual_indicators)
+        formal_count = sum(1 for word in words_clean if word in self._formal_set)
+        casual_count = sum(1 for word in words_clean if word in self._casual_set)
         formality_score = min(10, max(0, (formal_count / sentence_count * 30) - (casual_count / sentence_count * 20)))
         
-        technical_count = sum(1 for word in words_clean if word in self.technical_indicators)
+        technical_count = sum(1 for word in words_clean if word in self._technical_set)
         technical_score = min(10, (technical_count / sentence_count) * 40 + vocabulary_complexity * 30)
         
         target_tone = self._determine_tone(formality_score, technical_score, casual_count)
         is_already_human = self._is_already_human(text, formality_score, casual_count)
-        existing_colloquial = sum(1 for indicator in self.casual_indicators 
-                                 if re.search(r'\b' + re.escape(indicator) + r'\b', text.lower()))
+        text_lower = text.lower()
+        existing_colloquial = sum(1 for indicator_re in self._casual_indicator_res
+                                 if indicator_re.search(text_lower))
         
-        return TextAnalysis(
+        analysis = TextAnalysis(
             formality_score=formality_score,
             technical_score=technical_score,
             avg_sentence_length=avg_sentence_length,
@@ -190,22 +280,23 @@ class TextAnalyzer:
             is_already_human=is_already_human,
             existing_colloquial_count=existing_colloquial
         )
+        return analysis, sentences
     
     def _is_already_human(self, text: str, formality_score: float, casual_count: int) -> bool:
         human_score = 0
         for pattern in self.human_indicators_patterns:
-            if re.search(pattern, text):
+            if pattern.search(text):
                 human_score += 1
         if formality_score < 4:
             human_score += 1
         if casual_count >= 3:
             human_score += 1
-        if re.search(r'\b(I|my|our)\b', text):
+        if PERSONAL_PRONOUN_RE.search(text):
             human_score += 1
         return human_score >= 3
     
     def _split_sentences(self, text: str) -> List[str]:
-        sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s', text)
+        sentences = SENTENCE_SPLIT_RE.split(text)
         return [s.strip() for s in sentences if s.strip()]
     
     def _determine_tone(self, formality: float, technicality: float, casual_count: int) -> str:
@@ -227,6 +318,14 @@ class ModificationEngine:
         self.lang = language_processor
         self.recently_used = deque(maxlen=50)
         self.used_in_current_text = set()
+        self.synonyms = language_processor.get_synonyms()
+        # Tutte le frasi AI in un'unica alternanza: il gruppo g<i> indica quale pattern ha fatto match
+        phrase_patterns = language_processor.get_phrase_patterns()
+        self.ai_phrase_replacements = list(phrase_patterns.values())
+        self.ai_phrase_re = re.compile(
+            '|'.join(f'(?P<g{i}>{pattern})' for i, pattern in enumerate(phrase_patterns)),
+            re.IGNORECASE
+        )
         
     def reset_current_text_tracking(self):
         self.used_in_current_text.clear()
@@ -255,23 +354,16 @@ class ModificationEngine:
     
     def replace_ai_phrases(self, text: str) -> str:
         """Sostituisce frasi tipicamente AI"""
-        for pattern, replacements in self.lang.get_phrase_patterns().items():
-            text = re.sub(pattern, lambda m: random.choice(replacements) if replacements else "", text, flags=re.IGNORECASE)
-        return text
+        return self.ai_phrase_re.sub(self._replace_ai_phrase, text)
+    
+    def _replace_ai_phrase(self, match: re.Match) -> str:
+        replacements = self.ai_phrase_replacements[int(match.lastgroup[1:])]
+        return random.choice(replacements) if replacements else ""
     
     def restructure_nominal_phrases(self, text: str) -> str:
         """NUOVO: Trasforma frasi nominali in verbali"""
-        patterns = {
-            r'The implementation of ([a-z\s]+)': r'\1 application',
-            r'The optimization of ([a-z\s]+)': r'Optimizing \1',
-            r'The development of ([a-z\s]+)': r'Developing \1',
-            r'The establishment of ([a-z\s]+)': r'Establishing \1',
-            r'The integration of ([a-z\s]+)': r'Integrating \1',
-            r'The utilization of ([a-z\s]+)': r'Using \1',
-        }
-        
-        for pattern, replacement in patterns.items():
-            text = re.sub(pattern, replacement, text)
+        for pattern, replacement in NOMINAL_PHRASE_PATTERNS:
+            text = pattern.sub(replacement, text)
         
         return text
     
@@ -301,31 +393,24 @@ class ModificationEngine:
     
     def add_human_imperfections(self, text: str) -> str:
         """NUOVO: Aggiunge costruzioni leggermente awkward ma umane"""
-        patterns = {
-            r'to achieve (\w+) performance': r'in their efforts to maximize \1',
-            r'to achieve optimal': r'working towards best',
-            r'while maintaining (\w+) standards': r'amidst keeping \1 standards intact',
-            r'(\w+) numerous industries': r'\1 world of various industries',
-            r'for automated decisions': r'for decisions made independently',
-            r'throughout the (\w+) process': r'during \1',
-        }
-        
-        for pattern, replacement in patterns.items():
+        for pattern, replacement in HUMAN_IMPERFECTION_PATTERNS:
             if random.random() < 0.6:  # 60% probabilità
-                text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
+                text = pattern.sub(replacement, text)
         
         return text
     
     def replace_synonyms_contextual(self, text: str, config: ModificationConfig, formality_level: str) -> str:
         """Sostituisce parole con sinonimi contestuali"""
         words = text.split()
-        synonyms_dict = self.lang.get_synonyms()
+        synonyms_dict = self.synonyms
+        recently_used = self.recently_used
         
         for i, word in enumerate(words):
-            word_clean = word.lower().strip('.,!?;:()[]{}')
+            word_clean = word.strip(WORD_STRIP_CHARS) if word.islower() else word.lower().strip(WORD_STRIP_CHARS)
             
             if word_clean in synonyms_dict and random.random() < config.synonym_replacement:
-                if word_clean in list(self.recently_used)[-5:]:
+                # Ultimi 5 usati, senza copiare l'intera deque
+                if word_clean in islice(reversed(recently_used), 5):
                     continue
                 
                 synonym = self._choose_best_synonym(
@@ -337,17 +422,18 @@ class ModificationEngine:
                 if word[0].isupper():
                     synonym = synonym.capitalize()
                 
-                punctuation = ''.join(c for c in word if c in '.,!?;:')
+                punctuation = ''.join(c for c in word if c in TRAILING_PUNCTUATION)
                 words[i] = synonym + punctuation
-                self.recently_used.append(word_clean)
+                recently_used.append(word_clean)
         
         return ' '.join(words)
     
     def _choose_best_synonym(self, word: str, synonyms: List[str], formality: str) -> str:
         """Sceglie il sinonimo migliore"""
         scored = []
+        middle_idx = len(synonyms) // 2
         
-        for syn in synonyms:
+        for idx, syn in enumerate(synonyms):
             score = 0
             
             # Preferisci sinonimi più corti e naturali
@@ -358,8 +444,7 @@ class ModificationEngine:
                 score += 10
             
             # Preferisci sinonimi nel mezzo della lista
-            middle_idx = len(synonyms) // 2
-            distance_from_middle = abs(synonyms.index(syn) - middle_idx)
+            distance_from_middle = abs(idx - middle_idx)
             score += (10 - distance_from_middle)
             
             scored.append((syn, score))
@@ -371,7 +456,7 @@ class ModificationEngine:
         """Split avanzato delle frasi"""
         if not isinstance(text, str) or not text.strip():
             return []
-        sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s+', text)
+        sentences = SENTENCE_SPLIT_ADVANCED_RE.split(text)
         return [s.strip() for s in sentences if s and s.strip()]
 
 class Humanizer:
@@ -404,7 +489,7 @@ class Humanizer:
             }
         
         self.modifier.reset_current_text_tracking()
-        analysis = self.analyzer.analyze(text)
+        analysis, original_sentences = self.analyzer.analyze_with_sentences(text)
         base_config = self.modifier.get_config_for_tone(analysis.target_tone, analysis.is_already_human)
         
         if analysis.is_already_human:
@@ -445,7 +530,7 @@ class Humanizer:
             print(f"Error during humanization: {e}")
             modified_text = text
         
-        quality_metrics = self._calculate_quality_metrics(text, modified_text)
+        quality_metrics = self._calculate_quality_metrics(text, modified_text, analysis, original_sentences)
         
         return {
             'original': text,
@@ -472,26 +557,19 @@ class Humanizer:
     def _intelligent_cleanup(self, text: str) -> str:
         """Pulizia intelligente del testo"""
         # Fix spazi
-        text = re.sub(r'\s+', ' ', text)
-        text = re.sub(r'\s+([.,!?;:])', r'\1', text)
+        text = WHITESPACE_RE.sub(' ', text)
+        text = SPACE_BEFORE_PUNCT_RE.sub(r'\1', text)
         
         # Rimuovi em-dash
-        text = re.sub(r'[\s\xa0\u00A0]*[\u2014\u2013\u2012\u2015—–-]{1,3}[\s\xa0\u00A0]*', ', ', text)
+        text = DASH_RE.sub(', ', text)
         
         # Ripristina parole composte con trattino
-        compound_words = [
-            'decision-making', 'well-being', 'long-term', 'real-time',
-            'short-term', 'high-quality', 'low-cost', 'full-time',
-            'part-time', 'state-of-the-art', 'up-to-date'
-        ]
-        
-        for compound in compound_words:
-            broken = compound.replace('-', ',\s*')
-            text = re.sub(r'\b' + broken + r'\b', compound, text, flags=re.IGNORECASE)
+        text = COMPOUND_WORD_RE.sub(
+            lambda m: COMPOUND_WORDS[COMPOUND_SEPARATOR_RE.sub('', m.group(0)).lower()], text
+        )
         
         # Rimuovi connettori doppi
-        text = re.sub(r'\b(So|But|Well|Now|Also|Plus),\s+(So|But|Well|Now|Also|Plus)\b', 
-                     r'\1', text, flags=re.IGNORECASE)
+        text = DOUBLE_CONNECTOR_RE.sub(r'\1', text)
         
         # Fix capitalizzazione random in mezzo alle frasi
         words = text.split()
@@ -504,21 +582,17 @@ class Humanizer:
         text = ' '.join(words)
         
         # Rimuovi pattern AI residui
-        text = re.sub(r'\bSubsequently,?\s+', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'\bFurthermore,?\s+', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'\bMoreover,?\s+', '', text, flags=re.IGNORECASE)
+        text = RESIDUAL_AI_RE.sub('', text)
         
         # Fix punteggiatura
-        text = re.sub(r'\.\s*,\s*', '. ', text)
-        text = re.sub(r',\s+\.', '.', text)
-        text = re.sub(r',\s*,+', ',', text)
-        text = re.sub(r'\.\.+', '.', text)
+        for pattern, replacement in PUNCTUATION_FIXES:
+            text = pattern.sub(replacement, text)
         
         # Rimuovi spazi doppi
-        text = re.sub(r'\s+', ' ', text)
+        text = WHITESPACE_RE.sub(' ', text)
         
         # Fix capitalizzazione inizio frasi
-        sentences = re.split(r'([.!?]\s+)', text)
+        sentences = SENTENCE_BOUNDARY_RE.split(text)
         for i in range(len(sentences)):
             if sentences[i] and len(sentences[i]) > 0 and sentences[i][0].isalpha():
                 sentences[i] = sentences[i][0].upper() + sentences[i][1:]
@@ -530,7 +604,13 @@ class Humanizer:
         
         return text.strip()
     
-    def _calculate_quality_metrics(self, original: str, modified: str) -> Dict:
+    def _calculate_quality_metrics(
+        self,
+        original: str,
+        modified: str,
+        orig_analysis: Optional[TextAnalysis] = None,
+        orig_sentences: Optional[List[str]] = None
+    ) -> Dict:
         """Calcola metriche di qualità dell'umanizzazione"""
         if not isinstance(original, str):
             original = str(original) if original else ""
@@ -548,16 +628,15 @@ class Humanizer:
                 'readability_maintained': True
             }
 
-        orig_analysis = self.analyzer.analyze(original)
-        mod_analysis = self.analyzer.analyze(modified)
+        # L'analisi del testo originale arriva già da humanize: la ricalcolo solo se manca
+        if orig_analysis is None or orig_sentences is None:
+            orig_analysis, orig_sentences = self.analyzer.analyze_with_sentences(original)
+        mod_analysis, mod_sentences = self.analyzer.analyze_with_sentences(modified)
         
         orig_words = set(original.lower().split())
         mod_words = set(modified.lower().split())
         vocabulary_change = len(mod_words - orig_words) / len(orig_words) if orig_words else 0
         
-        orig_sentences = self.analyzer._split_sentences(original)
-        mod_sentences = self.analyzer._split_sentences(modified)
-        
         orig_lengths = [len(s.split()) for s in orig_sentences]
         mod_lengths = [len(s.split()) for s in mod_sentences]
         
@@ -608,18 +687,8 @@ class HumanizerEvaluator:
         score = 100.0
         issues = []
         
-        ai_patterns = [
-            (r'\b(furthermore|moreover|additionally|consequently|subsequently)\b', -4, "Formal transitions"),
-            (r'\bIt is important to note that\b', -5, "AI opening phrase"),
-            (r'\b(comprehensive|robust|leverage|utilize|facilitate)\b', -2, "AI vocabulary"),
-            (r'\.\s+The\s+', -1, "Monotonous sentence starts"),
-            (r',\s+(making|being|term)\b', -3, "Broken compound words"),
-            (r'\b(So|But|Also),\s+(So|But|Also)\b', -4, "Double connectors"),
-            (r'The \w+ of', -0.5, "Nominal phrase pattern"),
-        ]
-        
-        for pattern, penalty, description in ai_patterns:
-            matches = len(re.findall(pattern, text, re.IGNORECASE))
+        for pattern, penalty, description in AI_DETECTION_PATTERNS:
+            matches = len(pattern.findall(text))
             if matches > 0:
                 score += penalty * matches
                 issues.append(f"{description}: {matches} occurrences")
@@ -1,4 +1,5 @@
 from celery import current_task
+from celery.signals import worker_process_shutdown
 import asyncio
 import logging
 from datetime import datetime, timedelta, date, timezone
@@ -15,7 +16,7 @@ from app.core.supabase_client import supabase_client
 from app.core.report_generator import ReportGenerator
 import asyncio
 # Import EmailService class invece delle funzioni
-from app.services.email_service import EmailService
+from app.services.email_service import get_email_service, refresh_email_statistics, retry_failed_emails_from_database, close_email_queue_writer
 import logging
 import os
 from app.core.logging import SupabaseAPILogger
@@ -53,29 +54,62 @@ def setup_analytics_logger():
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Crea istanza globale del servizio email
-email_service = EmailService()
+# Istanza condivisa del servizio email
+email_service = get_email_service()
+
+@worker_process_shutdown.connect
+def flush_email_queue_on_shutdown(**kwargs):
+    """
+    I processi figli escono con os._exit (riciclo per worker_max_tasks_per_child,
+    SIGTERM, deploy) senza eseguire gli handler atexit: scrive qui i record
+    di email_queue ancora in coda
+    """
+    close_email_queue_writer()
 
 # Crea istanza del Logger
 api_logger = SupabaseAPILogger(supabase_client)
 
+def record_text_analysis_start(task_id: str, user_id: str, text: str):
+    """Registra in text_analyses l'elaborazione appena avviata (session_id = task_id)"""
+    text_analyses_data = {
+        'user_id': user_id,
+        'session_id': task_id,
+        'text_content': text,
+        'text_length': len(str(text)),
+        'text_word_count': len(text.split()),
+        'status': 'processing',
+        'created_at': datetime.utcnow().isoformat(),
+        'is_ai_generated': True,
+        'confidence_score': 100
+    }
+    supabase_client.table('text_analyses').insert(text_analyses_data).execute()
+
+def record_text_analysis_completed(task_id: str, processed_text: str, processing_type: str, processing_time_ms):
+    """Aggiorna text_analyses con il testo elaborato"""
+    update_data_text_analyses = {
+        'processed_text_word_count': len(processed_text.split()),
+        'processed_text': processed_text,
+        'processed_text_lenght': len(str(processed_text)),
+        'status': 'completed',
+        'processing_time_ms': processing_time_ms,
+        'processing_type': processing_type
+    }
+    supabase_client.table("text_analyses").update(update_data_text_analyses).eq("session_id", task_id).execute()
+
+def record_text_analysis_failed(task_id: str, error: str):
+    """Segna in text_analyses l'elaborazione come fallita"""
+    update_data_text_analyses = {
+        'status': 'failed',
+        'error_text': f"Error: {error}"
+    }
+    supabase_client.table("text_analyses").update(update_data_text_analyses).eq("session_id", task_id).execute()
+
 @celery_app.task(bind=True, name="process_text", acks_late=True)
 def process_text_task(self, text: str, processing_type: str, user_id: str, options: dict = None):
     task_id = self.request.id
     try:
         # Log the text analyst 
-        text_analyses_data = {
-            'user_id': user_id,
-            'session_id': task_id,
-            'text_content': text,
-            'text_length': len(str(text)),
-            'text_word_count': len(text.split()),
-            'status': 'processing',
-            'created_at': datetime.utcnow().isoformat(),
-            'is_ai_generated': True,
-            'confidence_score': 100
-        }        
-        result = supabase_client.table('text_analyses').insert(text_analyses_data).execute()
+        record_text_analysis_start(task_id, user_id, text)
         
         logger.info(f"Starting text processing task {task_id} for user {user_id}")
 
@@ -109,15 +143,7 @@ def process_text_task(self, text: str, processing_type: str, user_id: str, optio
         # Update the text analyst
         processing_time_ms = ( datetime.utcnow() - datetime.fromisoformat(self.request.eta or datetime.utcnow().isoformat())
                             ) if self.request.eta else 0
-        update_data_text_analyses = {
-            'processed_text_word_count': processed_word_count,
-            'processed_text': processed_text,
-            'processed_text_lenght': len(str(processed_text)),
-            'status': 'completed',
-            'processing_time_ms': processing_time_ms,
-            'processing_type': processing_type
-        }
-        supabase_client.table("text_analyses").update(update_data_text_analyses).eq("session_id", task_id).execute()
+        record_text_analysis_completed(task_id, processed_text, processing_type, processing_time_ms)
         
         result = {
             "status": "completed",
@@ -137,11 +163,7 @@ def process_text_task(self, text: str, processing_type: str, user_id: str, optio
         return result
 
     except Exception as exc:
-        update_data_text_analyses = {
-            'status': 'failed',
-            'error_text': f"Error: {str(exc)}"
-        }
-        supabase_client.table("text_analyses").update(update_data_text_analyses).eq("session_id", task_id).execute()
+        record_text_analysis_failed(task_id, str(exc))
         
         logger.error(f"Task {task_id} failed: {str(exc)}")
         self.update_state(
@@ -578,10 +600,32 @@ def send_expiring_subscription_notification_task(self, notification_data: Dict):
 @celery_app.task(bind=True, name="handle_webhook_event_task", acks_late=True)
 def handle_webhook_event_task(self, event_data: Dict):
     """Task per gestire eventi webhook - delega tutto a task separate"""
+    stripe_event_id = event_data.get('id')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
         event_type = event_data.get('type')
         logger.info(f"Processing webhook event: {event_type}")
         
+        # Stripe ripete gli eventi non confermati: quelli già completati non vengono rielaborati.
+        # Il log è best effort (richiede sql/stripe_webhook_events_unique.sql): se fallisce
+        # l'evento viene comunque elaborato, un pagamento non resta bloccato dal logging
+        try:
+            webhook_event = loop.run_until_complete(
+                payment_service.log_webhook_event(
+                    stripe_event_id=stripe_event_id,
+                    event_type=event_type,
+                    event_data=event_data,
+                    celery_task_id=self.request.id
+                )
+            )
+        except Exception as log_error:
+            logger.warning("Could not log webhook event %s, processing anyway: %s", stripe_event_id, log_error)
+            webhook_event = None
+        if webhook_event and webhook_event.get('processing_status') == 'completed':
+            logger.info("Webhook event %s already processed, skipping", stripe_event_id)
+            return {'success': True, 'processed': event_type, 'duplicate': True}
+        
         if event_type == 'payment_intent.succeeded':
             invoice_obj = event_data['data']['object']
 
@@ -637,11 +681,18 @@ def handle_webhook_event_task(self, event_data: Dict):
                     priority=7
                 )
 
+        loop.run_until_complete(payment_service.mark_webhook_processed(stripe_event_id))
+        
         return {'success': True, 'processed': event_type}
 
     except Exception as e:
         logger.error(f"Error handling webhook event: {str(e)}")
+        loop.run_until_complete(
+            payment_service.mark_webhook_processed(stripe_event_id, success=False, error_message=str(e))
+        )
         raise self.retry(exc=e)
+    finally:
+        loop.close()
 
 @celery_app.task(bind=True, name="update_payment_analytics_task", acks_late=True)
 def update_payment_analytics_task(self, analytics_data: Dict):
@@ -1297,6 +1348,22 @@ def cleanup_tables_task(self):
         logger.error(f"Error in cleanup task: {str(e)}")
         raise self.retry(exc=e)
 
+@celery_app.task(bind=True, name="refresh_email_stats_task", acks_late=True)
+def refresh_email_stats_task(self):
+    """Task periodico per aggiornare la vista materializzata delle statistiche email"""
+    if not refresh_email_statistics():
+        raise self.retry(countdown=300)
+    return {'status': 'refreshed', 'timestamp': datetime.utcnow().isoformat()}
+
+@celery_app.task(bind=True, name="retry_failed_emails_task", acks_late=True)
+def retry_failed_emails_task(self, limit: int = 50):
+    """Task periodico per ritentare l'invio delle email fallite"""
+    try:
+        return retry_failed_emails_from_database(limit)
+    except Exception as e:
+        logger.error(f"Error in retry_failed_emails_task: {str(e)}")
+        raise self.retry(exc=e)
+
 @celery_app.task(bind=True, name="process_free_user_deletions", max_retries=3, default_retry_delay=60, acks_late=True)
 def process_free_user_deletions(self):
     """
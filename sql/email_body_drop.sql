@@ -0,0 +1,21 @@
+-- 📦 Rimozione di email_body: i corpi tornano inline in email_queue
+-- I corpi sono personalizzati (nomi, link, token): la deduplica per hash non
+-- trovava quasi mai duplicati e le righe orfane non venivano mai eliminate.
+-- Idempotente: non fa nulla se email_body.sql non era stato applicato.
+
+DO $$
+BEGIN
+    IF to_regclass('email_body') IS NOT NULL THEN
+        UPDATE email_queue q SET
+            html_body = b.html_body,
+            text_body = b.text_body
+        FROM email_body b
+        WHERE q.body_hash = b.hash
+          AND q.html_body IS NULL;
+    END IF;
+END;
+$$;
+
+DROP VIEW IF EXISTS email_queue_with_body;
+ALTER TABLE email_queue DROP COLUMN IF EXISTS body_hash;
+DROP TABLE IF EXISTS email_body;
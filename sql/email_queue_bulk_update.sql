@@ -0,0 +1,27 @@
+-- 📧 Update parziali di email_queue in un solo round-trip
+-- Usata dal writer in background per tutti i cambi di stato (sent, failed,
+-- retry): ogni elemento di updates contiene l'id e solo le colonne da
+-- modificare, i corpi delle email non vengono riscritti.
+
+CREATE OR REPLACE FUNCTION email_queue_bulk_update(updates jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    updated integer;
+BEGIN
+    UPDATE email_queue q SET
+        status = CASE WHEN u ? 'status' THEN u->>'status' ELSE q.status END,
+        sent_at = CASE WHEN u ? 'sent_at' THEN (u->>'sent_at')::timestamptz ELSE q.sent_at END,
+        processing_time_ms = CASE WHEN u ? 'processing_time_ms' THEN (u->>'processing_time_ms')::integer ELSE q.processing_time_ms END,
+        failed_at = CASE WHEN u ? 'failed_at' THEN (u->>'failed_at')::timestamptz ELSE q.failed_at END,
+        error_message = CASE WHEN u ? 'error_message' THEN u->>'error_message' ELSE q.error_message END,
+        retry_count = CASE WHEN u ? 'retry_count' THEN (u->>'retry_count')::integer ELSE q.retry_count END,
+        next_retry_at = CASE WHEN u ? 'next_retry_at' THEN (u->>'next_retry_at')::timestamptz ELSE q.next_retry_at END
+    FROM jsonb_array_elements(updates) AS u
+    WHERE q.id::text = u->>'id';
+
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$;
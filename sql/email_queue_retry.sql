@@ -0,0 +1,6 @@
+-- 🔁 Indice parziale per get_failed_emails_for_retry
+-- Copre il filtro status = 'failed' e l'ordinamento per next_retry_at.
+
+CREATE INDEX IF NOT EXISTS email_queue_retry_idx
+    ON email_queue (next_retry_at, retry_count)
+    WHERE status = 'failed';
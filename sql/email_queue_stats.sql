@@ -0,0 +1,16 @@
+-- 📊 Aggregazione lato server della coda email per get_email_statistics
+-- Restituisce una riga per (email_type, status) invece di tutte le email della finestra.
+
+CREATE INDEX IF NOT EXISTS email_queue_created_at_idx
+    ON email_queue (created_at);
+
+CREATE OR REPLACE FUNCTION email_queue_stats(since timestamptz)
+RETURNS TABLE (email_type text, status text, n bigint)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT email_type, status, count(*)
+    FROM email_queue
+    WHERE created_at >= since
+    GROUP BY 1, 2;
+$$;
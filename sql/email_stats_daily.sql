@@ -0,0 +1,25 @@
+-- 📊 Pre-aggregazione giornaliera della coda email per get_email_statistics
+-- Il costo della query diventa indipendente dal volume di email_queue:
+-- si sommano al massimo (giorni x email_type x status) righe.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS email_stats_daily AS
+SELECT
+    date_trunc('day', created_at) AS d,
+    email_type,
+    status,
+    count(*) AS c
+FROM email_queue
+GROUP BY 1, 2, 3;
+
+-- Indice univoco richiesto da REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS email_stats_daily_d_type_status_idx
+    ON email_stats_daily (d, email_type, status);
+
+-- Refresh richiamabile via RPC dal worker (refresh_email_stats_task, ogni ora)
+CREATE OR REPLACE FUNCTION refresh_email_stats_daily()
+RETURNS void
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    REFRESH MATERIALIZED VIEW CONCURRENTLY email_stats_daily;
+$$;
@@ -0,0 +1,5 @@
+-- 💳 Rimozione della RPC payment_analytics_summary
+-- get_payment_analytics restituisce sempre daily_data: la funzione non aveva chiamanti.
+-- Idempotente: non fa nulla se payment_analytics_summary.sql non era stato applicato.
+
+DROP FUNCTION IF EXISTS payment_analytics_summary(integer);
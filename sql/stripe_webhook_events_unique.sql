@@ -0,0 +1,33 @@
+-- 💳 Idempotenza dei webhook Stripe
+-- log_webhook_event usa upsert(on_conflict='stripe_event_id', ignore_duplicates=True):
+-- serve un vincolo unico su stripe_event_id.
+-- Da applicare prima del deploy di handle_webhook_event_task: senza l'indice
+-- l'upsert fallisce e l'evento viene elaborato senza deduplica (solo un warning).
+-- Prima della creazione dell'indice vengono rimossi i duplicati già registrati
+-- (una riga per evento: quella completata, altrimenti la più recente).
+
+BEGIN;
+
+LOCK TABLE stripe_webhook_events IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM stripe_webhook_events
+WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT
+            ctid,
+            row_number() OVER (
+                PARTITION BY stripe_event_id
+                ORDER BY (processing_status = 'completed') DESC NULLS LAST,
+                         processed_at DESC NULLS LAST,
+                         ctid DESC
+            ) AS rn
+        FROM stripe_webhook_events
+        WHERE stripe_event_id IS NOT NULL
+    ) ranked
+    WHERE rn > 1
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS stripe_webhook_events_event_id_key
+    ON stripe_webhook_events (stripe_event_id);
+
+COMMIT;
@@ -0,0 +1,69 @@
+-- 💳 Creazione/aggiornamento subscription in un solo round-trip
+-- Usata da SupabasePaymentService.create_or_update_subscription: controllo della
+-- subscription esistente, cancellazione della vecchia al cambio piano,
+-- insert/update e passaggio dell'utente a premium nella stessa transazione.
+-- p_data contiene le colonne di user_subscriptions (user_id opzionale).
+
+CREATE OR REPLACE FUNCTION upsert_subscription(p_email text, p_data jsonb)
+RETURNS user_subscriptions
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    r user_subscriptions := jsonb_populate_record(NULL::user_subscriptions, p_data);
+    existing user_subscriptions;
+    has_existing boolean;
+    result user_subscriptions;
+BEGIN
+    -- Serializza i webhook concorrenti dello stesso utente (niente doppi insert)
+    PERFORM pg_advisory_xact_lock(hashtext(p_email));
+
+    SELECT * INTO existing
+    FROM user_subscriptions
+    WHERE email = p_email AND status = 'active'
+    ORDER BY created_at DESC
+    LIMIT 1
+    FOR UPDATE;
+    has_existing := FOUND;
+
+    IF has_existing AND existing.plan_type IS NOT DISTINCT FROM r.plan_type THEN
+        UPDATE user_subscriptions SET
+            user_id = COALESCE(r.user_id, user_subscriptions.user_id),
+            stripe_customer_id = r.stripe_customer_id,
+            stripe_payment_intent_id = r.stripe_payment_intent_id,
+            plan_type = r.plan_type,
+            status = r.status,
+            start_date = r.start_date,
+            end_date = r.end_date,
+            last_payment_date = r.last_payment_date,
+            amount_paid = r.amount_paid,
+            currency = r.currency,
+            metadata = r.metadata,
+            expiring_mail_sent = r.expiring_mail_sent,
+            expired_mail_sent = r.expired_mail_sent
+        WHERE id = existing.id
+        RETURNING * INTO result;
+    ELSE
+        -- Upgrade/downgrade: la vecchia subscription viene cancellata
+        IF has_existing THEN
+            UPDATE user_subscriptions
+            SET status = 'canceled', canceled_at = now()
+            WHERE id = existing.id;
+        END IF;
+
+        INSERT INTO user_subscriptions (
+            email, user_id, stripe_customer_id, stripe_payment_intent_id, plan_type,
+            status, start_date, end_date, last_payment_date, amount_paid, currency,
+            metadata, expiring_mail_sent, expired_mail_sent
+        ) VALUES (
+            p_email, r.user_id, r.stripe_customer_id, r.stripe_payment_intent_id, r.plan_type,
+            r.status, r.start_date, r.end_date, r.last_payment_date, r.amount_paid, r.currency,
+            r.metadata, r.expiring_mail_sent, r.expired_mail_sent
+        )
+        RETURNING * INTO result;
+    END IF;
+
+    UPDATE users SET subscription_tier = 'premium' WHERE email = p_email;
+
+    RETURN result;
+END;
+$$;
@@ -0,0 +1,12 @@
+-- 💳 Indici parziali sulle subscription attive
+-- get_user_subscription / upsert_subscription: email + status='active', ordinate per end_date/created_at
+-- get_expiring_subscriptions: status='active' AND end_date <= cutoff
+-- CONCURRENTLY: da eseguire fuori da una transazione (non blocca le scritture)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_subs_active
+    ON user_subscriptions (email, end_date DESC, created_at DESC)
+    WHERE status = 'active';
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_subs_active_end_date
+    ON user_subscriptions (end_date)
+    WHERE status = 'active';
@@ -0,0 +1,8 @@
+import os
+
+# Le impostazioni vengono lette all'import di app.core.config: valori fittizi
+# per i servizi esterni (nei test i client vengono sostituiti da mock)
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "header.payload.signature")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
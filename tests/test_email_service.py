@@ -0,0 +1,91 @@
+import email
+import email.policy
+import unittest
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from app.services import email_service as email_module
+from app.services.email_service import EmailQueueWriter, EmailService
+
+
+class BuildRawMessageTest(unittest.TestCase):
+    """Serializzazione dei messaggi inviati via SMTP"""
+
+    def setUp(self):
+        self.service = EmailService()
+
+    def test_non_ascii_subject(self):
+        subject = "✅ Pagamento confermato - Abbonamento è attivo ⚠️"
+        raw = self.service._build_raw_message(
+            "cliente@example.com",
+            subject,
+            "<p>Ciao è</p>",
+            "Ciao è"
+        )
+
+        # Righe terminate da CRLF, header codificati in ASCII
+        self.assertEqual(raw.count(b"\n"), raw.count(b"\r\n"))
+        raw.decode("ascii")
+
+        parsed = email.message_from_bytes(raw, policy=email.policy.default)
+        self.assertEqual(parsed["Subject"], subject)
+        self.assertEqual(parsed.get_body(("plain",)).get_content().strip(), "Ciao è")
+        self.assertEqual(parsed.get_body(("html",)).get_content().strip(), "<p>Ciao è</p>")
+
+
+class EmailQueueWriterTest(unittest.TestCase):
+    """Scrittura raggruppata di insert e update su email_queue"""
+
+    def setUp(self):
+        self.supabase = MagicMock()
+        patcher = patch.object(email_module, "supabase_client", self.supabase)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = EmailQueueWriter()
+
+    def test_inserts_and_updates_are_written_in_one_round_trip_each(self):
+        self.supabase.table.return_value.insert.return_value.execute.return_value = SimpleNamespace(
+            data=[{'id': 'id-1'}, {'id': 'id-2'}]
+        )
+        first, second = Future(), Future()
+        row = {'recipient_email': 'a@example.com', 'html_body': '<p>corpo</p>', 'status': 'pending'}
+
+        self.writer._flush([
+            ('insert', row, first),
+            ('insert', dict(row), second),
+            ('update', first, {'status': 'failed', 'retry_count': 0}),
+            ('update', first, {'status': 'sent'}),
+            ('update', 'id-9', {'status': 'sent'}),
+        ])
+
+        self.assertEqual((first.result(), second.result()), ('id-1', 'id-2'))
+        self.supabase.table.return_value.insert.assert_called_once()
+        self.supabase.rpc.assert_called_once_with('email_queue_bulk_update', {'updates': [
+            # Più update dello stesso record fusi; solo le colonne modificate, mai i corpi
+            {'id': 'id-1', 'status': 'sent', 'retry_count': 0},
+            {'id': 'id-9', 'status': 'sent'},
+        ]})
+
+    def test_failed_insert_resolves_futures_with_none(self):
+        self.supabase.table.return_value.insert.return_value.execute.side_effect = Exception("db down")
+        future = Future()
+
+        self.writer._flush([('insert', {'status': 'pending'}, future), ('update', future, {'status': 'sent'})])
+
+        self.assertIsNone(future.result())
+        self.supabase.rpc.assert_not_called()
+
+    def test_updates_fall_back_to_single_rows_without_the_rpc(self):
+        self.supabase.rpc.return_value.execute.side_effect = Exception("function not found")
+
+        self.writer._flush([('update', 'id-1', {'status': 'sent'}), ('update', 'id-2', {'status': 'failed'})])
+
+        table = self.supabase.table.return_value
+        self.assertEqual(table.update.call_count, 2)
+        table.update.assert_any_call({'status': 'sent'})
+        table.update.return_value.eq.assert_any_call('id', 'id-2')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+from openai import NotFoundError
+
+from app.services import openai_service as service_module
+from app.services.openai_service import (
+    OpenAIRateLimiter,
+    OpenAIService,
+    RETRY_JITTER,
+    RETRY_MAX_DELAY,
+    _compute_backoff,
+    _retry_after_seconds,
+)
+
+
+def _error_with_headers(headers):
+    return SimpleNamespace(response=SimpleNamespace(headers=headers))
+
+
+class RetryTimingTest(unittest.TestCase):
+    """Attesa tra i retry OpenAI"""
+
+    def test_retry_after_ms_has_priority(self):
+        error = _error_with_headers({"retry-after-ms": "1500", "retry-after": "9"})
+        self.assertEqual(_retry_after_seconds(error), 1.5)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(_retry_after_seconds(_error_with_headers({"retry-after": "4"})), 4.0)
+
+    def test_rate_limit_reset_headers_use_the_longest(self):
+        error = _error_with_headers({
+            "x-ratelimit-reset-requests": "20ms",
+            "x-ratelimit-reset-tokens": "6m0s",
+        })
+        self.assertEqual(_retry_after_seconds(error), 360.0)
+
+    def test_no_hint(self):
+        self.assertIsNone(_retry_after_seconds(_error_with_headers({})))
+        self.assertIsNone(_retry_after_seconds(Exception("no response")))
+
+    def test_backoff_uses_retry_after_plus_jitter(self):
+        for _ in range(50):
+            delay = _compute_backoff(1, retry_after=2.0)
+            self.assertGreaterEqual(delay, 2.0)
+            self.assertLessEqual(delay, 2.0 + RETRY_JITTER)
+
+    def test_backoff_is_exponential_and_capped(self):
+        for _ in range(50):
+            self.assertGreaterEqual(_compute_backoff(2), 4.0)
+            self.assertLessEqual(_compute_backoff(2), 4.0 * (1 + RETRY_JITTER))
+            self.assertLessEqual(_compute_backoff(20), RETRY_MAX_DELAY * (1 + RETRY_JITTER))
+
+
+class RateLimiterLocalTest(unittest.TestCase):
+    """Contatori locali del rate limiter quando Redis non è disponibile"""
+
+    def setUp(self):
+        patcher = patch.object(service_module, "_get_redis", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(service_module.time, "time", return_value=1_699_999_990.0)
+    def test_rpm_limit(self, _):
+        limiter = OpenAIRateLimiter(rpm_limit=2, tpm_limit=1000)
+        self.assertEqual(limiter._try_acquire(10), 0)
+        self.assertEqual(limiter._try_acquire(10), 0)
+        # Terza richiesta nello stesso minuto: attende l'inizio del minuto successivo
+        self.assertAlmostEqual(limiter._try_acquire(10), 50.0)
+
+    @patch.object(service_module.time, "time", return_value=1_699_999_990.0)
+    def test_tpm_limit(self, _):
+        limiter = OpenAIRateLimiter(rpm_limit=10, tpm_limit=100)
+        self.assertEqual(limiter._try_acquire(80), 0)
+        self.assertGreater(limiter._try_acquire(30), 0)
+        # Una richiesta rifiutata non consuma il budget
+        self.assertEqual(limiter._try_acquire(20), 0)
+
+    def test_counters_reset_every_minute(self):
+        limiter = OpenAIRateLimiter(rpm_limit=1, tpm_limit=1000)
+        with patch.object(service_module.time, "time", return_value=1_699_999_990.0):
+            self.assertEqual(limiter._try_acquire(1), 0)
+            self.assertGreater(limiter._try_acquire(1), 0)
+        with patch.object(service_module.time, "time", return_value=1_700_000_050.0):
+            self.assertEqual(limiter._try_acquire(1), 0)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """Cache LRU/TTL delle risposte e single-flight delle richieste identiche"""
+
+    def setUp(self):
+        self.service = OpenAIService()
+        self.service._response_cache_size = 2
+        self.service._response_cache_ttl = 60
+        self.service._response_cache_shared = False
+        self.service._prompt_hash = AsyncMock(return_value="prompts-v1")
+        self.service._process_uncached = AsyncMock(side_effect=lambda text, *_: f"processed {text}")
+
+    def process(self, text):
+        return self.service._process_text(text, "grammar", {})
+
+    def test_identical_request_is_served_from_cache(self):
+        async def run():
+            return await self.process("a"), await self.process("a")
+
+        self.assertEqual(asyncio.run(run()), ("processed a", "processed a"))
+        self.assertEqual(self.service._process_uncached.await_count, 1)
+
+    def test_expired_entry_is_recomputed(self):
+        async def run():
+            await self.process("a")
+            # Scadenza già passata per tutte le voci in cache
+            cache = self.service._response_cache
+            for key, (_, result) in list(cache.items()):
+                cache[key] = (service_module.time.monotonic() - 1, result)
+            await self.process("a")
+
+        asyncio.run(run())
+        self.assertEqual(self.service._process_uncached.await_count, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        async def run():
+            await self.process("a")
+            await self.process("b")
+            await self.process("a")  # "a" diventa la più recente
+            await self.process("c")  # evict di "b"
+            await self.process("a")
+            await self.process("b")
+
+        asyncio.run(run())
+        processed = [call.args[0] for call in self.service._process_uncached.await_args_list]
+        self.assertEqual(processed, ["a", "b", "c", "b"])
+
+    def test_prompt_change_invalidates_cached_responses(self):
+        async def run():
+            await self.process("a")
+            self.service._prompt_hash.return_value = "prompts-v2"
+            await self.process("a")
+
+        asyncio.run(run())
+        self.assertEqual(self.service._process_uncached.await_count, 2)
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        async def slow(text, *_):
+            await asyncio.sleep(0.01)
+            return f"processed {text}"
+
+        self.service._process_uncached = AsyncMock(side_effect=slow)
+
+        async def run():
+            return await asyncio.gather(*(self.process("a") for _ in range(5)))
+
+        self.assertEqual(asyncio.run(run()), ["processed a"] * 5)
+        self.assertEqual(self.service._process_uncached.await_count, 1)
+
+
+class BatchTest(unittest.TestCase):
+    """Invio dei batch e lettura dei risultati per il proprietario"""
+
+    def setUp(self):
+        self.service = OpenAIService()
+        self.service.client = MagicMock()
+        self.service._build_messages = AsyncMock(return_value=([{"role": "user", "content": "x"}], 100))
+
+    def _batch(self, **fields):
+        batch = {
+            "id": "batch_1",
+            "status": "completed",
+            "metadata": {"user_id": "user-1"},
+            "request_counts": SimpleNamespace(completed=1, failed=1, total=2),
+            "output_file_id": "file-out",
+            "error_file_id": None,
+        }
+        batch.update(fields)
+        return SimpleNamespace(**batch)
+
+    def test_submit_batch_keeps_custom_ids_and_owner(self):
+        self.service.client.files.create = AsyncMock(return_value=SimpleNamespace(id="file-in"))
+        self.service.client.batches.create = AsyncMock(return_value=SimpleNamespace(id="batch_1"))
+
+        batch_id = asyncio.run(self.service._submit_batch("user-1", [
+            {"text": "one", "processing_type": "grammar", "options": {}, "custom_id": "0"},
+            {"text": "two", "processing_type": "style", "options": {}, "custom_id": "mine"},
+        ]))
+
+        self.assertEqual(batch_id, "batch_1")
+        _, content = self.service.client.files.create.await_args.kwargs["file"]
+        lines = [json.loads(line) for line in content.decode("utf-8").splitlines()]
+        self.assertEqual([line["custom_id"] for line in lines], ["0", "mine"])
+        self.assertEqual(self.service.client.batches.create.await_args.kwargs["metadata"], {"user_id": "user-1"})
+
+    def test_submit_batch_rejects_humanizer(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.service._submit_batch("user-1", [
+                {"text": "one", "processing_type": "humanizer", "options": {}, "custom_id": "0"},
+            ]))
+
+    def test_results_are_mapped_by_custom_id(self):
+        output = "\n".join(json.dumps(row) for row in (
+            {"custom_id": "0", "response": {"status_code": 200, "body": {"choices": [
+                {"message": {"content": "<TRANSFORMED_TEXT>done</TRANSFORMED_TEXT>"}}
+            ]}}},
+            {"custom_id": "1", "response": {"status_code": 500}, "error": {"message": "boom"}},
+        ))
+        self.service.client.batches.retrieve = AsyncMock(return_value=self._batch())
+        self.service.client.files.content = AsyncMock(return_value=SimpleNamespace(text=output))
+
+        result = asyncio.run(self.service._get_batch_results("batch_1", "user-1"))
+
+        self.assertEqual(result["results"], {"0": "done", "1": None})
+        self.assertEqual((result["completed"], result["failed"], result["total"]), (1, 1, 2))
+
+    def test_running_batch_has_no_results(self):
+        self.service.client.batches.retrieve = AsyncMock(return_value=self._batch(status="in_progress"))
+        self.service.client.files.content = AsyncMock()
+
+        result = asyncio.run(self.service._get_batch_results("batch_1", "user-1"))
+
+        self.assertIsNone(result["results"])
+        self.service.client.files.content.assert_not_awaited()
+
+    def test_other_users_batch_is_not_found(self):
+        self.service.client.batches.retrieve = AsyncMock(return_value=self._batch())
+        self.service.client.files.content = AsyncMock()
+
+        self.assertIsNone(asyncio.run(self.service._get_batch_results("batch_1", "user-2")))
+        self.service.client.files.content.assert_not_awaited()
+
+    def test_unknown_batch_is_not_found(self):
+        request = httpx.Request("GET", "https://api.openai.com/v1/batches/missing")
+        self.service.client.batches.retrieve = AsyncMock(side_effect=NotFoundError(
+            "not found", response=httpx.Response(404, request=request), body=None
+        ))
+
+        self.assertIsNone(asyncio.run(self.service._get_batch_results("missing", "user-1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
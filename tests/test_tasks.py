@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.workers import tasks
+
+PAYMENT_EVENT = {
+    "id": "evt_1",
+    "type": "payment_intent.succeeded",
+    "data": {
+        "object": {
+            "customer": "cus_1",
+            "customer_email": "customer@example.com",
+            "payment_intent": "pi_1",
+            "amount_paid": 999,
+            "metadata": {"plan_type": "monthly", "customer_name": "Mario"},
+        }
+    },
+}
+
+
+class WebhookIdempotencyTest(unittest.TestCase):
+    """handle_webhook_event_task con gli eventi Stripe ripetuti"""
+
+    def setUp(self):
+        self.payment_service = MagicMock()
+        self.payment_service.mark_webhook_processed = AsyncMock(return_value=True)
+        self.payment_task = MagicMock()
+        for target, value in (
+            ("payment_service", self.payment_service),
+            ("process_payment_success_task", self.payment_task),
+        ):
+            patcher = patch.object(tasks, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_task(self):
+        return tasks.handle_webhook_event_task.apply(args=[PAYMENT_EVENT]).get()
+
+    def test_new_event_is_processed_and_marked(self):
+        self.payment_service.log_webhook_event = AsyncMock(return_value={"processing_status": "pending"})
+
+        result = self.run_task()
+
+        self.assertEqual(result, {"success": True, "processed": "payment_intent.succeeded"})
+        self.payment_task.apply_async.assert_called_once()
+        payment_data = self.payment_task.apply_async.call_args.kwargs["kwargs"]["payment_data"]
+        self.assertEqual(payment_data["payment_intent_id"], "pi_1")
+        self.payment_service.mark_webhook_processed.assert_awaited_once_with("evt_1")
+
+    def test_completed_event_is_skipped(self):
+        self.payment_service.log_webhook_event = AsyncMock(return_value={"processing_status": "completed"})
+
+        result = self.run_task()
+
+        self.assertTrue(result["duplicate"])
+        self.payment_task.apply_async.assert_not_called()
+        self.payment_service.mark_webhook_processed.assert_not_awaited()
+
+    def test_failed_event_is_processed_again(self):
+        self.payment_service.log_webhook_event = AsyncMock(return_value={"processing_status": "failed"})
+
+        self.run_task()
+
+        self.payment_task.apply_async.assert_called_once()
+        self.payment_service.mark_webhook_processed.assert_awaited_once_with("evt_1")
+
+    def test_logging_failure_does_not_block_the_payment(self):
+        # Es. indice unico su stripe_event_id non ancora creato
+        self.payment_service.log_webhook_event = AsyncMock(side_effect=Exception("no unique constraint"))
+
+        result = self.run_task()
+
+        self.assertTrue(result["success"])
+        self.payment_task.apply_async.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
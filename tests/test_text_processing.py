@@ -0,0 +1,123 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from app.api.v1.endpoints import text_processing
+from app.core.auth import get_authenticated_user_with_credits, verify_email_verified
+from app.schemas.text_schemas import BatchTextProcessingRequest
+
+
+class BatchRequestSchemaTest(unittest.TestCase):
+    """custom_id degli elementi di un batch"""
+
+    def test_missing_custom_ids_default_to_the_index(self):
+        request = BatchTextProcessingRequest(items=[
+            {"text": "one"},
+            {"text": "two", "custom_id": "mine"},
+            {"text": "three"},
+        ])
+        self.assertEqual([item.custom_id for item in request.items], ["0", "mine", "2"])
+
+    def test_duplicate_custom_ids_are_rejected(self):
+        with self.assertRaises(ValidationError):
+            BatchTextProcessingRequest(items=[
+                {"text": "one", "custom_id": "a"},
+                {"text": "two", "custom_id": "a"},
+            ])
+
+    def test_custom_id_clashing_with_a_default_is_rejected(self):
+        with self.assertRaises(ValidationError):
+            BatchTextProcessingRequest(items=[
+                {"text": "one"},
+                {"text": "two", "custom_id": "0"},
+            ])
+
+    def test_humanizer_is_rejected(self):
+        with self.assertRaises(ValidationError):
+            BatchTextProcessingRequest(items=[{"text": "one", "processing_type": "humanizer"}])
+
+
+class BatchEndpointsTest(unittest.TestCase):
+    """POST /batch e GET /batch/{batch_id} con servizio OpenAI simulato"""
+
+    def setUp(self):
+        self.user = {"id": "user-1", "email": "user@example.com", "subscription_tier": "premium"}
+        app = FastAPI()
+        app.include_router(text_processing.router)
+        app.dependency_overrides[get_authenticated_user_with_credits] = lambda: self.user
+        app.dependency_overrides[verify_email_verified] = lambda: self.user
+        self.client = TestClient(app)
+
+        self.openai_service = MagicMock()
+        for target, value in (
+            ("openai_service", self.openai_service),
+            ("apply_rate_limit_safe", AsyncMock()),
+        ):
+            patcher = patch.object(text_processing, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_submit_returns_the_custom_ids(self):
+        self.openai_service.submit_batch = AsyncMock(return_value="batch_1")
+
+        response = self.client.post("/batch", json={"items": [
+            {"text": "first text", "processing_type": "grammar"},
+            {"text": "second text", "processing_type": "style", "custom_id": "mine"},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["custom_ids"], ["0", "mine"])
+        user_id, requests = self.openai_service.submit_batch.await_args.args
+        self.assertEqual(user_id, "user-1")
+        self.assertEqual([request["custom_id"] for request in requests], ["0", "mine"])
+
+    def test_submit_requires_a_paid_subscription(self):
+        self.user["subscription_tier"] = "free"
+        self.openai_service.submit_batch = AsyncMock()
+
+        response = self.client.post("/batch", json={"items": [{"text": "first text"}]})
+
+        self.assertEqual(response.status_code, 403)
+        self.openai_service.submit_batch.assert_not_awaited()
+
+    def test_submit_applies_the_word_limit_to_each_item(self):
+        self.openai_service.submit_batch = AsyncMock()
+
+        response = self.client.post("/batch", json={"items": [
+            {"text": "short text"},
+            {"text": "word " * 1001},
+        ]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"]["item_index"], 1)
+        self.openai_service.submit_batch.assert_not_awaited()
+
+    def test_status_of_a_batch_owned_by_someone_else_is_not_found(self):
+        self.openai_service.get_batch_results = AsyncMock(return_value=None)
+
+        response = self.client.get("/batch/batch_1")
+
+        self.assertEqual(response.status_code, 404)
+        self.openai_service.get_batch_results.assert_awaited_once_with("batch_1", "user-1")
+
+    def test_status_returns_results_by_custom_id(self):
+        self.openai_service.get_batch_results = AsyncMock(return_value={
+            "batch_id": "batch_1",
+            "status": "completed",
+            "completed": 1,
+            "failed": 1,
+            "total": 2,
+            "results": {"0": "done", "mine": None},
+        })
+
+        response = self.client.get("/batch/batch_1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], {"0": "done", "mine": None})
+
+
+if __name__ == "__main__":
+    unittest.main()